@@ -3,16 +3,24 @@
 from __future__ import annotations
 import argparse
 import base64
+import io
+import json
 import os
 import sys
+import unicodedata
 from pathlib import Path
 from typing import Iterable, Tuple
 
+from PIL import Image
+
 PNG_EXTS = {".png", ".PNG"}
 
-def to_base64(png_path: Path) -> str:
-    with png_path.open("rb") as f:
-        return base64.b64encode(f.read()).decode("utf-8")
+# Tamanhos em que o Dashboard desenha os ícones (px CSS) e fatores de densidade gerados
+TAMANHOS_PADRAO = (24, 28)
+ESCALAS_PADRAO = (1, 2)
+
+def to_base64(data: bytes) -> str:
+    return base64.b64encode(data).decode("utf-8")
 
 def to_datauri_from_b64(b64: str) -> str:
     return f"data:image/png;base64,{b64}"
@@ -22,48 +30,174 @@ def should_convert(src: Path, dst: Path, force: bool) -> bool:
         return True
     return not dst.exists() or dst.stat().st_size == 0 or dst.stat().st_mtime < src.stat().st_mtime
 
-def find_pngs(root: Path, recursive: bool) -> Iterable[Path]:
-    if recursive:
-        yield from (p for p in root.rglob("*") if p.suffix in PNG_EXTS and p.is_file())
-    else:
-        yield from (p for p in root.glob("*") if p.suffix in PNG_EXTS and p.is_file())
+def find_pngs(root: Path, recursive: bool, exclude: Path | None = None) -> Iterable[Path]:
+    candidatos = root.rglob("*") if recursive else root.glob("*")
+    for p in candidatos:
+        if p.suffix not in PNG_EXTS or not p.is_file():
+            continue
+        if exclude is not None and exclude in p.resolve().parents:
+            continue  # não reprocessa as próprias saídas (variantes/sprite)
+        yield p
 
 def write_text(path: Path, text: str) -> None:
     path.parent.mkdir(parents=True, exist_ok=True)
     with path.open("w", encoding="utf-8") as f:
         f.write(text)
 
-def convert_one(png_path: Path, write_datauri: bool, write_b64: bool, force: bool) -> Tuple[bool, str]:
+def write_bytes(path: Path, data: bytes) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with path.open("wb") as f:
+        f.write(data)
+
+def slug(nome: str) -> str:
+    """Nome do ícone sem acentos/espaços ("Prédios Públicos" -> "PrediosPublicos"), usado em arquivos e classes CSS."""
+    base = unicodedata.normalize("NFKD", nome).encode("ascii", "ignore").decode("ascii")
+    return "".join(c for c in base if c.isalnum())
+
+def render_icon(img: Image.Image, px: int, colors: int) -> Image.Image:
+    """Redimensiona para px×px (mantendo proporção, centralizado) e reduz a paleta (0 = sem quantização)."""
+    img = img.convert("RGBA")
+    img.thumbnail((px, px), Image.Resampling.LANCZOS)
+    if img.size != (px, px):
+        quadro = Image.new("RGBA", (px, px), (0, 0, 0, 0))
+        quadro.paste(img, ((px - img.width) // 2, (px - img.height) // 2))
+        img = quadro
+    if colors > 0:
+        img = img.quantize(colors=colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+    return img
+
+def png_bytes(img: Image.Image) -> bytes:
+    buf = io.BytesIO()
+    img.save(buf, format="PNG", optimize=True)
+    return buf.getvalue()
+
+def optimized_png(src: Path, px: int, colors: int) -> bytes:
+    """PNG otimizado no tamanho final; se a paleta não compensar, fica a versão RGBA (a menor das duas)."""
+    with Image.open(src) as img:
+        img.load()
+        saidas = [png_bytes(render_icon(img, px, 0))]
+        if colors > 0:
+            saidas.append(png_bytes(render_icon(img, px, colors)))
+    return min(saidas, key=len)
+
+def variant_name(src: Path, size: int, scale: int) -> str:
+    return f"{slug(src.stem)}-{size}" + (f"@{scale}x" if scale > 1 else "") + ".png"
+
+def convert_one(png_path: Path, write_datauri: bool, write_b64: bool, force: bool,
+                datauri_px: int = 0, colors: int = 0,
+                variants_dir: Path | None = None, sizes: Tuple[int, ...] = (), scales: Tuple[int, ...] = ()) -> Tuple[bool, str]:
+    def encode() -> str:
+        # datauri_px = 0 mantém o PNG original (comportamento antigo)
+        if datauri_px > 0:
+            return to_base64(optimized_png(png_path, datauri_px, colors))
+        return to_base64(png_path.read_bytes())
+
     try:
-        b64 = to_base64(png_path)
+        b64 = None   # codificado só se algum .datauri/.b64 precisar ser (re)escrito
         created_any = False
         msgs = []
 
         if write_datauri:
             datauri_path = png_path.with_suffix(png_path.suffix + ".datauri")  # ex: "Empresas.png.datauri"
             if should_convert(png_path, datauri_path, force):
+                b64 = b64 or encode()
                 write_text(datauri_path, to_datauri_from_b64(b64))
                 created_any = True
-                msgs.append(f"→ .datauri: {datauri_path.name}")
+                msgs.append(f"→ .datauri: {datauri_path.name} ({len(b64) // 1024} KB)")
             else:
                 msgs.append(f"(skip .datauri existe): {datauri_path.name}")
 
         if write_b64:
             b64_path = png_path.with_suffix(png_path.suffix + ".b64")
             if should_convert(png_path, b64_path, force):
+                b64 = b64 or encode()
                 write_text(b64_path, b64)
                 created_any = True
                 msgs.append(f"→ .b64: {b64_path.name}")
             else:
                 msgs.append(f"(skip .b64 existe): {b64_path.name}")
 
+        if variants_dir is not None:
+            geradas = 0
+            for size in sizes:
+                for scale in scales:
+                    dst = variants_dir / variant_name(png_path, size, scale)
+                    if should_convert(png_path, dst, force):
+                        write_bytes(dst, optimized_png(png_path, size * scale, colors))
+                        geradas += 1
+            if geradas:
+                created_any = True
+                msgs.append(f"→ {geradas} variante(s) em {variants_dir.name}/")
+            else:
+                msgs.append("(skip variantes existem)")
+
         return created_any, " | ".join(msgs)
     except Exception as e:
         return False, f"ERRO em {png_path.name}: {e}"
 
+def build_sprite(pngs: list[Path], out_dir: Path, sizes: Tuple[int, ...], scales: Tuple[int, ...],
+                 colors: int, force: bool) -> Tuple[bool, str]:
+    """
+    Folha única com todos os ícones: uma linha por tamanho, um ícone por coluna.
+    Gera sprite.png / sprite@2x.png (...), sprite.json ({slug: {tamanho: {x, y, w, h}}}, em px CSS)
+    e sprite.css (.icone-<slug>-<tamanho>, com a folha @2x em telas de alta densidade).
+    """
+    try:
+        folhas = {s: out_dir / ("sprite.png" if s == 1 else f"sprite@{s}x.png") for s in scales}
+        index_path, css_path = out_dir / "sprite.json", out_dir / "sprite.css"
+        saidas = [*folhas.values(), index_path, css_path]
+        if not force and all(not should_convert(src, dst, False) for src in pngs for dst in saidas):
+            return False, f"(skip sprite atualizado): {out_dir.name}/sprite.*"
+
+        largura = sum(max(sizes) for _ in pngs)
+        altura = sum(sizes)
+        index: dict[str, dict[str, dict[str, int]]] = {}
+        y = 0
+        for size in sizes:
+            for col, src in enumerate(pngs):
+                index.setdefault(slug(src.stem), {})[str(size)] = {"x": col * max(sizes), "y": y, "w": size, "h": size}
+            y += size
+
+        for scale, dst in folhas.items():
+            folha = Image.new("RGBA", (largura * scale, altura * scale), (0, 0, 0, 0))
+            for src in pngs:
+                with Image.open(src) as img:
+                    img.load()
+                    for size, pos in index[slug(src.stem)].items():
+                        folha.paste(render_icon(img, pos["w"] * scale, 0), (pos["x"] * scale, pos["y"] * scale))
+            if colors > 0:
+                folha = folha.quantize(colors=colors, method=Image.Quantize.FASTOCTREE, dither=Image.Dither.NONE)
+            write_bytes(dst, png_bytes(folha))
+
+        write_text(index_path, json.dumps({"largura": largura, "altura": altura, "icones": index},
+                                          ensure_ascii=False, indent=2))
+        css = [f".icone-sprite{{background-image:url({folhas[min(scales)].name});"
+               f"background-size:{largura}px {altura}px;background-repeat:no-repeat;}}"]
+        for nome, tamanhos in index.items():
+            for size, pos in tamanhos.items():
+                css.append(f".icone-{nome}-{size}{{width:{pos['w']}px;height:{pos['h']}px;"
+                           f"background-position:-{pos['x']}px -{pos['y']}px;}}")
+        if max(scales) > min(scales):
+            css.append(f"@media (min-resolution:{max(scales)}dppx){{.icone-sprite{{background-image:url({folhas[max(scales)].name});}}}}")
+        write_text(css_path, "\n".join(css) + "\n")
+        tam = sum(p.stat().st_size for p in folhas.values()) // 1024
+        return True, f"→ sprite: {len(pngs)} ícone(s) × {len(sizes)} tamanho(s), {', '.join(p.name for p in folhas.values())} ({tam} KB)"
+    except Exception as e:
+        return False, f"ERRO no sprite: {e}"
+
+def _int_list(texto: str) -> Tuple[int, ...]:
+    try:
+        valores = tuple(sorted({int(v) for v in texto.split(",") if v.strip()}))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"lista de inteiros inválida: {texto!r}")
+    if not valores or min(valores) <= 0:
+        raise argparse.ArgumentTypeError(f"use inteiros positivos separados por vírgula: {texto!r}")
+    return valores
+
 def main(argv: list[str] | None = None) -> int:
     parser = argparse.ArgumentParser(
-        description="Converte PNGs em .datauri (e opcionalmente .b64) para uso no Folium/Streamlit.",
+        description="Converte PNGs em .datauri (e opcionalmente .b64) para uso no Folium/Streamlit, "
+                    "redimensionando e otimizando para os tamanhos desenhados no mapa.",
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
     )
     parser.add_argument(
@@ -79,6 +213,27 @@ def main(argv: list[str] | None = None) -> int:
     group.add_argument(
         "--b64-only", action="store_true", help="Gerar apenas .b64"
     )
+    parser.add_argument(
+        "--sizes", type=_int_list, default=TAMANHOS_PADRAO, help="Tamanhos desenhados no mapa (px, separados por vírgula)"
+    )
+    parser.add_argument(
+        "--scales", type=_int_list, default=ESCALAS_PADRAO, help="Densidades geradas (1 = normal, 2 = telas retina)"
+    )
+    parser.add_argument(
+        "--colors", type=int, default=64, help="Cores da paleta na quantização (0 = manter RGBA)"
+    )
+    parser.add_argument(
+        "--original", action="store_true", help="Embutir o PNG original no .datauri/.b64, sem redimensionar"
+    )
+    parser.add_argument(
+        "--variants", action="store_true", help="Gravar também um PNG por tamanho × densidade em --output-dir"
+    )
+    parser.add_argument(
+        "--sprite", action="store_true", help="Gerar folha única (sprite) com índice CSS/JSON em --output-dir"
+    )
+    parser.add_argument(
+        "-o", "--output-dir", default=None, help="Destino de variantes e sprite (padrão: <input-dir>/dist)"
+    )
     parser.add_argument(
         "-f", "--force", action="store_true", help="Sobrescrever arquivos existentes"
     )
@@ -92,6 +247,7 @@ def main(argv: list[str] | None = None) -> int:
     if not root.exists() or not root.is_dir():
         print(f"Diretório não encontrado: {root}", file=sys.stderr)
         return 2
+    out_dir = Path(args.output_dir).resolve() if args.output_dir else root / "dist"
 
     write_datauri = True
     write_b64 = False
@@ -100,7 +256,10 @@ def main(argv: list[str] | None = None) -> int:
     elif args.b64_only:
         write_datauri, write_b64 = False, True
 
-    pngs = list(find_pngs(root, args.recursive))
+    # .datauri no maior tamanho desenhado na maior densidade: serve nítido a todos os tamanhos via CSS
+    datauri_px = 0 if args.original else max(args.sizes) * max(args.scales)
+
+    pngs = sorted(find_pngs(root, args.recursive, exclude=out_dir))
     if not pngs:
         print(f"Nenhum PNG encontrado em: {root}")
         return 0
@@ -112,10 +271,15 @@ def main(argv: list[str] | None = None) -> int:
 
     if not args.quiet:
         print(f"Processando {total} PNG(s) em {root} (recursive={args.recursive})")
-        print(f"Geração: .datauri={write_datauri}, .b64={write_b64}, force={args.force}\n")
+        print(f"Geração: .datauri={write_datauri}, .b64={write_b64}, force={args.force}")
+        print(f"Ícones: {datauri_px or 'original'} px no .datauri, tamanhos={list(args.sizes)}, "
+              f"densidades={list(args.scales)}, cores={args.colors}\n")
 
     for i, p in enumerate(pngs, 1):
-        ok, msg = convert_one(p, write_datauri, write_b64, args.force)
+        ok, msg = convert_one(p, write_datauri, write_b64, args.force,
+                              datauri_px=datauri_px, colors=args.colors,
+                              variants_dir=out_dir if args.variants else None,
+                              sizes=args.sizes, scales=args.scales)
         if ok:
             created += 1
             if not args.quiet:
@@ -130,6 +294,14 @@ def main(argv: list[str] | None = None) -> int:
                 if not args.quiet:
                     print(f"[{i}/{total}] {p.name} | {msg}")
 
+    if args.sprite:
+        ok, msg = build_sprite(pngs, out_dir, args.sizes, args.scales, args.colors, args.force)
+        if "ERRO" in msg:
+            errors += 1
+            print(msg, file=sys.stderr)
+        elif not args.quiet:
+            print(msg)
+
     if not args.quiet:
         print("\nResumo:")
         print(f"  PNGs encontrados : {total}")
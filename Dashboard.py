@@ -3,12 +3,21 @@
 # Versão: 2025-10-02 (Educação: funcionários por soma das colunas; cards por dependência; fix do mapa quando "Atingidos")
 
 import streamlit as st
+import numpy as np
 import pandas as pd
 import geopandas as gpd
+import shapely
 import folium
-from folium.plugins import MarkerCluster
-from streamlit_folium import st_folium
-import os, base64
+from folium.plugins import FastMarkerCluster, Draw, VectorGridProtobuf
+from streamlit_folium import st_folium, generate_leaflet_string
+from jinja2 import Template
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+import os, base64, glob, json, pickle, gzip, sqlite3, struct, threading, hashlib
+from collections import OrderedDict
+from contextlib import closing
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 # ========= Helpers de formatação (pt-BR + K/M/B/T) =========
 def _pt_number(x, nd=1):
@@ -40,19 +49,50 @@ def pct_int(x):
     try: return f"{int(round(float(x)))}%"
     except Exception: return "0%"
 
-# ========= Helpers de contagem =========
-def _count_flag01(df, col):
-    if (df is None) or (col not in df.columns): return 0
-    s = pd.to_numeric(df[col], errors="coerce")
-    if s.notna().any(): return int((s == 1).sum())
-    sv = df[col].astype(str).str.strip().str.lower()
-    return int(sv.isin({"1", "true", "sim", "yes"}).sum())
-
-def _count_equals(df, col, values):
-    if (df is None) or (col not in df.columns): return 0
-    sv = df[col].astype(str).str.strip().str.lower()
+# ========= Helpers de contagem (flags normalizadas uma vez no carregamento) =========
+def _flag01(s: pd.Series) -> pd.Series:
+    """1/0 numérico; se a coluna não tiver nenhum número, aceita '1', 'true', 'sim', 'yes'."""
+    num = pd.to_numeric(s, errors="coerce")
+    if num.notna().any():
+        return (num == 1)
+    return s.astype(str).str.strip().str.lower().isin({"1", "true", "sim", "yes"})
+
+def _flag_igual(s: pd.Series, values) -> pd.Series:
     vals = {str(v).strip().lower() for v in values}
-    return int(sv.isin(vals).sum())
+    return s.astype(str).str.strip().str.lower().isin(vals)
+
+# coluna booleana -> (coluna de origem, valores aceitos; None = flag 0/1)
+FLAGS_TERRENOS = {
+    "_f_agua":           ("agua", None),
+    "_f_coleta_lix":     ("coleta_lix", None),
+    "_f_esgoto_plu":     ("esgoto_plu", None),
+    "_f_condominio":     ("condominio", None),
+    "_f_esgoto_cloacal": ("esgoto_clo", {"esgoto_cloacal"}),
+    "_f_fossa_septica":  ("esgoto_clo", {"fossa_septica"}),
+}
+FLAGS_RUAS = {
+    "_f_drenagem":   ("drenagem", None),
+    "_f_iluminacao": ("iluminacao", None),
+}
+
+def _normalizar_flags(gdf, specs: dict):
+    """Materializa as flags de 'specs' como colunas booleanas (coluna ausente -> False)."""
+    if gdf is None:
+        return gdf
+    gdf = gdf.copy()
+    for dst, (col, values) in specs.items():
+        if col not in gdf.columns:
+            gdf[dst] = False
+        else:
+            gdf[dst] = (_flag01(gdf[col]) if values is None else _flag_igual(gdf[col], values)).to_numpy(dtype=bool)
+    return gdf
+
+def _somar_flags(df, specs: dict) -> dict:
+    """Contagem de todas as flags numa única redução: soma por coluna da matriz booleana."""
+    cols = list(specs)
+    if df is None or len(df) == 0 or not set(cols).issubset(df.columns):
+        return dict.fromkeys(cols, 0)
+    return dict(zip(cols, df[cols].to_numpy(dtype=bool).sum(axis=0).astype(int).tolist()))
 
 # ========= Mapas e helpers específicos: EDUCAÇÃO =========
 
@@ -89,13 +129,8 @@ STAFF_COLS = [
     "QT_PROF_TRAD_LIBRAS","QT_PROF_AGRICOLA","QT_PROF_REVISOR_BRAILLE"
 ]
 
-def _sum_cols(df: pd.DataFrame, cols: list[str]) -> float:
-    if df is None or len(df) == 0:
-        return 0.0
-    use = [c for c in cols if c in df.columns]
-    if not use:
-        return 0.0
-    return pd.to_numeric(df[use].stack(), errors="coerce").fillna(0).sum()
+# Colunas derivadas por escola (materializadas em carregar_educacao_xlsx)
+COLS_MAT_NIVEIS = ["MAT_INFANTIL", "MAT_FUNDAMENTAL", "MAT_MEDIO", "MAT_TECNICO_PROF"]
 
 # ========= Ícones customizados (carrega .datauri prontos de .icons) =========
 def _icons_path(filename: str) -> str:
@@ -120,8 +155,11 @@ def _icon_data_uri(path: str) -> str | None:
         pass
     return None
 
-@st.cache_data(show_spinner=False)
-def get_custom_icon(name: str, size=(28,28), anchor="center") -> folium.CustomIcon | None:
+def icone_mapa(m: folium.Map, name: str, size=(28,28), anchor="center") -> dict | None:
+    """
+    Opções de L.divIcon para o ícone `name`. A imagem entra uma única vez no documento do mapa, como
+    classe CSS (.icone-<name>) no cabeçalho; os marcadores só referenciam a classe.
+    """
     path = ICONS_PATHS.get(name)
     uri  = _icon_data_uri(path) if path else None
     if uri is None:
@@ -132,7 +170,11 @@ def get_custom_icon(name: str, size=(28,28), anchor="center") -> folium.CustomIc
         ax, ay = anchor
     else:
         ax, ay = size[0]//2, size[1]//2
-    return folium.CustomIcon(icon_image=uri, icon_size=size, icon_anchor=(ax, ay))
+    # add_child com o mesmo nome substitui o filho: a classe é definida uma vez, por mais camadas que a usem
+    m.get_root().header.add_child(folium.Element(
+        f"<style>.icone-{name}{{background:url({uri}) center/100% 100% no-repeat;}}</style>"
+    ), name=f"icone_{name}")
+    return {"className": f"icone-{name}", "iconSize": list(size), "iconAnchor": [ax, ay]}
 
 # ========= Configuração =========
 st.set_page_config(page_title="Vulnerabilidade Econômica - Rio Grande", layout="wide")
@@ -148,6 +190,8 @@ h1 { padding-bottom: 0.5rem; }
 
 :root{ --card-bg:#FFFFFF; --card-br:#CCC; --card-tx:#000; --muted:#000;
        --blue:#247BA0; --green:#2E7D32; --orange:#C25E00; --purple:#6F42C1; --teal:#00695c; --gray:#424242; }
+.grade-cards{ display:grid; column-gap:.75rem; }
+@media (max-width: 640px){ .grade-cards{ grid-template-columns:1fr !important; } }
 .mini-card{ display:flex; gap:.65rem; align-items:flex-start; width:100%;
             background:var(--card-bg); border:1px solid var(--card-br);
             border-radius:.6rem; padding:.75rem .95rem !important; margin-bottom:.85rem !important;
@@ -205,6 +249,49 @@ def carregar_empresas_xlsx(caminho_completo):
         st.error(f"Erro ao carregar o arquivo de empresas: {e}")
         return None
 
+@st.cache_data
+def carregar_terrenos(caminho_completo):
+    return _normalizar_flags(carregar_shapefile(caminho_completo), FLAGS_TERRENOS)
+
+@st.cache_data
+def carregar_logradouros(caminho_completo):
+    gdf = _normalizar_flags(carregar_shapefile(caminho_completo), FLAGS_RUAS)
+    if gdf is not None:
+        # Identificador de rua (tipo + nome) usado nas contagens de ruas únicas
+        if {'tipo','nome'}.issubset(gdf.columns):
+            gdf['tipo'] = gdf['tipo'].fillna('')
+            gdf['nome'] = gdf['nome'].fillna('')
+            gdf['_rua_id_interno'] = (gdf['tipo'].astype(str).str.strip() + ' ' +
+                                      gdf['nome'].astype(str).str.strip()).str.strip()
+        else:
+            gdf['_rua_id_interno'] = gdf.index.astype(str)
+    return gdf
+
+# === IMÓVEIS ===
+_TOKENS_OUTROS = {"", "none", "nan", "na", "null", "sem informação", "sem informacao", "outro", "outros"}
+
+def _categoria_normalizada(s: pd.Series) -> pd.Series:
+    """Agrupa sem diferenciar caixa/espaços (rótulo = primeira grafia vista); vazios/'outros' -> 'Outros'."""
+    s_raw = s.astype(str).str.strip()
+    s_norm = s_raw.str.lower()
+    mask_outros = s_norm.isin(_TOKENS_OUTROS)
+    rotulos = s_raw[~mask_outros].groupby(s_norm[~mask_outros], sort=False).first()
+    return s_norm.map(rotulos).where(~mask_outros, "Outros").fillna("Outros")
+
+@st.cache_data
+def carregar_imoveis(caminho_completo):
+    gdf = carregar_shapefile(caminho_completo)
+    if gdf is None:
+        return None
+    if gdf.crs is None or gdf.crs.to_epsg() in [None, 4326]:
+        gdf = gdf.set_crs("EPSG:31982", allow_override=True)
+    for col, dst in (("Uso", "_uso_cat"), ("Patrim", "_patrim_cat")):
+        if col in gdf.columns:
+            gdf[dst] = _categoria_normalizada(gdf[col])
+    cond = pd.to_numeric(gdf["Condom"], errors="coerce").fillna(0).astype(int) if "Condom" in gdf.columns else 0
+    gdf["_f_condom"] = (cond == 1)
+    return gdf
+
 # === SAÚDE ===
 @st.cache_data
 def carregar_saude_xlsx(caminho_completo):
@@ -296,6 +383,8 @@ def carregar_educacao_xlsx(caminho_completo: str) -> gpd.GeoDataFrame | None:
       - Converte colunas numéricas; nas colunas de funcionários, o valor 88888 é tratado como sentinela inválida (vira 0).
       - Calcula DEP_LABEL (TP_DEPENDENCIA -> {1: Federal, 2: Estadual, 3: Municipal, 4: Privada}).
       - Calcula QT_FUNCIONARIOS = soma(STAFF_COLS) já sem os 88888.
+      - Materializa matrículas por escola: MAT_INFANTIL / MAT_FUNDAMENTAL / MAT_MEDIO (soma das COLS_*),
+        MAT_TECNICO_PROF (QT_MAT_PROF), MAT_TOTAL_NIVEIS e MAT_BAS_PROF (QT_MAT_BAS + QT_MAT_PROF).
       - Retorna GeoDataFrame em EPSG:4326 com geometry = Point(Longitude, Latitude).
     """
     try:
@@ -334,6 +423,17 @@ def carregar_educacao_xlsx(caminho_completo: str) -> gpd.GeoDataFrame | None:
         presentes = [c for c in STAFF_COLS if c in df.columns]
         df["QT_FUNCIONARIOS"] = df[presentes].sum(axis=1).fillna(0) if presentes else 0
 
+        # Matrículas por nível (somas vetorizadas por linha; NaN conta como 0)
+        def _soma_linhas(cols):
+            presentes = [c for c in cols if c in df.columns]
+            return df[presentes].sum(axis=1).fillna(0) if presentes else pd.Series(0.0, index=df.index)
+        df["MAT_INFANTIL"]     = _soma_linhas(COLS_INFANTIL)
+        df["MAT_FUNDAMENTAL"]  = _soma_linhas(COLS_FUNDAMENTAL)
+        df["MAT_MEDIO"]        = _soma_linhas(COLS_MEDIO)
+        df["MAT_TECNICO_PROF"] = _soma_linhas(["QT_MAT_PROF"])
+        df["MAT_TOTAL_NIVEIS"] = df[COLS_MAT_NIVEIS].sum(axis=1)
+        df["MAT_BAS_PROF"]     = _soma_linhas(["QT_MAT_BAS", "QT_MAT_PROF"])
+
         # GeoDataFrame
         gdf = gpd.GeoDataFrame(
             df,
@@ -346,28 +446,55 @@ def carregar_educacao_xlsx(caminho_completo: str) -> gpd.GeoDataFrame | None:
         st.error(f"Erro ao carregar o arquivo de Educação (Escolas.xlsx): {e}")
         return None
     
+# === CENÁRIOS (manchas CEN_*.shp) ===
+def _rotulo_padrao_cenario(stem: str) -> str:
+    return stem[4:].replace("_", " ") if stem.upper().startswith("CEN_") else stem
+
+def descobrir_cenarios(pasta: str) -> dict[str, str]:
+    """
+    Descobre as manchas em '<pasta>/CEN_*.shp' (novos cenários aparecem sem alterar o código).
+    Metadados opcionais em '<pasta>/cenarios.json': {"CEN_X": {"nome": "...", "ordem": 1}, ...};
+    sem metadados, o rótulo vem do nome do arquivo e a ordem é alfabética.
+    Retorna {rótulo: caminho do .shp} na ordem de exibição.
+    """
+    meta = {}
+    meta_path = os.path.join(pasta, "cenarios.json")
+    if os.path.exists(meta_path):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except Exception as e:
+            st.warning(f"Não foi possível ler 'cenarios.json': {e}")
+    itens = []
+    for caminho in sorted(glob.glob(os.path.join(pasta, "CEN_*.shp"))):
+        stem = os.path.splitext(os.path.basename(caminho))[0]
+        m = meta.get(stem, {})
+        itens.append((m.get("ordem", 999), m.get("nome", _rotulo_padrao_cenario(stem)), caminho))
+    return {nome: caminho for _, nome, caminho in sorted(itens, key=lambda t: (t[0], t[1]))}
+
 # ========================= Carregamento dos dados =========================
 with st.spinner('Carregando dados geoespaciais...'):
     pasta_dados = "Dados"
     gpea_logo_path = "GPEA.png"
 
+    fontes_camadas = {   # camada base -> arquivo de origem (assinatura das chaves de cache, ver _assinatura_camada)
+        "Ruas":     os.path.join(pasta_dados, 'PMRG_231215_layer_Logradouros_segmentos.shp'),
+        "Quadras":  os.path.join(pasta_dados, 'PMRG_231215_layer_Quadras.shp'),
+        "Terrenos": os.path.join(pasta_dados, 'PMRG_231215_layer_Terrenos.shp'),
+        "Empresas": os.path.join(pasta_dados, 'RAIS e Receita (Georrefenciada).xlsx'),
+        "Imóveis":  os.path.join(pasta_dados, 'PMRG_CAD_IMOB.shp'),
+    }
     bairros_gdf         = carregar_shapefile(os.path.join(pasta_dados, 'PMRG_231215_layer_Bairros.shp'))
-    logradouros_gdf     = carregar_shapefile(os.path.join(pasta_dados, 'PMRG_231215_layer_Logradouros_segmentos.shp'))
-    mancha_mai2024_gdf  = carregar_shapefile(os.path.join(pasta_dados, 'CEN_MAI2024.shp'))
-    mancha_set2023_gdf  = carregar_shapefile(os.path.join(pasta_dados, 'CEN_SET2023.shp'))
-
-    plus60_path = os.path.join(pasta_dados, 'CEN_MAI24_MAIS60CM.shp')
-    mancha_mai2024_plus60_gdf = carregar_shapefile(plus60_path) if os.path.exists(plus60_path) else None
-    if mancha_mai2024_plus60_gdf is None:
-        st.warning("Camada 'CEN_MAI24_MAIS60CM.shp' não encontrada na pasta 'Dados/'.")
+    logradouros_path    = fontes_camadas["Ruas"]
+    logradouros_gdf     = carregar_logradouros(logradouros_path)
+    cenarios_arquivo    = descobrir_cenarios(pasta_dados)
+    if not cenarios_arquivo:
+        st.warning("Nenhuma mancha 'CEN_*.shp' encontrada na pasta 'Dados/'.")
 
-    quadras_gdf         = carregar_shapefile(os.path.join(pasta_dados, 'PMRG_231215_layer_Quadras.shp'))
-    terrenos_gdf        = carregar_shapefile(os.path.join(pasta_dados, 'PMRG_231215_layer_Terrenos.shp'))
-    empresas_gdf        = carregar_empresas_xlsx(os.path.join(pasta_dados, 'RAIS e Receita (Georrefenciada).xlsx'))
-    imoveis_gdf         = carregar_shapefile(os.path.join(pasta_dados, 'PMRG_CAD_IMOB.shp'))
-
-    if imoveis_gdf is not None and (imoveis_gdf.crs is None or imoveis_gdf.crs.to_epsg() in [None, 4326]):
-        imoveis_gdf = imoveis_gdf.set_crs("EPSG:31982", allow_override=True)
+    quadras_gdf         = carregar_shapefile(fontes_camadas["Quadras"])
+    terrenos_gdf        = carregar_terrenos(fontes_camadas["Terrenos"])
+    empresas_gdf        = carregar_empresas_xlsx(fontes_camadas["Empresas"])
+    imoveis_gdf         = carregar_imoveis(fontes_camadas["Imóveis"])
 
     # === SAÚDE ===
     saude_gdf = None
@@ -375,6 +502,7 @@ with st.spinner('Carregando dados geoespaciais...'):
                os.path.join(pasta_dados, 'Saude.xlsx')]:
         if os.path.exists(_p):
             saude_gdf = carregar_saude_xlsx(_p)
+            fontes_camadas["Saúde"] = _p
             if saude_gdf is not None: break
     if saude_gdf is None:
         st.warning("Planilha de Saúde não encontrada. Verifique o caminho e o nome do arquivo (Saúde.xlsx).")
@@ -386,6 +514,7 @@ with st.spinner('Carregando dados geoespaciais...'):
                '/mnt/data/parcial prédios públicos.xlsx']:
         if os.path.exists(_p):
             predios_publicos_gdf = carregar_predios_publicos_xlsx(_p)
+            fontes_camadas["Prédios Públicos"] = _p
             if predios_publicos_gdf is not None: break
     if predios_publicos_gdf is None:
         st.warning("Planilha de Prédios Públicos não encontrada. Esperado: 'parcial prédios públicos.xlsx'.")
@@ -397,6 +526,7 @@ with st.spinner('Carregando dados geoespaciais...'):
                '/mnt/data/parcial segurança.xlsx']:
         if os.path.exists(_p):
             seguranca_gdf = carregar_seguranca_xlsx(_p)
+            fontes_camadas["Segurança"] = _p
             if seguranca_gdf is not None: break
     if seguranca_gdf is None:
         st.warning("Planilha de Segurança não encontrada. Esperado: 'parcial segurança.xlsx'.")
@@ -409,11 +539,141 @@ with st.spinner('Carregando dados geoespaciais...'):
     ]:
         if os.path.exists(_p):
             educacao_gdf = carregar_educacao_xlsx(_p)
+            fontes_camadas["Educação"] = _p
             if educacao_gdf is not None:
                 break
     if educacao_gdf is None:
         st.warning("Planilha de Educação não encontrada. Esperado: 'Escolas.xlsx'.")
 
+# ========= Filtros: códigos de categoria e máscaras =========
+def _assinatura(gdf: gpd.GeoDataFrame) -> tuple:
+    return (len(gdf), tuple(np.round(gdf.total_bounds, 6)))
+
+@st.cache_data(show_spinner=False)
+def _assinatura_fonte(caminho: str | None) -> tuple:
+    """
+    (arquivo, mtime_ns, tamanho) do arquivo de origem e, num shapefile, dos arquivos irmãos (.dbf/.shx/.prj/.cpg).
+    Em cache_data como os carregadores: vale para a versão do arquivo que está carregada na memória.
+    """
+    if not caminho:
+        return ()
+    base, ext = os.path.splitext(caminho)
+    arquivos = [caminho] + ([base + e for e in (".dbf", ".shx", ".prj", ".cpg")] if ext.lower() == ".shp" else [])
+    partes = []
+    for arq in arquivos:
+        try:
+            info = os.stat(arq)
+        except OSError:
+            continue
+        partes.append((os.path.basename(arq), info.st_mtime_ns, info.st_size))
+    return tuple(partes)
+
+def _assinatura_camada(nome_camada: str, gdf: gpd.GeoDataFrame) -> tuple:
+    """
+    Assinatura de camada base para as chaves de cache (inclusive as persistidas em disco, com posições iloc):
+    forma da tabela + arquivo(s) de origem, de modo que reexportar a camada com as mesmas linhas/extensão
+    (reordenada ou editada) invalida os caches.
+    """
+    return (_assinatura(gdf), _assinatura_fonte(fontes_camadas.get(nome_camada)))
+
+# Colunas categóricas filtráveis por camada
+FILTROS_CATEGORICOS = {
+    "Empresas":         ("Seção", "Denominação", "situacao_cadastral_desc"),
+    "Saúde":            ("CO_TIPO_ESTABELECIMENTO",),
+    "Prédios Públicos": ("Tipo",),
+    "Segurança":        ("Tipo",),
+    "Educação":         ("DEP_LABEL",),
+}
+
+# Filtros dependentes: opções da coluna filha restritas às categorias escolhidas na coluna pai
+HIERARQUIAS_FILTRO = {"Empresas": (("Seção", "Denominação"),)}
+
+@st.cache_resource(show_spinner=False)
+def indice_invertido(nome_camada: str, assinatura: tuple, _gdf: gpd.GeoDataFrame, colunas: tuple) -> dict:
+    """
+    Índice invertido das colunas categóricas da camada, montado uma única vez:
+      - 'codigos': código int32 por linha (-1 = ausente); 'categorias': opções já ordenadas;
+      - 'postings': posições (ordenadas) das linhas de cada categoria; 'posicao': categoria -> código;
+      - 'filhos' (só na coluna pai de HIERARQUIAS_FILTRO): categoria -> opções da coluna filha.
+    Uma seleção vira a união dos postings escolhidos, sem varrer a tabela.
+    """
+    out = {}
+    for col in colunas:
+        if col not in _gdf.columns:
+            continue
+        valido = _gdf[col].notna().to_numpy()
+        cats, cod_validos = np.unique(_gdf[col].astype(str).to_numpy()[valido], return_inverse=True)
+        cod = np.full(len(_gdf), -1, dtype=np.int32)
+        cod[valido] = cod_validos
+        ordem = np.argsort(cod, kind="stable")
+        cortes = np.searchsorted(cod[ordem], np.arange(len(cats) + 1))
+        out[col] = {
+            "codigos": cod,
+            "categorias": cats.tolist(),
+            "postings": [ordem[cortes[i]:cortes[i + 1]] for i in range(len(cats))],
+            "posicao": {c: i for i, c in enumerate(cats.tolist())},
+        }
+    for pai, filho in HIERARQUIAS_FILTRO.get(nome_camada, ()):
+        if pai in out and filho in out:
+            cod_f, cats_f = out[filho]["codigos"], out[filho]["categorias"]
+            out[pai]["filhos"] = {
+                c: [cats_f[i] for i in np.unique(cod_f[linhas]) if i >= 0]
+                for c, linhas in zip(out[pai]["categorias"], out[pai]["postings"])
+            }
+    return out
+
+def _linhas(indice_col: dict, sel) -> np.ndarray:
+    """União dos postings das categorias selecionadas."""
+    ids = [indice_col["posicao"][v] for v in map(str, sel) if v in indice_col["posicao"]]
+    if not ids:
+        return np.empty(0, dtype=np.int64)
+    return np.concatenate([indice_col["postings"][i] for i in ids])
+
+def _mascara(indice: dict, n: int, filtros: dict | None) -> np.ndarray:
+    """Combina (E) as seleções {coluna: [valores]} numa máscara booleana; lista vazia = sem filtro."""
+    mask = np.ones(n, dtype=bool)
+    for col, sel in (filtros or {}).items():
+        if not sel or col not in indice:
+            continue
+        sel_col = np.zeros(n, dtype=bool)
+        sel_col[_linhas(indice[col], sel)] = True
+        mask &= sel_col
+    return mask
+
+@st.cache_data(show_spinner=False, max_entries=256)
+def contagens_faceta(nome_camada: str, assinatura, chave_cenario, coluna: str, filtros_outros: tuple,
+                     _indice: dict, _posicoes_atingidas) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Total e atingidos por categoria de 'coluna', sob os filtros das demais colunas ('filtros_outros').
+    Só conta códigos (bincount) sobre a máscara; fica em cache por cenário e combinação de filtros,
+    então mudar um filtro recalcula apenas as facetas que dependem dele.
+    """
+    cod = _indice[coluna]["codigos"]
+    n_cat = len(_indice[coluna]["categorias"])
+    mask = _mascara(_indice, len(cod), dict(filtros_outros)) & (cod >= 0)
+    total = np.bincount(cod[mask], minlength=n_cat)
+    if _posicoes_atingidas is None:
+        return total, np.zeros(n_cat, dtype=np.int64)
+    atingida = np.zeros(len(cod), dtype=bool)
+    atingida[np.asarray(_posicoes_atingidas, dtype=np.int64)] = True
+    return total, np.bincount(cod[mask & atingida], minlength=n_cat)
+
+def _materializar(gdf: gpd.GeoDataFrame | None, mask: np.ndarray | None):
+    """Linhas da camada sob a máscara; sem filtro efetivo devolve a própria camada (sem cópia)."""
+    if gdf is None or mask is None or mask.all():
+        return gdf
+    return gdf[mask]
+
+CAMADAS_FILTRAVEIS = {
+    "Empresas":         empresas_gdf,
+    "Saúde":            saude_gdf,
+    "Prédios Públicos": predios_publicos_gdf,
+    "Segurança":        seguranca_gdf,
+    "Educação":         educacao_gdf,
+}
+indices_filtro = {nome: indice_invertido(nome, _assinatura_camada(nome, gdf), gdf, FILTROS_CATEGORICOS[nome])
+                  for nome, gdf in CAMADAS_FILTRAVEIS.items() if gdf is not None and len(gdf) > 0}
+
 # ========= Sidebar =========
 st.sidebar.image(gpea_logo_path, use_container_width=True)
 
@@ -422,28 +682,68 @@ for _k in ("ck_empresas","ck_saude","ck_educacao","ck_predios","ck_seguranca"):
     if _k not in st.session_state:
         st.session_state[_k] = False
 
+# ---- Aplicação em lote: Cenários + Filtros num único formulário (uma reexecução por lote) ----
+modo_lote = st.sidebar.toggle(
+    "Aplicar filtros em lote", value=False, key="modo_lote",
+    help="Agrupa Cenários e Filtros num formulário: as mudanças só valem ao clicar em 'Aplicar'."
+)
+form_sidebar = st.sidebar.form("form_filtros", border=False) if modo_lote else st.sidebar.container()
+
 # ---- Cenários ----
-st.sidebar.header("Cenários")
-opcoes_manchas = {
-    "Maio de 2024":        mancha_mai2024_gdf,
-    "Maio de 2024 +60CM":  mancha_mai2024_plus60_gdf,
-    "Setembro de 2023":    mancha_set2023_gdf,
-}
+form_sidebar.header("Cenários")
+opcoes_manchas = dict(cenarios_arquivo)   # {rótulo: caminho do CEN_*.shp}
+
+# ---- Área desenhada no mapa (cenário temporário) ----
+CENARIO_DESENHADO = "Área Desenhada"
+if st.session_state.get("mancha_desenhada") is not None:
+    opcoes_manchas[CENARIO_DESENHADO] = None
+    if st.session_state.pop("selecionar_desenho", False):
+        st.session_state["cenario"] = CENARIO_DESENHADO
+if st.session_state.get("cenario") is not None and st.session_state["cenario"] not in opcoes_manchas:
+    st.session_state["cenario"] = None
+
+def _descartar_desenho():
+    st.session_state["mancha_desenhada"] = None
+    st.session_state["cenario"] = None
+
 lista_opcoes = list(opcoes_manchas.keys())
-selecao_mancha_nome = st.sidebar.selectbox(
-    "Selecione o Cenário:", options=lista_opcoes, index=None,
+selecao_mancha_nome = form_sidebar.selectbox(
+    "Selecione o Cenário:", options=lista_opcoes, index=None, key="cenario",
     placeholder="Escolha uma mancha",
-    help="Selecione uma mancha para habilitar os filtros de 'Atingidos'."
+    help="Selecione uma mancha para habilitar os filtros de 'Atingidos'. "
+         "Desenhe um polígono no mapa para criar o cenário 'Área Desenhada'."
 )
-mancha_selecionada_gdf = opcoes_manchas.get(selecao_mancha_nome) if selecao_mancha_nome else None
+if CENARIO_DESENHADO in opcoes_manchas:
+    # botões comuns não podem ficar dentro de formulários: no modo lote vai para baixo do "Aplicar"
+    (st.sidebar if modo_lote else form_sidebar).button("Descartar área desenhada", on_click=_descartar_desenho)
+if selecao_mancha_nome == CENARIO_DESENHADO:
+    mancha_selecionada_gdf = gpd.GeoDataFrame.from_features([st.session_state["mancha_desenhada"]], crs="EPSG:4326")
+elif selecao_mancha_nome:
+    mancha_selecionada_gdf = carregar_shapefile(opcoes_manchas[selecao_mancha_nome])
+else:
+    mancha_selecionada_gdf = None
 modo_atingidos = mancha_selecionada_gdf is not None
 
+# Chave do cenário p/ caches: a área desenhada muda de geometria mantendo o mesmo nome
+if selecao_mancha_nome == CENARIO_DESENHADO:
+    cenario_chave = (CENARIO_DESENHADO, mancha_selecionada_gdf.geometry.iloc[0].wkb_hex)
+else:
+    cenario_chave = selecao_mancha_nome
+
 if modo_atingidos:
-    st.sidebar.markdown("**Exibir Camadas Atingidas**")
+    form_sidebar.markdown("**Exibir Camadas Atingidas**")
     opcoes_camadas = ["Empresas", "Saúde", "Educação", "Ruas", "Terrenos", "Quadras", "Imóveis", "Prédios Públicos", "Segurança"]
-    selecionadas = st.sidebar.multiselect("Selecione as camadas", opcoes_camadas, default=[])
+    selecionadas = form_sidebar.multiselect("Selecione as camadas", opcoes_camadas, default=[])
+    modo_evacuacao = form_sidebar.checkbox(
+        "Modo Evacuação (escolas como abrigo)", value=False,
+        help="Aloca os imóveis atingidos nas escolas fora da mancha, respeitando a capacidade (matrículas)."
+    )
+    pessoas_por_imovel = (form_sidebar.number_input("Pessoas por imóvel", min_value=1.0, max_value=10.0, value=3.0, step=0.5)
+                          if modo_evacuacao else 3.0)
 else:
     selecionadas = []
+    modo_evacuacao = False
+    pessoas_por_imovel = 3.0
 
 # ---- Sincroniza seleção de Atingidos -> Controle de Camadas ----
 _map_atg_to_ck = {
@@ -458,97 +758,9 @@ for _nome, _ck in _map_atg_to_ck.items():
         st.session_state[_ck] = True
 
 # ---- Filtros ----
-st.sidebar.header("Filtros")
-
-# === Filtros: Empresas ===
-empresas_filtradas = empresas_gdf
-if empresas_gdf is not None:
-    setores_opcoes = sorted(empresas_gdf['Seção'].dropna().unique()) if ('Seção' in empresas_gdf.columns) else []
-    setor_selecionado = st.sidebar.multiselect(
-        "Setor (Empresas)", options=setores_opcoes, default=[],
-        help="Selecione um Setor para habilitar os filtros de 'Subsetor'."
-    )
-    if setor_selecionado and 'Seção' in empresas_gdf.columns:
-        empresas_filtradas = empresas_gdf[empresas_gdf['Seção'].isin(setor_selecionado)].copy()
-    else:
-        empresas_filtradas = empresas_gdf.copy()
-
-    subsetores_opcoes = []
-    subsetor_selecionado = []
-    if setor_selecionado and 'Denominação' in empresas_filtradas.columns:
-        subsetores_opcoes = sorted(empresas_filtradas['Denominação'].dropna().unique())
-        subsetor_selecionado = st.sidebar.multiselect("Subsetor (Empresas)", options=subsetores_opcoes, default=[])
-        if subsetor_selecionado:
-            empresas_filtradas = empresas_filtradas[empresas_filtradas['Denominação'].isin(subsetor_selecionado)]
-
-    st.sidebar.markdown("Situação Cadastral (Empresas)")
-    c1_sc, c2_sc = st.sidebar.columns(2)
-    chk_ativa   = c1_sc.checkbox("Ativa", value=True)
-    chk_baixada = c2_sc.checkbox("Baixada", value=False)
-    if 'situacao_cadastral_desc' in empresas_filtradas.columns:
-        if chk_ativa or chk_baixada:
-            selecao_situacao = []
-            if chk_ativa:   selecao_situacao.append("Ativa")
-            if chk_baixada: selecao_situacao.append("Baixada")
-            empresas_filtradas = empresas_filtradas[empresas_filtradas['situacao_cadastral_desc'].isin(selecao_situacao)]
-
-# === Filtros: Saúde ===
-saude_filtrada = saude_gdf
-if saude_gdf is not None:
-    tipos_opcoes = sorted(saude_gdf['CO_TIPO_ESTABELECIMENTO'].dropna().astype(str).unique()) if 'CO_TIPO_ESTABELECIMENTO' in saude_gdf.columns else []
-    tipos_sel = st.sidebar.multiselect("Tipo do Estabelecimento (Saúde)", options=tipos_opcoes, default=[])
-    if tipos_sel:
-        saude_filtrada = saude_gdf[saude_gdf['CO_TIPO_ESTABELECIMENTO'].astype(str).isin(tipos_sel)].copy()
-    else:
-        saude_filtrada = saude_gdf.copy()
-
-# === Filtros: Prédios Públicos ===
-predios_filtrados = predios_publicos_gdf
-if predios_publicos_gdf is not None:
-    col_tipo = 'Tipo' if 'Tipo' in predios_publicos_gdf.columns else None
-    if col_tipo:
-        tipos_pp = sorted(predios_publicos_gdf[col_tipo].dropna().astype(str).unique())
-        tipos_pp_sel = st.sidebar.multiselect("Tipo (Prédios Públicos)", options=tipos_pp, default=[])
-        if tipos_pp_sel:
-            predios_filtrados = predios_publicos_gdf[predios_publicos_gdf[col_tipo].astype(str).isin(tipos_pp_sel)].copy()
-        else:
-            predios_filtrados = predios_publicos_gdf.copy()
-
-# === Filtros: Segurança ===
-seguranca_filtrada = seguranca_gdf
-if seguranca_gdf is not None:
-    col_tipo_s = 'Tipo' if 'Tipo' in seguranca_gdf.columns else None
-    if col_tipo_s:
-        tipos_s = sorted(seguranca_gdf[col_tipo_s].dropna().astype(str).unique())
-        tipos_s_sel = st.sidebar.multiselect("Tipo (Segurança)", options=tipos_s, default=[])
-        if tipos_s_sel:
-            seguranca_filtrada = seguranca_gdf[seguranca_gdf[col_tipo_s].astype(str).isin(tipos_s_sel)].copy()
-        else:
-            seguranca_filtrada = seguranca_gdf.copy()
-
-# === Filtros: Educação (Dependência) ===
-educacao_filtrada = educacao_gdf
-if educacao_gdf is not None:
-    dep_opcoes = sorted(educacao_gdf["DEP_LABEL"].dropna().unique())
-    dep_sel = st.sidebar.multiselect(
-        "Dependência (Educação)", options=dep_opcoes, default=[],
-        help="Filtra escolas por dependência administrativa (Federal/Estadual/Municipal/Privada)."
-    )
-    if dep_sel:
-        educacao_filtrada = educacao_gdf[educacao_gdf["DEP_LABEL"].isin(dep_sel)].copy()
-    else:
-        educacao_filtrada = educacao_gdf.copy()
-
-# ---- Controle de Camadas ----
-st.sidebar.header("Controle de Camadas")
-c3_sc, c4_sc = st.sidebar.columns(2)
-mostrar_empresas  = c3_sc.checkbox("Empresas", key="ck_empresas")
-mostrar_saude     = c4_sc.checkbox("Saúde", key="ck_saude")
-c5_sc, c6_sc = st.sidebar.columns(2)
-mostrar_educacao  = c5_sc.checkbox("Educação", key="ck_educacao")
-mostrar_predios   = c6_sc.checkbox("Prédios Públicos", key="ck_predios")
-c7_sc, c8_sc = st.sidebar.columns(2)
-mostrar_seguranca = c7_sc.checkbox("Segurança", key="ck_seguranca")
+# Os widgets são preenchidos depois do cálculo do cenário, para exibir as contagens de atingidos nas opções
+form_sidebar.header("Filtros")
+filtros_sidebar = form_sidebar.container()
 
 # ---- Flags das camadas atingidas ----
 mostrar_empresas_atingidas  = ("Empresas" in selecionadas) and modo_atingidos
@@ -602,594 +814,1128 @@ def _clean_mancha(gdf):
     except Exception:
         return None
 
-def _sjoin_points_with_fallback(points_gdf, poly_gdf):
-    if points_gdf is None or poly_gdf is None or len(points_gdf) == 0 or len(poly_gdf) == 0:
+def _to_point_gdf(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    if gdf is None or gdf.empty:
+        return gdf
+    geom = gdf.geometry
+    pts = geom if geom.iloc[0].geom_type == "Point" else geom.representative_point()
+    return gpd.GeoDataFrame(gdf.drop(columns="geometry"), geometry=pts, crs=gdf.crs)
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def _indice_espacial(nome_camada: str, assinatura, _gdf: gpd.GeoDataFrame, pontos: bool):
+    """
+    Camada completa em EPSG:4326 + STRtree, construídos uma vez por camada e compartilhados
+    entre reruns/sessões. 'assinatura' (tamanho + extensão) invalida o índice se a fonte mudar.
+    """
+    g = _to_point_gdf(_gdf) if pontos else _gdf
+    g = g.to_crs("EPSG:4326")
+    return g, shapely.STRtree(g.geometry.values)
+
+def _posicoes_atingidas(nome_camada, base_gdf, geom, pontos: bool) -> np.ndarray:
+    """
+    Posições (iloc) de base_gdf atingidas por geom, via índice pré-construído da camada:
+    só os candidatos do bbox passam pelo predicado. Pontos: 'within' com fallback para
+    'intersects' (como o sjoin original); linhas/polígonos: 'intersects'.
+    """
+    _, arvore = _indice_espacial(nome_camada, _assinatura_camada(nome_camada, base_gdf), base_gdf, pontos)
+    pos = arvore.query(geom, predicate="contains" if pontos else "intersects")
+    if pontos and len(pos) == 0:
+        pos = arvore.query(geom, predicate="intersects")
+    return np.sort(pos)
+
+def _atingidos_indexados(nome_camada, base_gdf, poly_gdf, pontos: bool, membros: dict | None = None,
+                         mascara: np.ndarray | None = None):
+    """
+    Feições de base_gdf (restritas à máscara de filtros, se houver) atingidas pela mancha, no mesmo
+    formato do sjoin (EPSG:4326, coluna index_right). Usa as posições pré-calculadas do cenário quando
+    existirem ('membros'); senão consulta o índice espacial (ex.: área desenhada).
+    """
+    if base_gdf is None or poly_gdf is None or len(base_gdf) == 0 or len(poly_gdf) == 0:
+        return None
+    if mascara is not None and not mascara.any():
         return None
     try:
-        p4326 = points_gdf.to_crs("EPSG:4326")
-        res = gpd.sjoin(p4326, poly_gdf, how="inner", predicate="within")
-        if res is not None and len(res) > 0:
-            return res
-        res2 = gpd.sjoin(p4326, poly_gdf, how="inner", predicate="intersects")
-        return res2 if res2 is not None and len(res2) > 0 else res
+        if membros is not None and nome_camada in membros:
+            pos = membros[nome_camada]
+        else:
+            pos = _posicoes_atingidas(nome_camada, base_gdf, poly_gdf.geometry.iloc[0], pontos)
+        base4326, _ = _indice_espacial(nome_camada, _assinatura_camada(nome_camada, base_gdf), base_gdf, pontos)
+        pos = np.asarray(pos, dtype=np.int64)
+        if mascara is not None:
+            pos = pos[mascara[pos]]
+        res = base4326.iloc[pos].copy()
+        res["index_right"] = 0
+        return res
     except Exception:
-        try:
-            p4326 = points_gdf.to_crs("EPSG:4326")
-            return gpd.sjoin(p4326, poly_gdf, how="inner", predicate="intersects")
-        except Exception:
-            return None
-
-def _sjoin_lines_or_polys(layer_gdf, poly_gdf):
-    if layer_gdf is None or poly_gdf is None or len(layer_gdf) == 0 or len(poly_gdf) == 0:
         return None
+
+# ---- Cenários pré-calculados (mancha limpa + pertinência por camada, persistidos em disco) ----
+PASTA_CACHE_CENARIOS = os.path.join(pasta_dados, ".cache_cenarios")
+
+CAMADAS_BASE = {   # nome -> (camada completa, é camada de pontos?)
+    "Empresas":         (empresas_gdf, True),
+    "Saúde":            (saude_gdf, True),
+    "Educação":         (educacao_gdf, True),
+    "Ruas":             (logradouros_gdf, False),
+    "Terrenos":         (terrenos_gdf, False),
+    "Quadras":          (quadras_gdf, False),
+    "Imóveis":          (imoveis_gdf, True),
+    "Prédios Públicos": (predios_publicos_gdf, True),
+    "Segurança":        (seguranca_gdf, True),
+}
+assinaturas_camadas = tuple(sorted((nome, _assinatura_camada(nome, g)) for nome, (g, _) in CAMADAS_BASE.items() if g is not None))
+
+@st.cache_resource(show_spinner=False)
+def preparar_cenario(caminho: str, mtime: float, assinaturas: tuple, _camadas: dict) -> dict | None:
+    """
+    Calcula uma única vez por arquivo de mancha (e por versão das camadas):
+      - a mancha limpa (buffer(0) + união) em EPSG:4326;
+      - 'membros': posições de cada camada base dentro da mancha.
+    O resultado é persistido em Dados/.cache_cenarios/<CEN_*>.pkl e reaproveitado entre
+    execuções enquanto o mtime do .shp e as assinaturas das camadas (inclusive dos arquivos de origem) não mudarem.
+    """
+    arq_cache = os.path.join(PASTA_CACHE_CENARIOS, os.path.splitext(os.path.basename(caminho))[0] + ".pkl")
     try:
-        l4326 = layer_gdf.to_crs("EPSG:4326")
-        return gpd.sjoin(l4326, poly_gdf, how="inner", predicate="intersects")
+        with open(arq_cache, "rb") as f:
+            salvo = pickle.load(f)
+        if salvo["mtime"] == mtime and salvo["assinaturas"] == assinaturas:
+            mancha = gpd.GeoDataFrame(geometry=[shapely.from_wkb(salvo["mancha_wkb"])], crs="EPSG:4326")
+            return {"mancha": mancha, "membros": salvo["membros"]}
     except Exception:
+        pass
+
+    mancha = _clean_mancha(carregar_shapefile(caminho))
+    if mancha is None:
         return None
+    geom = mancha.geometry.iloc[0]
+    membros = {nome: _posicoes_atingidas(nome, gdf, geom, pontos)
+               for nome, (gdf, pontos) in _camadas.items() if gdf is not None and len(gdf) > 0}
+    try:
+        os.makedirs(PASTA_CACHE_CENARIOS, exist_ok=True)
+        with open(arq_cache, "wb") as f:
+            pickle.dump({"mtime": mtime, "assinaturas": assinaturas,
+                         "mancha_wkb": shapely.to_wkb(geom), "membros": membros}, f)
+    except Exception:
+        pass
+    return {"mancha": mancha, "membros": membros}
+
+with st.spinner("Preparando cenários..."):
+    cenarios_preparados = {
+        nome: preparar_cenario(caminho, os.path.getmtime(caminho), assinaturas_camadas, CAMADAS_BASE)
+        for nome, caminho in cenarios_arquivo.items()
+    }
+
+cenario_pre = cenarios_preparados.get(selecao_mancha_nome) if modo_atingidos else None
+membros_cenario = cenario_pre["membros"] if cenario_pre is not None else None
+if cenario_pre is not None:
+    mancha_4326 = cenario_pre["mancha"]
+else:
+    mancha_4326 = _clean_mancha(mancha_selecionada_gdf) if mancha_selecionada_gdf is not None else None
+
+# Posições atingidas por camada no cenário atual (pré-calculadas p/ CEN_*.shp; área desenhada via índice)
+if membros_cenario is not None:
+    membros_atuais = membros_cenario
+elif mancha_4326 is not None:
+    membros_atuais = {nome: _posicoes_atingidas(nome, gdf, mancha_4326.geometry.iloc[0], pontos)
+                      for nome, (gdf, pontos) in CAMADAS_BASE.items() if gdf is not None and len(gdf) > 0}
+else:
+    membros_atuais = None
+
+# ========= Filtros (sidebar) com contagens por opção =========
+def _chave_filtros(filtros: dict | None) -> tuple:
+    """Seleções {coluna: [valores]} como tupla ordenada e hashable (chave de cache); colunas sem seleção saem."""
+    return tuple(sorted((c, tuple(map(str, v))) for c, v in (filtros or {}).items() if v))
+
+def _rotulo_faceta(nome_camada: str, coluna: str, outros_filtros: dict | None = None):
+    """format_func das opções: 'valor (total)' ou, com cenário, 'valor (atingidos/total)'."""
+    indice = indices_filtro[nome_camada]
+    filtros_outros = _chave_filtros(outros_filtros)
+    total, atg = contagens_faceta(nome_camada, dict(assinaturas_camadas).get(nome_camada), cenario_chave if modo_atingidos else None,
+                                  coluna, filtros_outros, indice, (membros_atuais or {}).get(nome_camada))
+    pos = indice[coluna]["posicao"]
+    if modo_atingidos:
+        return lambda v: f"{v} ({compacto_br(atg[pos[v]])}/{compacto_br(total[pos[v]])})" if v in pos else str(v)
+    return lambda v: f"{v} ({compacto_br(total[pos[v]])})" if v in pos else str(v)
+
+# Seleções ativas por camada: {camada: {coluna: [valores]}} (lista vazia = sem filtro)
+filtros_ativos = {}
+
+# === Filtros: Empresas ===
+if "Empresas" in indices_filtro:
+    idx_emp = indices_filtro["Empresas"]
+    setores_opcoes = idx_emp["Seção"]["categorias"] if "Seção" in idx_emp else []
+    # Situação lida do estado antes dos checkboxes (abaixo) para entrar nas contagens de Setor/Subsetor
+    selecao_situacao = ((["Ativa"] if st.session_state.get("emp_ativa", True) else [])
+                        + (["Baixada"] if st.session_state.get("emp_baixada", False) else []))
+    filtro_situacao = {"situacao_cadastral_desc": selecao_situacao}
+    setor_selecionado = filtros_sidebar.multiselect(
+        "Setor (Empresas)", options=setores_opcoes, default=[],
+        format_func=_rotulo_faceta("Empresas", "Seção", filtro_situacao),
+        help="Selecione um Setor para habilitar os filtros de 'Subsetor'."
+    )
 
-mancha_4326 = _clean_mancha(mancha_selecionada_gdf) if mancha_selecionada_gdf is not None else None
+    subsetor_selecionado = []
+    if setor_selecionado and "filhos" in idx_emp.get("Seção", {}):
+        subsetores_opcoes = sorted({d for sec in setor_selecionado for d in idx_emp["Seção"]["filhos"].get(sec, [])})
+        subsetor_selecionado = filtros_sidebar.multiselect(
+            "Subsetor (Empresas)", options=subsetores_opcoes, default=[],
+            format_func=_rotulo_faceta("Empresas", "Denominação", {"Seção": setor_selecionado, **filtro_situacao}))
+
+    filtros_sidebar.markdown("Situação Cadastral (Empresas)")
+    c1_sc, c2_sc = filtros_sidebar.columns(2)
+    c1_sc.checkbox("Ativa", value=True, key="emp_ativa")
+    c2_sc.checkbox("Baixada", value=False, key="emp_baixada")
+    filtros_ativos["Empresas"] = {"Seção": list(setor_selecionado), "Denominação": list(subsetor_selecionado)}
+    if "situacao_cadastral_desc" in idx_emp and selecao_situacao:
+        filtros_ativos["Empresas"]["situacao_cadastral_desc"] = selecao_situacao
+
+# === Filtros: Saúde ===
+if "CO_TIPO_ESTABELECIMENTO" in indices_filtro.get("Saúde", {}):
+    tipos_opcoes = indices_filtro["Saúde"]["CO_TIPO_ESTABELECIMENTO"]["categorias"]
+    tipos_sel = filtros_sidebar.multiselect("Tipo do Estabelecimento (Saúde)", options=tipos_opcoes, default=[],
+                                            format_func=_rotulo_faceta("Saúde", "CO_TIPO_ESTABELECIMENTO"))
+    filtros_ativos["Saúde"] = {"CO_TIPO_ESTABELECIMENTO": list(tipos_sel)}
+
+# === Filtros: Prédios Públicos ===
+if "Tipo" in indices_filtro.get("Prédios Públicos", {}):
+    tipos_pp = indices_filtro["Prédios Públicos"]["Tipo"]["categorias"]
+    tipos_pp_sel = filtros_sidebar.multiselect("Tipo (Prédios Públicos)", options=tipos_pp, default=[],
+                                               format_func=_rotulo_faceta("Prédios Públicos", "Tipo"))
+    filtros_ativos["Prédios Públicos"] = {"Tipo": list(tipos_pp_sel)}
+
+# === Filtros: Segurança ===
+if "Tipo" in indices_filtro.get("Segurança", {}):
+    tipos_s = indices_filtro["Segurança"]["Tipo"]["categorias"]
+    tipos_s_sel = filtros_sidebar.multiselect("Tipo (Segurança)", options=tipos_s, default=[],
+                                              format_func=_rotulo_faceta("Segurança", "Tipo"))
+    filtros_ativos["Segurança"] = {"Tipo": list(tipos_s_sel)}
+
+# === Filtros: Educação (Dependência) ===
+if "DEP_LABEL" in indices_filtro.get("Educação", {}):
+    dep_opcoes = indices_filtro["Educação"]["DEP_LABEL"]["categorias"]
+    dep_sel = filtros_sidebar.multiselect(
+        "Dependência (Educação)", options=dep_opcoes, default=[],
+        format_func=_rotulo_faceta("Educação", "DEP_LABEL"),
+        help="Filtra escolas por dependência administrativa (Federal/Estadual/Municipal/Privada)."
+    )
+    filtros_ativos["Educação"] = {"DEP_LABEL": list(dep_sel)}
+
+if modo_lote:
+    form_sidebar.form_submit_button("Aplicar", type="primary", use_container_width=True)
+
+# Máscaras por camada; as linhas só são materializadas onde tabela/mapa/análises precisam delas
+mascaras_filtro = {nome: _mascara(indice, len(CAMADAS_FILTRAVEIS[nome]), filtros_ativos.get(nome))
+                   for nome, indice in indices_filtro.items()}
+empresas_filtradas = _materializar(empresas_gdf, mascaras_filtro.get("Empresas"))
+saude_filtrada     = _materializar(saude_gdf, mascaras_filtro.get("Saúde"))
+predios_filtrados  = _materializar(predios_publicos_gdf, mascaras_filtro.get("Prédios Públicos"))
+seguranca_filtrada = _materializar(seguranca_gdf, mascaras_filtro.get("Segurança"))
+educacao_filtrada  = _materializar(educacao_gdf, mascaras_filtro.get("Educação"))
 
 # Empresas x mancha
-empresas_atingidas_gdf = _sjoin_points_with_fallback(empresas_filtradas, mancha_4326) if (empresas_filtradas is not None and mancha_4326 is not None) else None
+empresas_atingidas_gdf = _atingidos_indexados("Empresas", empresas_gdf, mancha_4326, pontos=True, membros=membros_atuais, mascara=mascaras_filtro.get("Empresas"))
 # Saúde x mancha
-saude_atingida_gdf = _sjoin_points_with_fallback(saude_filtrada, mancha_4326) if (saude_filtrada is not None and mancha_4326 is not None) else None
+saude_atingida_gdf = _atingidos_indexados("Saúde", saude_gdf, mancha_4326, pontos=True, membros=membros_atuais, mascara=mascaras_filtro.get("Saúde"))
 # Ruas x mancha
-if logradouros_gdf is not None:
-    logradouros_gdf = logradouros_gdf.copy()
-    if {'tipo','nome'}.issubset(logradouros_gdf.columns):
-        logradouros_gdf['tipo'] = logradouros_gdf['tipo'].fillna('')
-        logradouros_gdf['nome'] = logradouros_gdf['nome'].fillna('')
-        logradouros_gdf['_rua_id_interno'] = (logradouros_gdf['tipo'].astype(str).str.strip() + ' ' +
-                                              logradouros_gdf['nome'].astype(str).str.strip()).str.strip()
-    else:
-        logradouros_gdf['_rua_id_interno'] = logradouros_gdf.index.astype(str)
-logradouros_atingidos_gdf = _sjoin_lines_or_polys(logradouros_gdf, mancha_4326) if (logradouros_gdf is not None and mancha_4326 is not None) else None
+logradouros_atingidos_gdf = _atingidos_indexados("Ruas", logradouros_gdf, mancha_4326, pontos=False, membros=membros_atuais)
 # Terrenos x mancha
 total_terrenos = len(terrenos_gdf) if terrenos_gdf is not None else 0
-terrenos_atingidos_gdf = _sjoin_lines_or_polys(terrenos_gdf, mancha_4326) if (terrenos_gdf is not None and mancha_4326 is not None) else None
+terrenos_atingidos_gdf = _atingidos_indexados("Terrenos", terrenos_gdf, mancha_4326, pontos=False, membros=membros_atuais)
 # Quadras x mancha
 total_quadras = len(quadras_gdf) if quadras_gdf is not None else 0
-quadras_atingidas_gdf = _sjoin_lines_or_polys(quadras_gdf, mancha_4326) if (quadras_gdf is not None and mancha_4326 is not None) else None
+quadras_atingidas_gdf = _atingidos_indexados("Quadras", quadras_gdf, mancha_4326, pontos=False, membros=membros_atuais)
 # Imóveis x mancha
-def _to_point_gdf(gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
-    if gdf is None or gdf.empty:
-        return gdf
-    geom = gdf.geometry
-    pts = geom if geom.iloc[0].geom_type == "Point" else geom.representative_point()
-    return gpd.GeoDataFrame(gdf.drop(columns="geometry"), geometry=pts, crs=gdf.crs)
-imoveis_atingidos_gdf = None
 total_imoveis = len(imoveis_gdf) if imoveis_gdf is not None else 0
-if (imoveis_gdf is not None) and (mancha_4326 is not None):
-    imoveis_pts = _to_point_gdf(imoveis_gdf)
-    imoveis_atingidos_gdf = _sjoin_points_with_fallback(imoveis_pts, mancha_4326)
+imoveis_atingidos_gdf = _atingidos_indexados("Imóveis", imoveis_gdf, mancha_4326, pontos=True, membros=membros_atuais)
 # Prédios Públicos x mancha
-predios_atingidos_gdf = _sjoin_points_with_fallback(predios_filtrados, mancha_4326) if (predios_filtrados is not None and mancha_4326 is not None) else None
+predios_atingidos_gdf = _atingidos_indexados("Prédios Públicos", predios_publicos_gdf, mancha_4326, pontos=True, membros=membros_atuais, mascara=mascaras_filtro.get("Prédios Públicos"))
 # Segurança x mancha
-seguranca_atingida_gdf = _sjoin_points_with_fallback(seguranca_filtrada, mancha_4326) if (seguranca_filtrada is not None and mancha_4326 is not None) else None
+seguranca_atingida_gdf = _atingidos_indexados("Segurança", seguranca_gdf, mancha_4326, pontos=True, membros=membros_atuais, mascara=mascaras_filtro.get("Segurança"))
 # Educação x mancha
-educacao_atingida_gdf = _sjoin_points_with_fallback(educacao_filtrada, mancha_4326) if (educacao_filtrada is not None and mancha_4326 is not None) else None
+educacao_atingida_gdf = _atingidos_indexados("Educação", educacao_gdf, mancha_4326, pontos=True, membros=membros_atuais, mascara=mascaras_filtro.get("Educação"))
+
+# ========= Cubo de impacto pré-agregado =========
+# camada -> (dimensões de filtro/categoria, medidas somáveis). '_n' (contagem) entra sempre;
+# '_n_<col>' conta os valores não nulos de <col> (denominador de médias, ex.: MédiaSalarial).
+CUBO_SPEC = {
+    "Empresas":         (["Seção", "Denominação", "situacao_cadastral_desc"],
+                         ["Empregados", "Massa_Salarial", "MédiaSalarial", "_n_MédiaSalarial"]),
+    "Saúde":            (["CO_TIPO_ESTABELECIMENTO"], []),
+    "Educação":         (["DEP_LABEL"], ["QT_FUNCIONARIOS"] + COLS_MAT_NIVEIS),
+    "Prédios Públicos": (["Tipo"], []),
+    "Segurança":        (["Tipo"], []),
+    "Terrenos":         ([], list(FLAGS_TERRENOS)),
+    "Quadras":          ([], []),
+    "Imóveis":          (["_uso_cat", "_patrim_cat"], ["_f_condom"]),
+}
 
-# ====== PAINEL DE IMPACTO ======
-with st.expander("📊 Painel de Impacto", expanded=False):
-
-    def mini_card(col, titulo, valor, delta=None, icon="📊", accent="blue"):
-        delta_html = f'<div class="mini-delta">{delta}</div>' if delta else ''
-        col.markdown(
-            f"""
-            <div class="mini-card">
-              <div class="accent {accent}"></div>
-              <div class="mini-wrap">
-                <div class="mini-label">{titulo}</div>
-                <div class="mini-top">
-                  <span class="mini-icon">{icon}</span>
-                  <span class="mini-value">{valor}</span>
-                </div>
-                {delta_html}
-              </div>
-            </div>
-            """,
-            unsafe_allow_html=True
-        )
+NAO_INFORMADO = "Não informado"   # categoria das linhas sem valor numa dimensão do cubo
+
+def _cubo_camada(gdf: gpd.GeoDataFrame, posicoes_atingidas, dims: list[str], medidas: list[str]) -> pd.DataFrame:
+    dims = [d for d in dims if d in gdf.columns]
+    # ausentes viram NAO_INFORMADO antes do texto: o groupby descartaria NaN e o cubo contaria menos que a camada
+    df = pd.DataFrame({d: gdf[d].astype(object).where(gdf[d].notna(), NAO_INFORMADO).astype(str).to_numpy() for d in dims},
+                      index=pd.RangeIndex(len(gdf)))
+    df["_n"] = 1
+    for m in medidas:
+        if m.startswith("_n_"):
+            df[m] = gdf[m[3:]].notna().to_numpy() if m[3:] in gdf.columns else 0
+        else:
+            df[m] = pd.to_numeric(gdf[m], errors="coerce").fillna(0).to_numpy() if m in gdf.columns else 0
+    atg = np.zeros(len(gdf), dtype=bool)
+    if posicoes_atingidas is not None:
+        atg[posicoes_atingidas] = True
+    df["_atg"] = atg
+    return df.groupby(dims + ["_atg"], sort=False).sum(numeric_only=True).reset_index()
 
-    st.subheader(f"Impacto: {selecao_mancha_nome}" if modo_atingidos else "Impacto")
-
-    # ---------- EMPRESAS ----------
-    total_empresas = len(empresas_filtradas) if empresas_filtradas is not None else 0
-    total_empregados = (empresas_filtradas['Empregados'].sum()
-                        if (empresas_filtradas is not None and 'Empregados' in empresas_filtradas.columns) else 0)
-    total_massa_salarial = (empresas_filtradas['Massa_Salarial'].sum()
-                            if (empresas_filtradas is not None and 'Massa_Salarial' in empresas_filtradas.columns) else 0)
-    media_salarial_geral = (empresas_filtradas['MédiaSalarial'].mean()
-                            if (empresas_filtradas is not None and 'MédiaSalarial' in empresas_filtradas.columns) else 0)
-
-    if modo_atingidos and (empresas_atingidas_gdf is not None) and (not empresas_atingidas_gdf.empty):
-        ating_empresas = len(empresas_atingidas_gdf)
-        ating_empregados = int(empresas_atingidas_gdf['Empregados'].sum() or 0) if 'Empregados' in empresas_atingidas_gdf.columns else 0
-        ating_massa = float(empresas_atingidas_gdf['Massa_Salarial'].sum() or 0) if 'Massa_Salarial' in empresas_atingidas_gdf.columns else 0.0
-        media_salarial_atingida = float(empresas_atingidas_gdf['MédiaSalarial'].mean() or 0) if 'MédiaSalarial' in empresas_atingidas_gdf.columns else 0.0
-    else:
-        ating_empresas = ating_empregados = 0
-        ating_massa = media_salarial_atingida = 0.0
-
-    perc_empresas   = (ating_empresas   / total_empresas * 100)       if total_empresas       > 0 else 0
-    perc_empregados = (ating_empregados / total_empregados * 100)     if total_empregados     > 0 else 0
-    perc_massa      = (ating_massa      / total_massa_salarial * 100) if total_massa_salarial > 0 else 0
-
-    st.markdown('<div class="painel-sec-titulo">Empresas</div>', unsafe_allow_html=True)
-    c1, c2, c3, c4 = st.columns(4)
-    if mostrar_empresas_atingidas:
-        mini_card(c1, "Empresas Atingidas", compacto_br(ating_empresas),
-                  f"de {compacto_br(total_empresas)} ({pct_int(perc_empresas)})", icon="🏢", accent="blue")
-        mini_card(c2, "Empregados Atingidos", compacto_br(ating_empregados),
-                  f"de {compacto_br(total_empregados)} ({pct_int(perc_empregados)})", icon="👥", accent="blue")
-        mini_card(c3, "Massa Salarial Atingida", moeda_compacta(ating_massa),
-                  f"de {moeda_compacta(total_massa_salarial)} ({pct_int(perc_massa)})", icon="💰", accent="blue")
-        mini_card(c4, "Média Salarial (Atingidos)", moeda_compacta(media_salarial_atingida),
-                  f"de {formatar_br(media_salarial_geral)} no Total", icon="📈", accent="blue")
+@st.cache_data(show_spinner=False)
+def construir_cubo(chave_cenario, assinaturas: tuple, _camadas: dict, _membros: dict | None) -> dict:
+    """
+    Agrega cada camada base por (dimensões, atingido) com contagens e medidas somáveis, uma vez
+    por cenário. O painel só fatia este cubo: o custo de renderização não depende do tamanho das camadas.
+    """
+    cubo = {}
+    for nome, (dims, medidas) in CUBO_SPEC.items():
+        gdf = _camadas.get(nome, (None, None))[0]
+        if gdf is None or len(gdf) == 0:
+            continue
+        pos = _membros.get(nome) if _membros is not None else None
+        cubo[nome] = _cubo_camada(gdf, pos, dims, medidas)
+    return cubo
+
+def _fatia(cubo: dict, camada: str, filtros: dict | None = None) -> pd.DataFrame | None:
+    """Linhas do cubo da camada que passam pelos filtros {dimensão: [valores]} (lista vazia = todos)."""
+    df = cubo.get(camada)
+    if df is None:
+        return None
+    return _filtrar_dims(df, filtros)
+
+def _filtrar_dims(df: pd.DataFrame, filtros: dict | None) -> pd.DataFrame:
+    mask = np.ones(len(df), dtype=bool)
+    for dim, sel in (filtros or {}).items():
+        if sel and dim in df.columns:
+            mask &= df[dim].isin([str(v) for v in sel]).to_numpy()
+    return df[mask]
+
+def _total_atingido(fatia: pd.DataFrame | None, medida: str = "_n") -> tuple[float, float]:
+    if fatia is None or len(fatia) == 0 or medida not in fatia.columns:
+        return 0.0, 0.0
+    return float(fatia[medida].sum()), float(fatia.loc[fatia["_atg"], medida].sum())
+
+def _por_categoria(fatia: pd.DataFrame | None, dim: str, medida: str = "_n") -> pd.DataFrame:
+    """Total e atingidos de 'medida' por categoria de 'dim' (colunas: dim, Total, Atingidos)."""
+    if fatia is None or dim not in fatia.columns:
+        return pd.DataFrame(columns=[dim, "Total", "Atingidos"])
+    v = fatia[medida]
+    return (pd.DataFrame({dim: fatia[dim], "Total": v, "Atingidos": v.where(fatia["_atg"], 0)})
+            .groupby(dim, as_index=False, sort=False).sum())
+
+# Rollup CNAE (Seção → Denominação) das Empresas
+ROLLUP_CNAE_MEDIDAS = {"Empresas": "_n", "Empregados": "Empregados", "Massa Salarial": "Massa_Salarial"}
+
+@st.cache_data(show_spinner=False)
+def rollup_cnae(chave_cenario, assinaturas: tuple, _cubo: dict) -> pd.DataFrame | None:
+    """
+    Empresas, empregados e massa salarial por Seção e Denominação, com Total e Atingidos lado a lado.
+    Mantém 'situacao_cadastral_desc' como chave para o filtro de situação continuar valendo;
+    só é refeito quando mudam os dados ou o cenário.
+    """
+    df = _cubo.get("Empresas")
+    if df is None or "Seção" not in df.columns:
+        return None
+    chaves = [c for c in ("Seção", "Denominação", "situacao_cadastral_desc") if c in df.columns]
+    out = df[chaves].copy()
+    for rotulo, medida in ROLLUP_CNAE_MEDIDAS.items():
+        out[f"{rotulo} (Total)"] = df[medida]
+        out[f"{rotulo} (Atingidos)"] = df[medida].where(df["_atg"], 0)
+    return out.groupby(chaves, as_index=False, sort=False).sum()
+
+def _tabela_cnae(rollup: pd.DataFrame, nivel: list[str], rotulo: str, com_atingidos: bool) -> pd.DataFrame:
+    """Agrega o rollup no nível pedido para a medida 'rotulo', ordenado pelo total."""
+    cols = [f"{rotulo} (Total)"] + ([f"{rotulo} (Atingidos)"] if com_atingidos else [])
+    df = rollup.groupby(nivel, as_index=False, sort=False)[cols].sum()
+    df = df[df[cols[0]] > 0]
+    if com_atingidos:
+        df["% atingidos"] = (df[cols[1]] / df[cols[0]] * 100).round(1)
+    for c in cols:
+        df[c] = df[c].round(2) if rotulo == "Massa Salarial" else df[c].astype(int)
+    return df.sort_values(cols[0], ascending=False)
+
+cubo_impacto = construir_cubo(cenario_chave if modo_atingidos else None, assinaturas_camadas, CAMADAS_BASE, membros_atuais)
+
+# ========= Conectividade viária (grafo dos logradouros) =========
+CRS_METRICO = "EPSG:31982"
+
+@st.cache_resource(show_spinner=False)
+def construir_grafo_ruas(assinatura, _gdf: gpd.GeoDataFrame, tol_m: float = 1.0) -> dict | None:
+    """
+    Monta (uma única vez por versão da camada, 'assinatura') o grafo da malha viária a partir de
+    Logradouros_segmentos já carregada (_gdf; 'linha' = posição na camada):
+      - Nós = extremidades dos segmentos em EPSG:31982, unificadas numa grade de tol_m metros.
+      - Arestas = segmentos (MultiLineString vira uma aresta por parte; 'linha' guarda a linha de origem).
+      - Adjacência em scipy.sparse (CSR), componentes da malha sem inundação e cKDTree dos nós
+        para ancorar quadras/escolas/saúde no nó mais próximo.
+    """
+    if _gdf is None or len(_gdf) == 0:
+        return None
+    partes = _gdf.geometry.to_crs(CRS_METRICO).reset_index(drop=True).explode(index_parts=False)
+    partes = partes[partes.notna() & ~partes.is_empty]
+    if len(partes) == 0:
+        return None
+    linha = partes.index.to_numpy()
+    ini = shapely.get_coordinates(shapely.get_point(partes.values, 0))
+    fim = shapely.get_coordinates(shapely.get_point(partes.values, -1))
+
+    chaves = np.round(np.vstack([ini, fim]) / tol_m).astype(np.int64)
+    chaves_unicas, inv = np.unique(chaves, axis=0, return_inverse=True)
+    inv = inv.ravel()
+    n_arestas = len(linha)
+    u, v = inv[:n_arestas], inv[n_arestas:]
+    n_nos = len(chaves_unicas)
+
+    adj = sparse.coo_matrix((np.ones(n_arestas, dtype=np.int8), (u, v)), shape=(n_nos, n_nos)).tocsr()
+    n_comp, rotulos = connected_components(adj, directed=False)
+    return {
+        "u": u, "v": v, "linha": linha, "n_nos": n_nos, "adj": adj,
+        "rotulos_base": rotulos, "n_comp_base": int(n_comp),
+        "arvore": cKDTree(chaves_unicas * tol_m),
+    }
+
+def _nos_mais_proximos(grafo: dict, gdf: gpd.GeoDataFrame | None) -> np.ndarray:
+    """Índice do nó da malha mais próximo de cada feição (pontos ou polígonos, via ponto representativo)."""
+    if grafo is None or gdf is None or len(gdf) == 0:
+        return np.empty(0, dtype=np.int64)
+    pts = _to_point_gdf(gdf).geometry.to_crs(CRS_METRICO)
+    _, idx = grafo["arvore"].query(shapely.get_coordinates(pts.values))
+    return np.asarray(idx, dtype=np.int64)
+
+@st.cache_resource(show_spinner=False)
+def nos_mais_proximos_camada(assinatura_ruas, assinatura, _grafo: dict, _gdf: gpd.GeoDataFrame) -> np.ndarray:
+    """
+    _nos_mais_proximos para a camada base inteira (uma posição por linha), calculado uma vez por versão
+    da malha ('assinatura_ruas') e da camada ('assinatura'); os cenários só consultam os componentes.
+    Somente leitura: o array é compartilhado entre sessões.
+    """
+    return _nos_mais_proximos(_grafo, _gdf)
+
+def _nos_da_camada(grafo, assinatura_ruas, nome_camada, base, mask=None) -> np.ndarray:
+    """Nós das linhas da camada filtrada (base[mask], ver _materializar) a partir do cache da camada base."""
+    if grafo is None or base is None or len(base) == 0:
+        return np.empty(0, dtype=np.int64)
+    nos = nos_mais_proximos_camada(assinatura_ruas, _assinatura_camada(nome_camada, base), grafo, base)
+    return nos if (mask is None or mask.all()) else nos[mask]
+
+def analisar_conectividade(grafo: dict, linhas_alagadas: np.ndarray) -> dict | None:
+    """
+    Remove as arestas alagadas e recalcula os componentes conexos (csgraph).
+    Um nó fica 'isolado' se pertencia ao maior componente da malha original
+    e deixou de pertencer ao maior componente da malha inundada.
+    """
+    if grafo is None:
+        return None
+    manter = ~np.isin(grafo["linha"], linhas_alagadas)
+    n = grafo["n_nos"]
+    u, v = grafo["u"][manter], grafo["v"][manter]
+    adj = sparse.coo_matrix((np.ones(len(u), dtype=np.int8), (u, v)), shape=(n, n)).tocsr()
+    n_comp, rotulos = connected_components(adj, directed=False)
+
+    base = grafo["rotulos_base"]
+    principal_base = np.bincount(base).argmax()
+    principal = np.bincount(rotulos).argmax()
+    isolados = (base == principal_base) & (rotulos != principal)
+    return {
+        "n_componentes": int(n_comp),
+        "n_componentes_base": grafo["n_comp_base"],
+        "nos_isolados": isolados,
+        "arestas_removidas": int((~manter).sum()),
+    }
+
+def _isolados_fora_da_mancha(conect, gdf, nos, atingidos_gdf):
+    """Subconjunto de gdf ancorado em nós isolados ('nos' = nó de cada linha de gdf), excluindo feições já dentro da mancha."""
+    if conect is None or gdf is None or len(gdf) == 0:
+        return None
+    mask = conect["nos_isolados"][nos]
+    if atingidos_gdf is not None and len(atingidos_gdf) > 0:
+        mask &= ~gdf.index.isin(atingidos_gdf.index)
+    return gdf[mask]
+
+assinatura_ruas = _assinatura_camada("Ruas", logradouros_gdf) if (logradouros_gdf is not None) else None
+grafo_ruas = construir_grafo_ruas(assinatura_ruas, logradouros_gdf) if (logradouros_gdf is not None) else None
+conectividade = None
+quadras_isoladas_gdf = escolas_isoladas_gdf = saude_isolada_gdf = None
+if (grafo_ruas is not None) and (mancha_4326 is not None):
+    _linhas_alagadas = (logradouros_gdf.index.get_indexer(logradouros_atingidos_gdf.index.unique())
+                        if logradouros_atingidos_gdf is not None else np.empty(0, dtype=np.int64))
+    conectividade        = analisar_conectividade(grafo_ruas, _linhas_alagadas)
+    quadras_isoladas_gdf = _isolados_fora_da_mancha(
+        conectividade, quadras_gdf, _nos_da_camada(grafo_ruas, assinatura_ruas, "Quadras", quadras_gdf),
+        quadras_atingidas_gdf)
+    escolas_isoladas_gdf = _isolados_fora_da_mancha(
+        conectividade, educacao_filtrada,
+        _nos_da_camada(grafo_ruas, assinatura_ruas, "Educação", educacao_gdf, mascaras_filtro.get("Educação")),
+        educacao_atingida_gdf)
+    saude_isolada_gdf    = _isolados_fora_da_mancha(
+        conectividade, saude_filtrada,
+        _nos_da_camada(grafo_ruas, assinatura_ruas, "Saúde", saude_gdf, mascaras_filtro.get("Saúde")),
+        saude_atingida_gdf)
+
+# ========= Acessibilidade: unidade de saúde mais próxima não atingida =========
+def _coords_metricas(gdf: gpd.GeoDataFrame) -> np.ndarray:
+    return shapely.get_coordinates(_to_point_gdf(gdf).geometry.to_crs(CRS_METRICO).values)
+
+@st.cache_data(show_spinner=False)
+def acessibilidade_saude(_imoveis_gdf, _saude_gdf, _saude_atingida_idx, chave) -> pd.DataFrame | None:
+    """
+    Para cada imóvel (ponto representativo, EPSG:31982) consulta em lote, via cKDTree:
+      - a unidade de saúde mais próxima sem inundação (dist_base_m);
+      - a unidade mais próxima fora da mancha (unidade_saude / dist_saude_m).
+    perdeu_unidade = a unidade mais próxima original está dentro da mancha.
+    'chave' (cenário + filtros de Saúde) define quando o resultado é recalculado.
+    """
+    if _imoveis_gdf is None or _saude_gdf is None or len(_imoveis_gdf) == 0 or len(_saude_gdf) == 0:
+        return None
+    xy_imv = _coords_metricas(_imoveis_gdf)
+    xy_sau = _coords_metricas(_saude_gdf)
+    atingida = _saude_gdf.index.isin(_saude_atingida_idx)
+
+    dist_base, idx_base = cKDTree(xy_sau).query(xy_imv)
+    livres = np.flatnonzero(~atingida)
+    if len(livres) > 0:
+        dist_livre, idx_livre = cKDTree(xy_sau[livres]).query(xy_imv)
+        unidade = _saude_gdf.index.to_numpy()[livres[idx_livre]]
     else:
-        mini_card(c1, "Empresas (Total)", compacto_br(total_empresas), icon="🏢", accent="blue")
-        mini_card(c2, "Empregados (Total)", compacto_br(total_empregados), icon="👥", accent="blue")
-        mini_card(c3, "Massa Salarial (Total)", moeda_compacta(total_massa_salarial), icon="💰", accent="blue")
-        mini_card(c4, "Média Salarial (Total)", moeda_compacta(media_salarial_geral), icon="📈", accent="blue")
+        dist_livre = np.full(len(xy_imv), np.inf)
+        unidade = np.full(len(xy_imv), None, dtype=object)
+
+    return pd.DataFrame({
+        "dist_base_m": dist_base,
+        "unidade_saude": unidade,
+        "dist_saude_m": dist_livre,
+        "perdeu_unidade": atingida[idx_base],
+    }, index=_imoveis_gdf.index)
+
+acesso_saude_df = None
+if (mancha_4326 is not None) and (imoveis_gdf is not None) and (saude_filtrada is not None):
+    _saude_atg_idx = saude_atingida_gdf.index.unique() if saude_atingida_gdf is not None else pd.Index([])
+    acesso_saude_df = acessibilidade_saude(
+        imoveis_gdf, saude_filtrada, _saude_atg_idx,
+        (cenario_chave, tuple(saude_filtrada.index), tuple(_saude_atg_idx))
+    )
 
-    # ---------- SAÚDE ----------
-    st.markdown('<div class="painel-sec-titulo">Saúde</div>', unsafe_allow_html=True)
+# ========= Evacuação: alocação de imóveis atingidos em escolas-abrigo =========
+def _col_nome_bairro(gdf: gpd.GeoDataFrame | None) -> str | None:
+    if gdf is None:
+        return None
+    for c in ("nome", "NOME", "Nome", "bairro", "BAIRRO", "NM_BAIRRO"):
+        if c in gdf.columns:
+            return c
+    return None
 
-    def _saude_cards_por_tipo(saude_total_gdf, saude_atg_gdf, mostrar_atingidos: bool, max_cards: int = 8):
-        if saude_total_gdf is None or len(saude_total_gdf) == 0:
-            st.info("Sem registros de Saúde para exibir.")
-            return
-        col_tipo = 'CO_TIPO_ESTABELECIMENTO'
-        cont_total = saude_total_gdf[col_tipo].astype(str).value_counts().reset_index()
-        cont_total.columns = [col_tipo, 'Total']
-        if mostrar_atingidos and (saude_atg_gdf is not None) and (len(saude_atg_gdf) > 0):
-            cont_atg = saude_atg_gdf[col_tipo].astype(str).value_counts().reset_index()
-            cont_atg.columns = [col_tipo, 'Atingidos']
+def _bairro_dos_pontos(pts_gdf: gpd.GeoDataFrame, bairros: gpd.GeoDataFrame | None) -> pd.Series:
+    col = _col_nome_bairro(bairros)
+    if bairros is None or col is None or len(pts_gdf) == 0:
+        return pd.Series("Sem bairro", index=pts_gdf.index)
+    pts = gpd.GeoDataFrame(geometry=_to_point_gdf(pts_gdf).geometry.to_crs("EPSG:4326"))
+    res = gpd.sjoin(pts, bairros[[col, "geometry"]].to_crs("EPSG:4326"), how="left", predicate="within")
+    res = res[~res.index.duplicated(keep="first")]
+    return res[col].astype("object").fillna("Sem bairro").reindex(pts_gdf.index)
+
+@st.cache_data(show_spinner=False)
+def alocar_abrigos(_imoveis_atg, _escolas, _escolas_atg_idx, _bairros, pessoas_por_imovel: float, chave, k: int = 8) -> dict | None:
+    """
+    Alocação gulosa em lote dos imóveis atingidos nas escolas fora da mancha:
+      - Capacidade da escola = MAT_BAS_PROF (QT_MAT_BAS + QT_MAT_PROF, em pessoas) -> vagas = capacidade // pessoas_por_imovel.
+      - cKDTree devolve os k abrigos mais próximos de cada imóvel (EPSG:31982).
+      - Rodada j: cada imóvel pendente tenta seu j-ésimo candidato; dentro de cada abrigo os mais
+        próximos entram primeiro até esgotar as vagas (bookkeeping vetorizado com bincount).
+    Imóveis sem vaga após k rodadas formam o excedente, agregado por bairro.
+    """
+    if _imoveis_atg is None or _escolas is None or len(_imoveis_atg) == 0:
+        return None
+    abrigos = _escolas[~_escolas.index.isin(_escolas_atg_idx)]
+    if len(abrigos) == 0:
+        return None
+
+    cap = abrigos["MAT_BAS_PROF"].to_numpy(dtype=float)
+    vagas = np.floor(cap / pessoas_por_imovel).astype(np.int64)
+    restante = vagas.copy()
+
+    xy_imv = _coords_metricas(_imoveis_atg)
+    k_eff = min(k, len(abrigos))
+    dist, cand = cKDTree(_coords_metricas(abrigos)).query(xy_imv, k=k_eff)
+    dist, cand = dist.reshape(len(xy_imv), k_eff), cand.reshape(len(xy_imv), k_eff)
+
+    abrigo = np.full(len(xy_imv), -1, dtype=np.int64)
+    dist_abrigo = np.full(len(xy_imv), np.nan)
+    for j in range(k_eff):
+        pend = np.flatnonzero(abrigo < 0)
+        if len(pend) == 0 or not (restante > 0).any():
+            break
+        c, d = cand[pend, j], dist[pend, j]
+        ordem = np.lexsort((d, c))
+        pend, c, d = pend[ordem], c[ordem], d[ordem]
+        inicio = np.r_[0, np.flatnonzero(np.diff(c)) + 1]
+        pos = np.arange(len(c)) - np.repeat(inicio, np.diff(np.r_[inicio, len(c)]))
+        ok = pos < restante[c]
+        abrigo[pend[ok]] = c[ok]
+        dist_abrigo[pend[ok]] = d[ok]
+        restante -= np.bincount(c[ok], minlength=len(restante))
+
+    alocado = abrigo >= 0
+    bairro = _bairro_dos_pontos(_imoveis_atg, _bairros).to_numpy()
+    por_bairro = (pd.DataFrame({"Bairro": bairro, "Alocados": alocado, "Sem Vaga": ~alocado})
+                  .groupby("Bairro").agg(Atingidos=("Alocados", "size"), Alocados=("Alocados", "sum"), **{"Sem Vaga": ("Sem Vaga", "sum")})
+                  .reset_index().sort_values(["Sem Vaga", "Atingidos"], ascending=False))
+    nomes = abrigos["NO_ENTIDADE"].astype(str).to_numpy() if "NO_ENTIDADE" in abrigos.columns else abrigos.index.astype(str).to_numpy()
+    ocupacao = pd.DataFrame({"Escola": nomes, "Capacidade (pessoas)": cap.astype(int), "Vagas (imóveis)": vagas,
+                             "Imóveis Alocados": vagas - restante})
+    ocupacao = ocupacao[ocupacao["Imóveis Alocados"] > 0].sort_values("Imóveis Alocados", ascending=False)
+    return {
+        "n_abrigos": len(abrigos), "vagas": int(vagas.sum()), "capacidade": float(cap.sum()),
+        "n_imoveis": len(xy_imv), "n_alocados": int(alocado.sum()),
+        "dist_media_m": float(np.nanmean(dist_abrigo)) if alocado.any() else 0.0,
+        "por_bairro": por_bairro, "ocupacao": ocupacao,
+    }
+
+evacuacao = None
+if modo_evacuacao and (imoveis_atingidos_gdf is not None) and (educacao_filtrada is not None):
+    _esc_atg_idx = educacao_atingida_gdf.index.unique() if educacao_atingida_gdf is not None else pd.Index([])
+    evacuacao = alocar_abrigos(
+        imoveis_atingidos_gdf, educacao_filtrada, _esc_atg_idx, bairros_gdf, float(pessoas_por_imovel),
+        (cenario_chave, tuple(educacao_filtrada.index), tuple(_esc_atg_idx))
+    )
+
+# ====== PAINEL DE IMPACTO ======
+# Fragmentos: o script completo (dados, filtros, cenário e overlays) só reexecuta quando muda a sidebar.
+# Widgets internos ao painel (rollup CNAE) reexecutam só o painel; os do mapa (Controle de Camadas,
+# desenho) só o mapa. Ambos leem os resultados da última execução completa do script.
+@st.fragment
+def painel_impacto():
+    with st.expander("📊 Painel de Impacto", expanded=False):
+
+        # Cards em grade: cada seção vira um único bloco HTML (um st.markdown), não um elemento por card.
+        # _linha(n) devolve n células vazias; mini_card acumula o HTML na célula; _render_secao emite tudo.
+        def _linha(n):
+            return [[] for _ in range(n)]
+
+        def mini_card(col, titulo, valor, delta=None, icon="📊", accent="blue"):
+            delta_html = f'<div class="mini-delta">{delta}</div>' if delta else ''
+            col.append(
+                f'<div class="mini-card"><div class="accent {accent}"></div><div class="mini-wrap">'
+                f'<div class="mini-label">{titulo}</div>'
+                f'<div class="mini-top"><span class="mini-icon">{icon}</span><span class="mini-value">{valor}</span></div>'
+                f'{delta_html}</div></div>'
+            )
+
+        def _render_secao(titulo=None, *linhas):
+            html = f'<div class="painel-sec-titulo">{titulo}</div>' if titulo else ''
+            for linha in linhas:
+                celulas = "".join(f'<div>{"".join(c)}</div>' for c in linha)
+                html += f'<div class="grade-cards" style="grid-template-columns:repeat({len(linha)}, minmax(0, 1fr));">{celulas}</div>'
+            st.markdown(html, unsafe_allow_html=True)
+
+        st.subheader(f"Impacto: {selecao_mancha_nome}" if modo_atingidos else "Impacto")
+
+        # ---------- EMPRESAS ----------
+        fatia_emp = _fatia(cubo_impacto, "Empresas", filtros_ativos.get("Empresas"))
+        total_empresas, ating_empresas             = _total_atingido(fatia_emp)
+        total_empregados, ating_empregados         = _total_atingido(fatia_emp, "Empregados")
+        total_massa_salarial, ating_massa          = _total_atingido(fatia_emp, "Massa_Salarial")
+        soma_media_geral, soma_media_atg           = _total_atingido(fatia_emp, "MédiaSalarial")
+        n_media_geral, n_media_atg                 = _total_atingido(fatia_emp, "_n_MédiaSalarial")
+        media_salarial_geral    = soma_media_geral / n_media_geral if n_media_geral else 0.0
+        media_salarial_atingida = soma_media_atg / n_media_atg if n_media_atg else 0.0
+
+        perc_empresas   = (ating_empresas   / total_empresas * 100)       if total_empresas       > 0 else 0
+        perc_empregados = (ating_empregados / total_empregados * 100)     if total_empregados     > 0 else 0
+        perc_massa      = (ating_massa      / total_massa_salarial * 100) if total_massa_salarial > 0 else 0
+
+        c1, c2, c3, c4 = _linha(4)
+        if mostrar_empresas_atingidas:
+            mini_card(c1, "Empresas Atingidas", compacto_br(ating_empresas),
+                      f"de {compacto_br(total_empresas)} ({pct_int(perc_empresas)})", icon="🏢", accent="blue")
+            mini_card(c2, "Empregados Atingidos", compacto_br(ating_empregados),
+                      f"de {compacto_br(total_empregados)} ({pct_int(perc_empregados)})", icon="👥", accent="blue")
+            mini_card(c3, "Massa Salarial Atingida", moeda_compacta(ating_massa),
+                      f"de {moeda_compacta(total_massa_salarial)} ({pct_int(perc_massa)})", icon="💰", accent="blue")
+            mini_card(c4, "Média Salarial (Atingidos)", moeda_compacta(media_salarial_atingida),
+                      f"de {formatar_br(media_salarial_geral)} no Total", icon="📈", accent="blue")
         else:
-            cont_atg = pd.DataFrame(columns=[col_tipo, 'Atingidos'])
-        dfm = cont_total.merge(cont_atg, on=col_tipo, how='left')
-        dfm['Atingidos'] = dfm['Atingidos'].fillna(0).astype(int)
-        dfm['%'] = (dfm['Atingidos'] / dfm['Total'] * 100).fillna(0)
-        dfm = dfm.sort_values(['Total', col_tipo], ascending=[False, True]).reset_index(drop=True)
-        top = dfm.head(max_cards)
-        n = len(top)
-        for i in range(0, n, 4):
-            cols = st.columns(min(4, n - i))
-            for j, (_, row) in enumerate(top.iloc[i:i+4].iterrows()):
-                tipo = str(row[col_tipo]); total = int(row['Total']); ating = int(row['Atingidos'])
-                delta = f"de {compacto_br(total)} ({pct_int((ating/total*100) if total else 0)})" if mostrar_atingidos else None
-                valor = compacto_br(ating) if mostrar_atingidos else compacto_br(total)
-                mini_card(cols[j], f"{tipo}", valor, delta=delta, icon="🏥", accent="green")
-        if len(dfm) > max_cards:
-            with st.expander("Outros tipos de estabelecimento (tabela)", expanded=False):
+            mini_card(c1, "Empresas (Total)", compacto_br(total_empresas), icon="🏢", accent="blue")
+            mini_card(c2, "Empregados (Total)", compacto_br(total_empregados), icon="👥", accent="blue")
+            mini_card(c3, "Massa Salarial (Total)", moeda_compacta(total_massa_salarial), icon="💰", accent="blue")
+            mini_card(c4, "Média Salarial (Total)", moeda_compacta(media_salarial_geral), icon="📈", accent="blue")
+        _render_secao("Empresas", [c1, c2, c3, c4])
+
+        rollup_emp = rollup_cnae(cenario_chave if modo_atingidos else None, assinaturas_camadas, cubo_impacto)
+        if rollup_emp is not None and len(rollup_emp) > 0:
+            with st.expander("🏭 Impacto por Setor (CNAE)", expanded=False):
+                rollup_emp = _filtrar_dims(rollup_emp, filtros_ativos.get("Empresas"))
+                medida_cnae = st.radio("Medida", list(ROLLUP_CNAE_MEDIDAS), horizontal=True, key="cnae_medida")
+                por_secao = _tabela_cnae(rollup_emp, ["Seção"], medida_cnae, mostrar_empresas_atingidas)
+                st.dataframe(por_secao, use_container_width=True, hide_index=True)
+                secao_cnae = st.selectbox("Detalhar Seção", ["(todas)"] + por_secao["Seção"].tolist(), key="cnae_secao")
+                if secao_cnae != "(todas)":
+                    rollup_emp = rollup_emp[rollup_emp["Seção"] == secao_cnae]
+                st.dataframe(_tabela_cnae(rollup_emp, ["Seção", "Denominação"], medida_cnae, mostrar_empresas_atingidas),
+                             use_container_width=True, hide_index=True)
+
+        # ---------- SAÚDE ----------
+        def _saude_cards_por_tipo(fatia_saude, mostrar_atingidos: bool, max_cards: int = 8):
+            col_tipo = 'CO_TIPO_ESTABELECIMENTO'
+            if fatia_saude is None or fatia_saude["_n"].sum() == 0:
+                _render_secao("Saúde")
+                st.info("Sem registros de Saúde para exibir.")
+                return
+            dfm = _por_categoria(fatia_saude, col_tipo)
+            dfm = dfm[dfm['Total'] > 0]
+            dfm['Atingidos'] = dfm['Atingidos'].astype(int) if mostrar_atingidos else 0
+            dfm['%'] = (dfm['Atingidos'] / dfm['Total'] * 100).fillna(0)
+            dfm = dfm.sort_values(['Total', col_tipo], ascending=[False, True]).reset_index(drop=True)
+            top = dfm.head(max_cards)
+            n = len(top)
+            linhas = []
+            for i in range(0, n, 4):
+                cols = _linha(min(4, n - i))
+                linhas.append(cols)
+                for j, (_, row) in enumerate(top.iloc[i:i+4].iterrows()):
+                    tipo = str(row[col_tipo]); total = int(row['Total']); ating = int(row['Atingidos'])
+                    delta = f"de {compacto_br(total)} ({pct_int((ating/total*100) if total else 0)})" if mostrar_atingidos else None
+                    valor = compacto_br(ating) if mostrar_atingidos else compacto_br(total)
+                    mini_card(cols[j], f"{tipo}", valor, delta=delta, icon="🏥", accent="green")
+            _render_secao("Saúde", *linhas)
+            if len(dfm) > max_cards:
+                with st.expander("Outros tipos de estabelecimento (tabela)", expanded=False):
+                    st.dataframe(
+                        dfm.rename(columns={col_tipo: "Tipo", "Total": "Total", "Atingidos": "Atingidos", "%": "% ating."}),
+                        use_container_width=True, hide_index=True
+                    )
+
+        _saude_cards_por_tipo(_fatia(cubo_impacto, "Saúde", filtros_ativos.get("Saúde")), mostrar_saude_atingida, max_cards=8)
+
+        if mostrar_saude_atingida and (saude_atingida_gdf is not None) and (not saude_atingida_gdf.empty):
+            with st.expander("📋 Unidades de Saúde Atingidas", expanded=False):
+                tmp = saude_atingida_gdf.copy()
+                vis_cols, aliases = [], []
+                for col, alias in [("NO_FANTASIA", "Nome"), ("NO_BAIRRO", "Bairro"), ("NO_LOGRADOURO", "Logradouro"), ("NU_ENDERECO", "Número")]:
+                    if col in tmp.columns:
+                        vis_cols.append(col); aliases.append(alias)
+                if not vis_cols:
+                    tmp["_idx"] = tmp.index.astype(str)
+                    vis_cols = ["_idx"]; aliases = ["ID"]
                 st.dataframe(
-                    dfm.rename(columns={col_tipo: "Tipo", "Total": "Total", "Atingidos": "Atingidos", "%": "% ating."}),
+                    tmp[vis_cols].rename(columns=dict(zip(vis_cols, aliases))),
                     use_container_width=True, hide_index=True
                 )
 
-    _saude_cards_por_tipo(saude_filtrada, saude_atingida_gdf, mostrar_saude_atingida, max_cards=8)
-
-    if mostrar_saude_atingida and (saude_atingida_gdf is not None) and (not saude_atingida_gdf.empty):
-        with st.expander("📋 Unidades de Saúde Atingidas", expanded=False):
-            tmp = saude_atingida_gdf.copy()
-            vis_cols, aliases = [], []
-            for col, alias in [("NO_FANTASIA", "Nome"), ("NO_BAIRRO", "Bairro"), ("NO_LOGRADOURO", "Logradouro"), ("NU_ENDERECO", "Número")]:
-                if col in tmp.columns:
-                    vis_cols.append(col); aliases.append(alias)
-            if not vis_cols:
-                tmp["_idx"] = tmp.index.astype(str)
-                vis_cols = ["_idx"]; aliases = ["ID"]
-            st.dataframe(
-                tmp[vis_cols].rename(columns=dict(zip(vis_cols, aliases))),
-                use_container_width=True, hide_index=True
-            )
-
-    # ---------- EDUCAÇÃO ----------
-    st.markdown('<div class="painel-sec-titulo">Educação</div>', unsafe_allow_html=True)
-
-# Totais
-    total_escolas = len(educacao_filtrada) if educacao_filtrada is not None else 0
-# Funcionários (já com 88888 zerado no carregamento)
-    total_func = float(educacao_filtrada["QT_FUNCIONARIOS"].sum()) if (educacao_filtrada is not None and "QT_FUNCIONARIOS" in educacao_filtrada.columns) else 0.0
-
-# Matrículas por nível
-    total_inf  = _sum_cols(educacao_filtrada, COLS_INFANTIL)        # Educação Infantil
-    total_fund = _sum_cols(educacao_filtrada, COLS_FUNDAMENTAL)     # Ensino Fundamental
-    total_med  = _sum_cols(educacao_filtrada, COLS_MEDIO)           # Ensino Médio
-    total_tec  = float(pd.to_numeric(educacao_filtrada["QT_MAT_PROF"], errors="coerce").fillna(0).sum()) if (educacao_filtrada is not None and "QT_MAT_PROF" in educacao_filtrada.columns) else 0.0
-
-# Atingidos
-    if modo_atingidos and (educacao_atingida_gdf is not None) and (not educacao_atingida_gdf.empty):
-        ating_escolas = len(educacao_atingida_gdf)
-        ating_func    = float(educacao_atingida_gdf["QT_FUNCIONARIOS"].sum()) if "QT_FUNCIONARIOS" in educacao_atingida_gdf.columns else 0.0
-
-        ating_inf  = _sum_cols(educacao_atingida_gdf, COLS_INFANTIL)
-        ating_fund = _sum_cols(educacao_atingida_gdf, COLS_FUNDAMENTAL)
-        ating_med  = _sum_cols(educacao_atingida_gdf, COLS_MEDIO)
-        ating_tec  = float(pd.to_numeric(educacao_atingida_gdf["QT_MAT_PROF"], errors="coerce").fillna(0).sum()) if "QT_MAT_PROF" in educacao_atingida_gdf.columns else 0.0
-    else:
-        ating_escolas = 0
-        ating_func = 0.0
-        ating_inf = ating_fund = ating_med = ating_tec = 0.0
-
-# Percentuais
-    perc_escolas = (ating_escolas / total_escolas * 100) if total_escolas > 0 else 0
-    perc_func    = (ating_func    / total_func    * 100) if total_func    > 0 else 0
-    perc_inf     = (ating_inf     / total_inf     * 100) if total_inf     > 0 else 0
-    perc_fund    = (ating_fund    / total_fund    * 100) if total_fund    > 0 else 0
-    perc_med     = (ating_med     / total_med     * 100) if total_med     > 0 else 0
-    perc_tec     = (ating_tec     / total_tec     * 100) if total_tec     > 0 else 0
-
-# Linha 1: escolas e funcionários (síntese)
-    e_top1, e_top2 = st.columns(2)
-    if mostrar_educacao_atingida:
-        mini_card(e_top1, "Escolas Atingidas", compacto_br(ating_escolas),
-                f"de {compacto_br(total_escolas)} ({pct_int(perc_escolas)})", icon="🏫", accent="teal")
-        mini_card(e_top2, "Funcionários Atingidos", compacto_br(ating_func),
-                f"de {compacto_br(total_func)} ({pct_int(perc_func)})", icon="👥", accent="teal")
-    else:
-        mini_card(e_top1, "Escolas (Total)", compacto_br(total_escolas), icon="🏫", accent="teal")
-        mini_card(e_top2, "Funcionários (Total)", compacto_br(total_func), icon="👥", accent="teal")
-
-# Linha 2: cards por nível (Infantil, Fundamental, Médio, Técnico/Profissional)
-    e1, e2, e3, e4 = st.columns(4)
-    if mostrar_educacao_atingida:
-        mini_card(e1, "Educação Infantil (Ating.)", compacto_br(ating_inf),
-                f"de {compacto_br(total_inf)} ({pct_int(perc_inf)})", icon="🧸", accent="teal")
-        mini_card(e2, "Ensino Fundamental (Ating.)", compacto_br(ating_fund),
-                f"de {compacto_br(total_fund)} ({pct_int(perc_fund)})", icon="📗", accent="teal")
-        mini_card(e3, "Ensino Médio (Ating.)", compacto_br(ating_med),
-                f"de {compacto_br(total_med)} ({pct_int(perc_med)})", icon="📘", accent="teal")
-        mini_card(e4, "Técnico/Prof. (Ating.)", compacto_br(ating_tec),
-                f"de {compacto_br(total_tec)} ({pct_int(perc_tec)})", icon="🛠️", accent="teal")
-    else:
-        mini_card(e1, "Educação Infantil (Total)", compacto_br(total_inf), icon="🧸", accent="teal")
-        mini_card(e2, "Ensino Fundamental (Total)", compacto_br(total_fund), icon="📗", accent="teal")
-        mini_card(e3, "Ensino Médio (Total)", compacto_br(total_med), icon="📘", accent="teal")
-        mini_card(e4, "Técnico/Prof. (Total)", compacto_br(total_tec), icon="🛠️", accent="teal")
-
-# ---- Cards por dependência escolar (mantidos) ----
-    def _cards_dependencia(edu_total, edu_atg, show_ating):
-        if edu_total is None or len(edu_total)==0:
-            st.info("Sem registros de Educação para exibir por dependência.")
-            return
-        base = edu_total.groupby("DEP_LABEL", dropna=False).agg(
-            Escolas=("DEP_LABEL","size"),
-            Funcionarios=("QT_FUNCIONARIOS","sum")
-        ).reset_index()
-        if show_ating and (edu_atg is not None):
-            atg = edu_atg.groupby("DEP_LABEL", dropna=False).agg(
-                Escolas=("DEP_LABEL","size"),
-                Funcionarios=("QT_FUNCIONARIOS","sum")
-            ).reset_index()
-            df = base.merge(atg, on="DEP_LABEL", how="left", suffixes=("", "_ATG")).fillna({"Escolas_ATG":0,"Funcionarios_ATG":0})
+        # ---- Acesso à saúde (unidade mais próxima fora da mancha) ----
+        if modo_atingidos and (acesso_saude_df is not None):
+            n_perdeu   = int(acesso_saude_df["perdeu_unidade"].sum())
+            n_imv_tot  = len(acesso_saude_df)
+            dist_ok    = acesso_saude_df["dist_saude_m"].replace(np.inf, np.nan)
+            dist_media = float(dist_ok.mean()) if dist_ok.notna().any() else 0.0
+            dist_base  = float(acesso_saude_df["dist_base_m"].mean())
+            afetados   = acesso_saude_df[acesso_saude_df["perdeu_unidade"]]
+            acrescimo  = float((afetados["dist_saude_m"] - afetados["dist_base_m"]).replace(np.inf, np.nan).mean()) if len(afetados) else 0.0
+            if np.isnan(acrescimo): acrescimo = 0.0
+
+            a1, a2, a3 = _linha(3)
+            mini_card(a1, "Imóveis que Perdem a Unidade Mais Próxima", compacto_br(n_perdeu),
+                      f"de {compacto_br(n_imv_tot)} ({pct_int(n_perdeu / n_imv_tot * 100 if n_imv_tot else 0)})", icon="🚑", accent="green")
+            mini_card(a2, "Distância Média à Unidade Não Atingida", f"{br(dist_media / 1000, 1)} km",
+                      f"de {br(dist_base / 1000, 1)} km sem inundação", icon="📏", accent="green")
+            mini_card(a3, "Acréscimo Médio (Imóveis Afetados)", f"{br(acrescimo / 1000, 1)} km", icon="➕", accent="green")
+            _render_secao(None, [a1, a2, a3])
+
+        # ---------- EDUCAÇÃO ----------
+
+    # Totais e atingidos (fatia do cubo; funcionários já com 88888 zerado no carregamento)
+        fatia_edu = _fatia(cubo_impacto, "Educação", filtros_ativos.get("Educação"))
+        total_escolas, ating_escolas = _total_atingido(fatia_edu)
+        total_func, ating_func       = _total_atingido(fatia_edu, "QT_FUNCIONARIOS")
+
+    # Matrículas por nível
+        total_inf,  ating_inf  = _total_atingido(fatia_edu, "MAT_INFANTIL")        # Educação Infantil
+        total_fund, ating_fund = _total_atingido(fatia_edu, "MAT_FUNDAMENTAL")     # Ensino Fundamental
+        total_med,  ating_med  = _total_atingido(fatia_edu, "MAT_MEDIO")           # Ensino Médio
+        total_tec,  ating_tec  = _total_atingido(fatia_edu, "MAT_TECNICO_PROF")    # Técnico/Profissional
+
+    # Percentuais
+        perc_escolas = (ating_escolas / total_escolas * 100) if total_escolas > 0 else 0
+        perc_func    = (ating_func    / total_func    * 100) if total_func    > 0 else 0
+        perc_inf     = (ating_inf     / total_inf     * 100) if total_inf     > 0 else 0
+        perc_fund    = (ating_fund    / total_fund    * 100) if total_fund    > 0 else 0
+        perc_med     = (ating_med     / total_med     * 100) if total_med     > 0 else 0
+        perc_tec     = (ating_tec     / total_tec     * 100) if total_tec     > 0 else 0
+
+    # Linha 1: escolas e funcionários (síntese)
+        e_top1, e_top2 = _linha(2)
+        if mostrar_educacao_atingida:
+            mini_card(e_top1, "Escolas Atingidas", compacto_br(ating_escolas),
+                    f"de {compacto_br(total_escolas)} ({pct_int(perc_escolas)})", icon="🏫", accent="teal")
+            mini_card(e_top2, "Funcionários Atingidos", compacto_br(ating_func),
+                    f"de {compacto_br(total_func)} ({pct_int(perc_func)})", icon="👥", accent="teal")
         else:
-            df = base.copy()
-            df["Escolas_ATG"] = 0
-            df["Funcionarios_ATG"] = 0
-
-        ordem = ["Federal","Estadual","Municipal","Privada"]
-        df["__ord"] = df["DEP_LABEL"].apply(lambda x: ordem.index(x) if x in ordem else 999)
-        df = df.sort_values(["__ord","DEP_LABEL"]).drop(columns="__ord")
-
-        cols = st.columns(4)
-        for i, (_, r) in enumerate(df.iterrows()):
-            titulo = r["DEP_LABEL"]
-            if show_ating:
-                delta_txt = f"{int(r['Escolas_ATG'])} esc. / {compacto_br(r['Funcionarios_ATG'])} func. ating."
-                valor_txt = f"{int(r['Escolas'])} / {compacto_br(r['Funcionarios'])}"
-                mini_card(cols[i], titulo, valor_txt, delta=delta_txt, icon="🏫", accent="teal")
-            else:
+            mini_card(e_top1, "Escolas (Total)", compacto_br(total_escolas), icon="🏫", accent="teal")
+            mini_card(e_top2, "Funcionários (Total)", compacto_br(total_func), icon="👥", accent="teal")
+
+    # Linha 2: cards por nível (Infantil, Fundamental, Médio, Técnico/Profissional)
+        e1, e2, e3, e4 = _linha(4)
+        if mostrar_educacao_atingida:
+            mini_card(e1, "Educação Infantil (Ating.)", compacto_br(ating_inf),
+                    f"de {compacto_br(total_inf)} ({pct_int(perc_inf)})", icon="🧸", accent="teal")
+            mini_card(e2, "Ensino Fundamental (Ating.)", compacto_br(ating_fund),
+                    f"de {compacto_br(total_fund)} ({pct_int(perc_fund)})", icon="📗", accent="teal")
+            mini_card(e3, "Ensino Médio (Ating.)", compacto_br(ating_med),
+                    f"de {compacto_br(total_med)} ({pct_int(perc_med)})", icon="📘", accent="teal")
+            mini_card(e4, "Técnico/Prof. (Ating.)", compacto_br(ating_tec),
+                    f"de {compacto_br(total_tec)} ({pct_int(perc_tec)})", icon="🛠️", accent="teal")
+        else:
+            mini_card(e1, "Educação Infantil (Total)", compacto_br(total_inf), icon="🧸", accent="teal")
+            mini_card(e2, "Ensino Fundamental (Total)", compacto_br(total_fund), icon="📗", accent="teal")
+            mini_card(e3, "Ensino Médio (Total)", compacto_br(total_med), icon="📘", accent="teal")
+            mini_card(e4, "Técnico/Prof. (Total)", compacto_br(total_tec), icon="🛠️", accent="teal")
+
+    # ---- Cards por dependência escolar (mantidos) ----
+        def _cards_dependencia(fatia, show_ating):
+            if fatia is None or len(fatia)==0:
+                return []
+            df = _por_categoria(fatia, "DEP_LABEL").rename(columns={"Total": "Escolas", "Atingidos": "Escolas_ATG"})
+            func = _por_categoria(fatia, "DEP_LABEL", "QT_FUNCIONARIOS").rename(
+                columns={"Total": "Funcionarios", "Atingidos": "Funcionarios_ATG"})
+            df = df.merge(func, on="DEP_LABEL", how="left")
+
+            ordem = ["Federal","Estadual","Municipal","Privada"]
+            df["__ord"] = df["DEP_LABEL"].apply(lambda x: ordem.index(x) if x in ordem else 999)
+            df = df.sort_values(["__ord","DEP_LABEL"]).drop(columns="__ord")
+
+            linhas = [_linha(min(4, len(df) - i)) for i in range(0, len(df), 4)]
+            for i, (_, r) in enumerate(df.iterrows()):
+                cols = linhas[i // 4]
+                titulo = r["DEP_LABEL"]
                 valor_txt = f"{int(r['Escolas'])} / {compacto_br(r['Funcionarios'])}"
-                mini_card(cols[i], titulo, valor_txt, icon="🏫", accent="teal")
-
-        _cards_dependencia(educacao_filtrada, educacao_atingida_gdf, mostrar_educacao_atingida)
-
-    # ---- Lista de Escolas Atingidas (como ruas/imóveis) ----
-    if mostrar_educacao_atingida and (educacao_atingida_gdf is not None) and (not educacao_atingida_gdf.empty):
-        with st.expander("📋 Escolas Atingidas (lista)", expanded=False):
-            tmp = educacao_atingida_gdf.copy()
-
-            # Calcula matrículas por nível por escola para exibição
-            def _row_sum_safe(row, cols):
-                s = 0.0
-                for c in cols:
-                    if c in row:
-                        v = pd.to_numeric(row[c], errors="coerce")
-                        if pd.notna(v):
-                            s += float(v)
-                return int(s)
-
-            tmp["INFANTIL"]   = tmp.apply(lambda r: _row_sum_safe(r, COLS_INFANTIL), axis=1)
-            tmp["FUNDAMENTAL"]= tmp.apply(lambda r: _row_sum_safe(r, COLS_FUNDAMENTAL), axis=1)
-            tmp["MEDIO"]      = tmp.apply(lambda r: _row_sum_safe(r, COLS_MEDIO), axis=1)
-            if "QT_MAT_PROF" in tmp.columns:
-                tmp["TECNICO_PROF"] = pd.to_numeric(tmp["QT_MAT_PROF"], errors="coerce").fillna(0).astype(int)
-            else:
-                tmp["TECNICO_PROF"] = 0
-
-        # Garante dependência e funcionários (88888 já tratado no carregamento)
-            if "DEP_LABEL" not in tmp.columns and "TP_DEPENDENCIA" in tmp.columns:
-                tmp["DEP_LABEL"] = tmp["TP_DEPENDENCIA"].apply(dep_label)
-            if "QT_FUNCIONARIOS" not in tmp.columns:
-            # contingência: soma no ato (tratando 88888 -> 0) se coluna não existir
-                def _staff_sum_row(r):
-                    total = 0
-                    for c in STAFF_COLS:
-                        v = pd.to_numeric(r.get(c, 0), errors="coerce")
-                        if pd.isna(v) or v == 88888:
-                            v = 0
-                        total += float(v)
-                    return int(total)
-                tmp["QT_FUNCIONARIOS"] = tmp.apply(_staff_sum_row, axis=1)
-
-            vis_cols = []
-            alias = []
-            for col, al in [
-                ("NO_ENTIDADE", "Escola"),
-                ("DEP_LABEL", "Dependência"),
-                ("QT_FUNCIONARIOS", "Funcionários"),
-                ("INFANTIL", "Matríc. Infantil"),
-                ("FUNDAMENTAL", "Matríc. Fundamental"),
-                ("MEDIO", "Matríc. Médio"),
-                ("TECNICO_PROF", "Matríc. Técnico/Prof.")
-            ]:
-                if col in tmp.columns:
-                    vis_cols.append(col); alias.append(al)
-
-        # Ordena por maior impacto (ex.: maior total de matrículas atingidas) e nome
-            if {"INFANTIL","FUNDAMENTAL","MEDIO","TECNICO_PROF"}.issubset(set(tmp.columns)):
-                tmp["_MAT_TOTAL_NIVEIS"] = tmp["INFANTIL"] + tmp["FUNDAMENTAL"] + tmp["MEDIO"] + tmp["TECNICO_PROF"]
-                tmp = tmp.sort_values(["_MAT_TOTAL_NIVEIS","NO_ENTIDADE"], ascending=[False, True])
-            else:
-                tmp = tmp.sort_values(["NO_ENTIDADE"])
+                if show_ating:
+                    delta_txt = f"{int(r['Escolas_ATG'])} esc. / {compacto_br(r['Funcionarios_ATG'])} func. ating."
+                    mini_card(cols[i % 4], titulo, valor_txt, delta=delta_txt, icon="🏫", accent="teal")
+                else:
+                    mini_card(cols[i % 4], titulo, valor_txt, icon="🏫", accent="teal")
+            return linhas
+
+        linhas_dep = _cards_dependencia(fatia_edu, mostrar_educacao_atingida)
+        _render_secao("Educação", [e_top1, e_top2], [e1, e2, e3, e4], *linhas_dep)
+        if not linhas_dep:
+            st.info("Sem registros de Educação para exibir por dependência.")
 
-            st.dataframe(
-                tmp[vis_cols].rename(columns=dict(zip(vis_cols, alias))),
-                use_container_width=True, hide_index=True
-            )
-    # ---------- PRÉDIOS PÚBLICOS & SEGURANÇA ----------
-    st.markdown('<div class="painel-sec-titulo">Prédios Públicos e Segurança</div>', unsafe_allow_html=True)
-    total_predios   = len(predios_filtrados) if predios_filtrados is not None else 0
-    predios_ating   = len(predios_atingidos_gdf) if (modo_atingidos and predios_atingidos_gdf is not None) else 0
-    perc_predios    = (predios_ating / total_predios * 100) if total_predios > 0 else 0
-
-    total_seguranca = len(seguranca_filtrada) if seguranca_filtrada is not None else 0
-    seguranca_ating = len(seguranca_atingida_gdf) if (modo_atingidos and seguranca_atingida_gdf is not None) else 0
-    perc_seguranca  = (seguranca_ating / total_seguranca * 100) if total_seguranca > 0 else 0
-
-    ps1, ps2 = st.columns(2)
-    if mostrar_predios_atingidos:
-        mini_card(ps1, "Prédios Públicos Atingidos", compacto_br(predios_ating),
-                  f"de {compacto_br(total_predios)} ({pct_int(perc_predios)})", icon="🏛️", accent="teal")
-    else:
-        mini_card(ps1, "Prédios Públicos (Total)", compacto_br(total_predios), icon="🏛️", accent="teal")
+        # ---- Lista de Escolas Atingidas (como ruas/imóveis) ----
+        if mostrar_educacao_atingida and (educacao_atingida_gdf is not None) and (not educacao_atingida_gdf.empty):
+            with st.expander("📋 Escolas Atingidas (lista)", expanded=False):
+                # Matrículas por nível e funcionários já vêm calculados do carregamento
+                cols_lista = [
+                    ("NO_ENTIDADE", "Escola"),
+                    ("DEP_LABEL", "Dependência"),
+                    ("QT_FUNCIONARIOS", "Funcionários"),
+                    ("MAT_INFANTIL", "Matríc. Infantil"),
+                    ("MAT_FUNDAMENTAL", "Matríc. Fundamental"),
+                    ("MAT_MEDIO", "Matríc. Médio"),
+                    ("MAT_TECNICO_PROF", "Matríc. Técnico/Prof.")
+                ]
+                vis_cols = [c for c, _ in cols_lista if c in educacao_atingida_gdf.columns]
+                alias    = [al for c, al in cols_lista if c in educacao_atingida_gdf.columns]
+
+            # Ordena por maior impacto (maior total de matrículas atingidas) e nome
+                tmp = educacao_atingida_gdf.sort_values(["MAT_TOTAL_NIVEIS","NO_ENTIDADE"], ascending=[False, True])
+                tmp = tmp[vis_cols].astype({c: int for c in vis_cols if c in COLS_MAT_NIVEIS + ["QT_FUNCIONARIOS"]})
 
-    if mostrar_seguranca_atingida:
-        mini_card(ps2, "Unidades de Segurança Atingidas", compacto_br(seguranca_ating),
-                  f"de {compacto_br(total_seguranca)} ({pct_int(perc_seguranca)})", icon="🛡️", accent="gray")
-    else:
-        mini_card(ps2, "Unidades de Segurança (Total)", compacto_br(total_seguranca), icon="🛡️", accent="gray")
-
-    # ---------- RUAS ----------
-    st.markdown('<div class="painel-sec-titulo">Ruas</div>', unsafe_allow_html=True)
-    total_segmentos = len(logradouros_gdf) if logradouros_gdf is not None else 0
-    total_ruas_unicas_calc = (logradouros_gdf['_rua_id_interno'].nunique()
-                              if (logradouros_gdf is not None and '_rua_id_interno' in logradouros_gdf.columns)
-                              else total_segmentos)
-    if modo_atingidos and (logradouros_atingidos_gdf is not None):
-        seg_ating = len(logradouros_atingidos_gdf)
-        ruas_ating = (logradouros_atingidos_gdf['_rua_id_interno'].nunique()
-                      if '_rua_id_interno' in logradouros_atingidos_gdf.columns else 0)
-    else:
-        seg_ating, ruas_ating = 0, 0
-    perc_seg = (seg_ating / total_segmentos * 100) if total_segmentos > 0 else 0
-    perc_rua = (ruas_ating / total_ruas_unicas_calc * 100) if total_ruas_unicas_calc > 0 else 0
-
-    dren_total = _count_flag01(logradouros_gdf, "drenagem")
-    ilum_total = _count_flag01(logradouros_gdf, "iluminacao")
-    if mostrar_ruas_atingidas and (logradouros_atingidos_gdf is not None):
-        dren_ating = _count_flag01(logradouros_atingidos_gdf, "drenagem")
-        ilum_ating = _count_flag01(logradouros_atingidos_gdf, "iluminacao")
-    else:
-        dren_ating = 0
-        ilum_ating = 0
-    p_dren = (dren_ating / dren_total * 100) if dren_total > 0 else 0
-    p_ilum = (ilum_ating / ilum_total * 100) if ilum_total > 0 else 0
-
-    i1, i2, i3, i4 = st.columns(4)
-    if mostrar_ruas_atingidas:
-        mini_card(i1, "Segmentos de Rua Atingidos", compacto_br(seg_ating),
-                  f"de {compacto_br(total_segmentos)} ({pct_int(perc_seg)})", icon="🛣️", accent="orange")
-        mini_card(i2, "Ruas Únicas Atingidas", compacto_br(ruas_ating),
-                  f"de {compacto_br(total_ruas_unicas_calc)} ({pct_int(perc_rua)})", icon="📍", accent="orange")
-        mini_card(i3, "Drenagem (Atingidos)", compacto_br(dren_ating),
-                  f"de {compacto_br(dren_total)} ({pct_int(p_dren)})", icon="🛠️", accent="orange")
-        mini_card(i4, "Iluminação (Atingidos)", compacto_br(ilum_ating),
-                  f"de {compacto_br(ilum_total)} ({pct_int(p_ilum)})", icon="💡", accent="orange")
-    else:
-        mini_card(i1, "Segmentos de Rua (Total)", compacto_br(total_segmentos), icon="🛣️", accent="orange")
-        mini_card(i2, "Ruas Únicas (Total)", compacto_br(total_ruas_unicas_calc), icon="📍", accent="orange")
-        mini_card(i3, "Drenagem (Total)", compacto_br(dren_total), icon="🛠️", accent="orange")
-        mini_card(i4, "Iluminação (Total)", compacto_br(ilum_total), icon="💡", accent="orange")
-
-    if mostrar_ruas_atingidas and (logradouros_atingidos_gdf is not None) and (not logradouros_atingidos_gdf.empty):
-        with st.expander("📋 Lista de Ruas Atingidas", expanded=False):
-            tmp = logradouros_atingidos_gdf.copy()
-            if 'tipo' not in tmp.columns: tmp['tipo'] = ''
-            if 'nome' not in tmp.columns: tmp['nome'] = tmp.get('_rua_id_interno', tmp.index.astype(str))
-            if '_rua_id_interno' not in tmp.columns:
-                tmp['_rua_id_interno'] = (tmp['tipo'].astype(str).str.strip() + ' ' + tmp['nome'].astype(str).str.strip()).str.strip()
-            df_ruas = (
-                tmp.groupby(['_rua_id_interno','tipo','nome'], dropna=False)
-                .size().reset_index(name='Segmentos Atingidos')
-                .sort_values(['Segmentos Atingidos','tipo','nome'], ascending=[False, True, True])
-                .reset_index(drop=True)
-            )
-            st.dataframe(
-                df_ruas[['tipo','nome','Segmentos Atingidos']].rename(
-                    columns={'tipo': 'Tipo','nome': 'Nome da Rua','Segmentos Atingidos': '# Segmentos Atingidos'}
-                ),
-                use_container_width=True, hide_index=True
-            )
+                st.dataframe(
+                    tmp.rename(columns=dict(zip(vis_cols, alias))),
+                    use_container_width=True, hide_index=True
+                )
+        # ---------- PRÉDIOS PÚBLICOS & SEGURANÇA ----------
+        total_predios, predios_ating     = _total_atingido(_fatia(cubo_impacto, "Prédios Públicos", filtros_ativos.get("Prédios Públicos")))
+        perc_predios    = (predios_ating / total_predios * 100) if total_predios > 0 else 0
 
-    # ---------- TERRENOS & QUADRAS ----------
-    st.markdown('<div class="painel-sec-titulo">Terrenos e Quadras</div>', unsafe_allow_html=True)
-    tq1, tq2, tq3, tq4 = st.columns(4)
-    terr_ating = len(terrenos_atingidos_gdf) if (modo_atingidos and terrenos_atingidos_gdf is not None) else 0
-    quad_ating = len(quadras_atingidas_gdf)  if (modo_atingidos and quadras_atingidas_gdf  is not None) else 0
-    perc_terr = (terr_ating / total_terrenos * 100) if total_terrenos > 0 else 0
-    perc_quad = (quad_ating / total_quadras  * 100) if total_quadras  > 0 else 0
-
-    if mostrar_terrenos_atingidos:
-        mini_card(tq1, "Terrenos Atingidos", compacto_br(terr_ating),
-                  f"de {compacto_br(total_terrenos)} ({pct_int(perc_terr)})", icon="🧱", accent="green")
-        mini_card(tq2, "Quadras Atingidas", compacto_br(quad_ating),
-                  f"de {compacto_br(total_quadras)} ({pct_int(perc_quad)})", icon="🧩", accent="purple")
-    else:
-        mini_card(tq1, "Terrenos (Total)", compacto_br(total_terrenos), icon="🧱", accent="green")
-        mini_card(tq2, "Quadras (Total)", compacto_br(total_quadras), icon="🧩", accent="purple")
-    tq3.write(""); tq4.write("")
-
-    # ----- Serviços nos Terrenos -----
-    agua_total    = _count_flag01(terrenos_gdf, "agua")
-    lixo_total    = _count_flag01(terrenos_gdf, "coleta_lix")
-    pluvial_total = _count_flag01(terrenos_gdf, "esgoto_plu")
-    condo_total   = _count_flag01(terrenos_gdf, "condominio")
-    cloacal_total = _count_equals(terrenos_gdf, "esgoto_clo", values={"esgoto_cloacal"})
-    fossa_total   = _count_equals(terrenos_gdf, "esgoto_clo", values={"fossa_septica"})
-
-    if mostrar_terrenos_atingidos and (terrenos_atingidos_gdf is not None):
-        agua_ating    = _count_flag01(terrenos_atingidos_gdf, "agua")
-        lixo_ating    = _count_flag01(terrenos_atingidos_gdf, "coleta_lix")
-        pluvial_ating = _count_flag01(terrenos_atingidos_gdf, "esgoto_plu")
-        condo_ating   = _count_flag01(terrenos_atingidos_gdf, "condominio")
-        cloacal_ating = _count_equals(terrenos_atingidos_gdf, "esgoto_clo", values={"esgoto_cloacal"})
-        fossa_ating   = _count_equals(terrenos_atingidos_gdf, "esgoto_clo", values={"fossa_septica"})
-    else:
-        agua_ating = lixo_ating = pluvial_ating = condo_ating = cloacal_ating = fossa_ating = 0
-
-    p_agua    = (agua_ating    / agua_total * 100)    if agua_total    > 0 else 0
-    p_lixo    = (lixo_ating    / lixo_total * 100)    if lixo_total    > 0 else 0
-    p_pluvial = (pluvial_ating / pluvial_total * 100) if pluvial_total > 0 else 0
-    p_condo   = (condo_ating   / condo_total * 100)   if condo_total   > 0 else 0
-    p_cloacal = (cloacal_ating / cloacal_total * 100) if cloacal_total > 0 else 0
-    p_fossa   = (fossa_ating   / fossa_total * 100)   if fossa_total   > 0 else 0
-
-    s1, s2, s3 = st.columns(3)
-    s4, s5, s6 = st.columns(3)
-    if mostrar_terrenos_atingidos:
-        mini_card(s1, "Água (Atingidos)", compacto_br(agua_ating),
-                  f"de {compacto_br(agua_total)} ({pct_int(p_agua)})", icon="🚰", accent="green")
-        mini_card(s2, "Coleta de Lixo (Atingidos)", compacto_br(lixo_ating),
-                  f"de {compacto_br(lixo_total)} ({pct_int(p_lixo)})", icon="🗑️", accent="green")
-        mini_card(s3, "Esgoto Pluvial (Atingidos)", compacto_br(pluvial_ating),
-                  f"de {compacto_br(pluvial_total)} ({pct_int(p_pluvial)})", icon="💧", accent="green")
-        mini_card(s4, "Esgoto Cloacal (Atingidos)", compacto_br(cloacal_ating),
-                  f"de {compacto_br(cloacal_total)} ({pct_int(p_cloacal)})", icon="🪠", accent="green")
-        mini_card(s5, "Fossa Séptica (Atingidos)", compacto_br(fossa_ating),
-                  f"de {compacto_br(fossa_total)} ({pct_int(p_fossa)})", icon="🕳️", accent="green")
-        mini_card(s6, "Condomínios (Atingidos)", compacto_br(condo_ating),
-                  f"de {compacto_br(condo_total)} ({pct_int(p_condo)})", icon="🏢", accent="green")
-    else:
-        mini_card(s1, "Água (Total)", compacto_br(agua_total), icon="🚰", accent="green")
-        mini_card(s2, "Coleta de Lixo (Total)", compacto_br(lixo_total), icon="🗑️", accent="green")
-        mini_card(s3, "Esgoto Pluvial (Total)", compacto_br(pluvial_total), icon="💧", accent="green")
-        mini_card(s4, "Esgoto Cloacal (Total)", compacto_br(cloacal_total), icon="🪠", accent="green")
-        mini_card(s5, "Fossa Séptica (Total)", compacto_br(fossa_total), icon="🕳️", accent="green")
-        mini_card(s6, "Condomínios (Total)", compacto_br(condo_total), icon="🏢", accent="green")
-
-    # ---------- IMÓVEIS ----------
-    st.markdown('<div class="painel-sec-titulo">Imóveis</div>', unsafe_allow_html=True)
-
-    def _cond1_count(gdf):
-        if gdf is None or len(gdf) == 0: return 0
-        s = pd.to_numeric(gdf.get('Condom', 0), errors='coerce').fillna(0).astype(int)
-        return int((s == 1).sum())
-
-    imoveis_ating = len(imoveis_atingidos_gdf) if (modo_atingidos and imoveis_atingidos_gdf is not None) else 0
-    cond1_total   = _cond1_count(_to_point_gdf(imoveis_gdf)) if imoveis_gdf is not None else 0
-    cond1_ating   = _cond1_count(imoveis_atingidos_gdf) if (modo_atingidos and imoveis_atingidos_gdf is not None) else 0
-    p_imoveis     = (imoveis_ating / total_imoveis * 100) if total_imoveis > 0 else 0
-    p_cond1       = (cond1_ating / cond1_total * 100) if cond1_total > 0 else 0
-
-    ci1, ci2 = st.columns(2)
-    if mostrar_imoveis_atingidos:
-        mini_card(ci1, "Imóveis Atingidos", compacto_br(imoveis_ating),
-                  f"de {compacto_br(total_imoveis)} ({pct_int(p_imoveis)})", icon="🏠", accent="purple")
-        mini_card(ci2, "Condomínios", compacto_br(cond1_ating),
-                  f"de {compacto_br(cond1_total)} ({pct_int(p_cond1)})", icon="🏢", accent="purple")
-    else:
-        mini_card(ci1, "Imóveis (Total)", compacto_br(total_imoveis), icon="🏠", accent="purple")
-        mini_card(ci2, "Condomínios", compacto_br(cond1_total), icon="🏢", accent="purple")
-
-    def _counts_dict(gdf, col):
-        if gdf is None or len(gdf) == 0 or (col not in gdf.columns): return {}
-        s_raw = gdf[col].astype(str).str.strip()
-        s_norm = s_raw.str.lower()
-        outros_tokens = {"", "none", "nan", "na", "null", "sem informação", "sem informacao", "outro", "outros"}
-        mask_outros = s_norm.isin(outros_tokens)
-        labels = {}
-        for raw, n in zip(s_raw[~mask_outros], s_norm[~mask_outros]):
-            if n not in labels and raw != "": labels[n] = raw
-        counts = s_norm[~mask_outros].value_counts().to_dict()
-        out = {labels[k]: int(v) for k, v in counts.items() if k in labels}
-        outros_count = int(mask_outros.sum())
-        if outros_count > 0: out["Outros"] = out.get("Outros", 0) + outros_count
-        return out
-
-    def _render_table_expander(titulo, total_dict, ating_dict=None):
-        labels = sorted(total_dict.keys(), key=lambda k: (-total_dict[k], k))
-        rows = []
-        for lb in labels:
-            tot = int(total_dict.get(lb, 0))
+        total_seguranca, seguranca_ating = _total_atingido(_fatia(cubo_impacto, "Segurança", filtros_ativos.get("Segurança")))
+        perc_seguranca  = (seguranca_ating / total_seguranca * 100) if total_seguranca > 0 else 0
+
+        ps1, ps2 = _linha(2)
+        if mostrar_predios_atingidos:
+            mini_card(ps1, "Prédios Públicos Atingidos", compacto_br(predios_ating),
+                      f"de {compacto_br(total_predios)} ({pct_int(perc_predios)})", icon="🏛️", accent="teal")
+        else:
+            mini_card(ps1, "Prédios Públicos (Total)", compacto_br(total_predios), icon="🏛️", accent="teal")
+
+        if mostrar_seguranca_atingida:
+            mini_card(ps2, "Unidades de Segurança Atingidas", compacto_br(seguranca_ating),
+                      f"de {compacto_br(total_seguranca)} ({pct_int(perc_seguranca)})", icon="🛡️", accent="gray")
+        else:
+            mini_card(ps2, "Unidades de Segurança (Total)", compacto_br(total_seguranca), icon="🛡️", accent="gray")
+        _render_secao("Prédios Públicos e Segurança", [ps1, ps2])
+
+        # ---------- RUAS ----------
+        total_segmentos = len(logradouros_gdf) if logradouros_gdf is not None else 0
+        total_ruas_unicas_calc = (logradouros_gdf['_rua_id_interno'].nunique()
+                                  if (logradouros_gdf is not None and '_rua_id_interno' in logradouros_gdf.columns)
+                                  else total_segmentos)
+        if modo_atingidos and (logradouros_atingidos_gdf is not None):
+            seg_ating = len(logradouros_atingidos_gdf)
+            ruas_ating = (logradouros_atingidos_gdf['_rua_id_interno'].nunique()
+                          if '_rua_id_interno' in logradouros_atingidos_gdf.columns else 0)
+        else:
+            seg_ating, ruas_ating = 0, 0
+        perc_seg = (seg_ating / total_segmentos * 100) if total_segmentos > 0 else 0
+        perc_rua = (ruas_ating / total_ruas_unicas_calc * 100) if total_ruas_unicas_calc > 0 else 0
+
+        ruas_tot = _somar_flags(logradouros_gdf, FLAGS_RUAS)
+        ruas_atg = (_somar_flags(logradouros_atingidos_gdf, FLAGS_RUAS)
+                    if (mostrar_ruas_atingidas and logradouros_atingidos_gdf is not None) else dict.fromkeys(FLAGS_RUAS, 0))
+        dren_total, ilum_total = ruas_tot["_f_drenagem"], ruas_tot["_f_iluminacao"]
+        dren_ating, ilum_ating = ruas_atg["_f_drenagem"], ruas_atg["_f_iluminacao"]
+        p_dren = (dren_ating / dren_total * 100) if dren_total > 0 else 0
+        p_ilum = (ilum_ating / ilum_total * 100) if ilum_total > 0 else 0
+
+        i1, i2, i3, i4 = _linha(4)
+        if mostrar_ruas_atingidas:
+            mini_card(i1, "Segmentos de Rua Atingidos", compacto_br(seg_ating),
+                      f"de {compacto_br(total_segmentos)} ({pct_int(perc_seg)})", icon="🛣️", accent="orange")
+            mini_card(i2, "Ruas Únicas Atingidas", compacto_br(ruas_ating),
+                      f"de {compacto_br(total_ruas_unicas_calc)} ({pct_int(perc_rua)})", icon="📍", accent="orange")
+            mini_card(i3, "Drenagem (Atingidos)", compacto_br(dren_ating),
+                      f"de {compacto_br(dren_total)} ({pct_int(p_dren)})", icon="🛠️", accent="orange")
+            mini_card(i4, "Iluminação (Atingidos)", compacto_br(ilum_ating),
+                      f"de {compacto_br(ilum_total)} ({pct_int(p_ilum)})", icon="💡", accent="orange")
+        else:
+            mini_card(i1, "Segmentos de Rua (Total)", compacto_br(total_segmentos), icon="🛣️", accent="orange")
+            mini_card(i2, "Ruas Únicas (Total)", compacto_br(total_ruas_unicas_calc), icon="📍", accent="orange")
+            mini_card(i3, "Drenagem (Total)", compacto_br(dren_total), icon="🛠️", accent="orange")
+            mini_card(i4, "Iluminação (Total)", compacto_br(ilum_total), icon="💡", accent="orange")
+        _render_secao("Ruas", [i1, i2, i3, i4])
+
+        if mostrar_ruas_atingidas and (logradouros_atingidos_gdf is not None) and (not logradouros_atingidos_gdf.empty):
+            with st.expander("📋 Lista de Ruas Atingidas", expanded=False):
+                tmp = logradouros_atingidos_gdf.copy()
+                if 'tipo' not in tmp.columns: tmp['tipo'] = ''
+                if 'nome' not in tmp.columns: tmp['nome'] = tmp.get('_rua_id_interno', tmp.index.astype(str))
+                if '_rua_id_interno' not in tmp.columns:
+                    tmp['_rua_id_interno'] = (tmp['tipo'].astype(str).str.strip() + ' ' + tmp['nome'].astype(str).str.strip()).str.strip()
+                df_ruas = (
+                    tmp.groupby(['_rua_id_interno','tipo','nome'], dropna=False)
+                    .size().reset_index(name='Segmentos Atingidos')
+                    .sort_values(['Segmentos Atingidos','tipo','nome'], ascending=[False, True, True])
+                    .reset_index(drop=True)
+                )
+                st.dataframe(
+                    df_ruas[['tipo','nome','Segmentos Atingidos']].rename(
+                        columns={'tipo': 'Tipo','nome': 'Nome da Rua','Segmentos Atingidos': '# Segmentos Atingidos'}
+                    ),
+                    use_container_width=True, hide_index=True
+                )
+
+        # ---------- CONECTIVIDADE VIÁRIA ----------
+        if modo_atingidos and (conectividade is not None):
+            n_quad_iso = len(quadras_isoladas_gdf) if quadras_isoladas_gdf is not None else 0
+            n_esc_iso  = len(escolas_isoladas_gdf) if escolas_isoladas_gdf is not None else 0
+            n_sau_iso  = len(saude_isolada_gdf)    if saude_isolada_gdf    is not None else 0
+            cv1, cv2, cv3, cv4 = _linha(4)
+            mini_card(cv1, "Quadras Isoladas", compacto_br(n_quad_iso), "fora da mancha, sem acesso viário", icon="🧩", accent="orange")
+            mini_card(cv2, "Escolas Isoladas", compacto_br(n_esc_iso), "fora da mancha, sem acesso viário", icon="🏫", accent="orange")
+            mini_card(cv3, "Unidades de Saúde Isoladas", compacto_br(n_sau_iso), "fora da mancha, sem acesso viário", icon="🏥", accent="orange")
+            mini_card(cv4, "Componentes da Malha", compacto_br(conectividade["n_componentes"]),
+                      f"de {compacto_br(conectividade['n_componentes_base'])} sem inundação", icon="🕸️", accent="orange")
+            _render_secao("Conectividade Viária", [cv1, cv2, cv3, cv4])
+
+            if n_esc_iso or n_sau_iso:
+                with st.expander("📋 Escolas e Unidades de Saúde Isoladas", expanded=False):
+                    partes = []
+                    if n_esc_iso and "NO_ENTIDADE" in escolas_isoladas_gdf.columns:
+                        partes.append(pd.DataFrame({"Tipo": "Escola", "Nome": escolas_isoladas_gdf["NO_ENTIDADE"].astype(str)}))
+                    if n_sau_iso and "NO_FANTASIA" in saude_isolada_gdf.columns:
+                        partes.append(pd.DataFrame({"Tipo": "Saúde", "Nome": saude_isolada_gdf["NO_FANTASIA"].astype(str)}))
+                    if partes:
+                        st.dataframe(pd.concat(partes, ignore_index=True), use_container_width=True, hide_index=True)
+
+        # ---------- TERRENOS & QUADRAS ----------
+        tq1, tq2, tq3, tq4 = _linha(4)
+        fatia_terr = _fatia(cubo_impacto, "Terrenos")
+        _, terr_ating = _total_atingido(fatia_terr)
+        _, quad_ating = _total_atingido(_fatia(cubo_impacto, "Quadras"))
+        perc_terr = (terr_ating / total_terrenos * 100) if total_terrenos > 0 else 0
+        perc_quad = (quad_ating / total_quadras  * 100) if total_quadras  > 0 else 0
+
+        if mostrar_terrenos_atingidos:
+            mini_card(tq1, "Terrenos Atingidos", compacto_br(terr_ating),
+                      f"de {compacto_br(total_terrenos)} ({pct_int(perc_terr)})", icon="🧱", accent="green")
+            mini_card(tq2, "Quadras Atingidas", compacto_br(quad_ating),
+                      f"de {compacto_br(total_quadras)} ({pct_int(perc_quad)})", icon="🧩", accent="purple")
+        else:
+            mini_card(tq1, "Terrenos (Total)", compacto_br(total_terrenos), icon="🧱", accent="green")
+            mini_card(tq2, "Quadras (Total)", compacto_br(total_quadras), icon="🧩", accent="purple")
+
+        # ----- Serviços nos Terrenos -----
+        terr_tot, terr_atg = {}, {}
+        for f in FLAGS_TERRENOS:
+            terr_tot[f], terr_atg[f] = (int(v) for v in _total_atingido(fatia_terr, f))
+        agua_total, agua_ating       = terr_tot["_f_agua"],           terr_atg["_f_agua"]
+        lixo_total, lixo_ating       = terr_tot["_f_coleta_lix"],     terr_atg["_f_coleta_lix"]
+        pluvial_total, pluvial_ating = terr_tot["_f_esgoto_plu"],     terr_atg["_f_esgoto_plu"]
+        condo_total, condo_ating     = terr_tot["_f_condominio"],     terr_atg["_f_condominio"]
+        cloacal_total, cloacal_ating = terr_tot["_f_esgoto_cloacal"], terr_atg["_f_esgoto_cloacal"]
+        fossa_total, fossa_ating     = terr_tot["_f_fossa_septica"],  terr_atg["_f_fossa_septica"]
+
+        p_agua    = (agua_ating    / agua_total * 100)    if agua_total    > 0 else 0
+        p_lixo    = (lixo_ating    / lixo_total * 100)    if lixo_total    > 0 else 0
+        p_pluvial = (pluvial_ating / pluvial_total * 100) if pluvial_total > 0 else 0
+        p_condo   = (condo_ating   / condo_total * 100)   if condo_total   > 0 else 0
+        p_cloacal = (cloacal_ating / cloacal_total * 100) if cloacal_total > 0 else 0
+        p_fossa   = (fossa_ating   / fossa_total * 100)   if fossa_total   > 0 else 0
+
+        s1, s2, s3 = _linha(3)
+        s4, s5, s6 = _linha(3)
+        if mostrar_terrenos_atingidos:
+            mini_card(s1, "Água (Atingidos)", compacto_br(agua_ating),
+                      f"de {compacto_br(agua_total)} ({pct_int(p_agua)})", icon="🚰", accent="green")
+            mini_card(s2, "Coleta de Lixo (Atingidos)", compacto_br(lixo_ating),
+                      f"de {compacto_br(lixo_total)} ({pct_int(p_lixo)})", icon="🗑️", accent="green")
+            mini_card(s3, "Esgoto Pluvial (Atingidos)", compacto_br(pluvial_ating),
+                      f"de {compacto_br(pluvial_total)} ({pct_int(p_pluvial)})", icon="💧", accent="green")
+            mini_card(s4, "Esgoto Cloacal (Atingidos)", compacto_br(cloacal_ating),
+                      f"de {compacto_br(cloacal_total)} ({pct_int(p_cloacal)})", icon="🪠", accent="green")
+            mini_card(s5, "Fossa Séptica (Atingidos)", compacto_br(fossa_ating),
+                      f"de {compacto_br(fossa_total)} ({pct_int(p_fossa)})", icon="🕳️", accent="green")
+            mini_card(s6, "Condomínios (Atingidos)", compacto_br(condo_ating),
+                      f"de {compacto_br(condo_total)} ({pct_int(p_condo)})", icon="🏢", accent="green")
+        else:
+            mini_card(s1, "Água (Total)", compacto_br(agua_total), icon="🚰", accent="green")
+            mini_card(s2, "Coleta de Lixo (Total)", compacto_br(lixo_total), icon="🗑️", accent="green")
+            mini_card(s3, "Esgoto Pluvial (Total)", compacto_br(pluvial_total), icon="💧", accent="green")
+            mini_card(s4, "Esgoto Cloacal (Total)", compacto_br(cloacal_total), icon="🪠", accent="green")
+            mini_card(s5, "Fossa Séptica (Total)", compacto_br(fossa_total), icon="🕳️", accent="green")
+            mini_card(s6, "Condomínios (Total)", compacto_br(condo_total), icon="🏢", accent="green")
+        _render_secao("Terrenos e Quadras", [tq1, tq2, tq3, tq4], [s1, s2, s3], [s4, s5, s6])
+
+        # ---------- IMÓVEIS ----------
+
+        fatia_imv = _fatia(cubo_impacto, "Imóveis")
+        _, imoveis_ating          = _total_atingido(fatia_imv)
+        cond1_total, cond1_ating  = _total_atingido(fatia_imv, "_f_condom")
+        p_imoveis     = (imoveis_ating / total_imoveis * 100) if total_imoveis > 0 else 0
+        p_cond1       = (cond1_ating / cond1_total * 100) if cond1_total > 0 else 0
+
+        ci1, ci2 = _linha(2)
+        if mostrar_imoveis_atingidos:
+            mini_card(ci1, "Imóveis Atingidos", compacto_br(imoveis_ating),
+                      f"de {compacto_br(total_imoveis)} ({pct_int(p_imoveis)})", icon="🏠", accent="purple")
+            mini_card(ci2, "Condomínios", compacto_br(cond1_ating),
+                      f"de {compacto_br(cond1_total)} ({pct_int(p_cond1)})", icon="🏢", accent="purple")
+        else:
+            mini_card(ci1, "Imóveis (Total)", compacto_br(total_imoveis), icon="🏠", accent="purple")
+            mini_card(ci2, "Condomínios", compacto_br(cond1_total), icon="🏢", accent="purple")
+        _render_secao("Imóveis", [ci1, ci2])
+
+        def _counts_dict(fatia, dim):
+            df = _por_categoria(fatia, dim)
+            return (dict(zip(df[dim], df["Total"].astype(int))),
+                    dict(zip(df[dim], df["Atingidos"].astype(int))) if modo_atingidos else None)
+
+        def _render_table_expander(titulo, total_dict, ating_dict=None):
+            labels = sorted(total_dict.keys(), key=lambda k: (-total_dict[k], k))
+            rows = []
+            for lb in labels:
+                tot = int(total_dict.get(lb, 0))
+                if (ating_dict is not None) and modo_atingidos:
+                    atg = int(ating_dict.get(lb, 0))
+                    perc = (atg / tot * 100) if tot else 0
+                    rows.append([lb, tot, atg, f"{perc:.1f}%"])
+                else:
+                    rows.append([lb, tot])
             if (ating_dict is not None) and modo_atingidos:
-                atg = int(ating_dict.get(lb, 0))
-                perc = (atg / tot * 100) if tot else 0
-                rows.append([lb, tot, atg, f"{perc:.1f}%"])
+                df = pd.DataFrame(rows, columns=["Categoria", "Total", "Atingidos", "% atingidos"])
             else:
-                rows.append([lb, tot])
-        if (ating_dict is not None) and modo_atingidos:
-            df = pd.DataFrame(rows, columns=["Categoria", "Total", "Atingidos", "% atingidos"])
-        else:
-            df = pd.DataFrame(rows, columns=["Categoria", "Total"])
-        with st.expander(titulo, expanded=False):
-            st.dataframe(df, use_container_width=True, hide_index=True)
+                df = pd.DataFrame(rows, columns=["Categoria", "Total"])
+            with st.expander(titulo, expanded=False):
+                st.dataframe(df, use_container_width=True, hide_index=True)
 
-    uso_total    = _counts_dict(_to_point_gdf(imoveis_gdf), "Uso") if imoveis_gdf is not None else {}
-    uso_ating    = _counts_dict(imoveis_atingidos_gdf, "Uso") if (modo_atingidos and imoveis_atingidos_gdf is not None) else None
-    patrim_total = _counts_dict(_to_point_gdf(imoveis_gdf), "Patrim") if imoveis_gdf is not None else {}
-    patrim_ating = _counts_dict(imoveis_atingidos_gdf, "Patrim") if (modo_atingidos and imoveis_atingidos_gdf is not None) else None
+        uso_total, uso_ating       = _counts_dict(fatia_imv, "_uso_cat")
+        patrim_total, patrim_ating = _counts_dict(fatia_imv, "_patrim_cat")
 
-    _render_table_expander("Imóveis por Tipo de Uso", uso_total, uso_ating)
-    _render_table_expander("Imóveis por Patrimônio", patrim_total, patrim_ating)
+        _render_table_expander("Imóveis por Tipo de Uso", uso_total, uso_ating)
+        _render_table_expander("Imóveis por Patrimônio", patrim_total, patrim_ating)
+
+        # ---------- EVACUAÇÃO (ESCOLAS COMO ABRIGO) ----------
+        if modo_evacuacao:
+            if evacuacao is None:
+                _render_secao("Evacuação (Escolas como Abrigo)")
+                st.info("Sem imóveis atingidos ou sem escolas fora da mancha para servir de abrigo.")
+            else:
+                sem_vaga = evacuacao["n_imoveis"] - evacuacao["n_alocados"]
+                ev1, ev2, ev3, ev4 = _linha(4)
+                mini_card(ev1, "Escolas-Abrigo", compacto_br(evacuacao["n_abrigos"]),
+                          f"{compacto_br(evacuacao['capacidade'])} pessoas de capacidade", icon="🏫", accent="purple")
+                mini_card(ev2, "Imóveis Alocados", compacto_br(evacuacao["n_alocados"]),
+                          f"de {compacto_br(evacuacao['n_imoveis'])} ({pct_int(evacuacao['n_alocados'] / evacuacao['n_imoveis'] * 100)})", icon="🏠", accent="purple")
+                mini_card(ev3, "Imóveis Sem Vaga", compacto_br(sem_vaga),
+                          f"{compacto_br(sem_vaga * pessoas_por_imovel)} pessoas", icon="⚠️", accent="purple")
+                mini_card(ev4, "Distância Média ao Abrigo", f"{br(evacuacao['dist_media_m'] / 1000, 1)} km", icon="📏", accent="purple")
+                _render_secao("Evacuação (Escolas como Abrigo)", [ev1, ev2, ev3, ev4])
+                with st.expander("📋 Excedente por Bairro", expanded=False):
+                    st.dataframe(evacuacao["por_bairro"], use_container_width=True, hide_index=True)
+                with st.expander("📋 Ocupação das Escolas-Abrigo", expanded=False):
+                    st.dataframe(evacuacao["ocupacao"], use_container_width=True, hide_index=True)
+
+painel_impacto()
 
 # ========= Mapa =========
 st.subheader("Mapa Interativo")
 
-def _latlon_from_row(row):
-    if hasattr(row, "geometry") and row.geometry is not None:
-        try:
-            x = getattr(row.geometry, "x", None)
-            y = getattr(row.geometry, "y", None)
-            if (x is not None) and (y is not None):
-                return (float(y), float(x))
-        except Exception:
-            pass
-    lat = row.get("latitude", None); lon = row.get("longitude", None)
-    if (lat is not None) and (lon is not None):
-        return (float(lat), float(lon))
-    lat = row.get("Latitude", None); lon = row.get("Longitude", None)
-    if (lat is not None) and (lon is not None):
-        try:
-            return (float(lat), float(lon))
-        except Exception:
-            return None
-    return None
-
-def _cluster(color_hex):
-    return MarkerCluster(
+def _latlon_array(gdf: gpd.GeoDataFrame) -> tuple[np.ndarray, np.ndarray]:
+    """(lat, lon) de todas as feições de uma vez: geometria de ponto ou colunas latitude/longitude (NaN se faltar)."""
+    lat = np.full(len(gdf), np.nan)
+    lon = np.full(len(gdf), np.nan)
+    if isinstance(gdf, gpd.GeoDataFrame) and gdf.geometry.name in gdf.columns:
+        g = gdf.geometry.values
+        ponto = (shapely.get_type_id(g) == 0) & ~shapely.is_empty(g)
+        lon[ponto], lat[ponto] = shapely.get_x(g[ponto]), shapely.get_y(g[ponto])
+    for c_lat, c_lon in (("latitude", "longitude"), ("Latitude", "Longitude")):
+        if c_lat in gdf.columns and c_lon in gdf.columns:
+            falta = np.isnan(lat) | np.isnan(lon)
+            lat[falta] = pd.to_numeric(gdf[c_lat], errors="coerce").to_numpy(dtype=float)[falta]
+            lon[falta] = pd.to_numeric(gdf[c_lon], errors="coerce").to_numpy(dtype=float)[falta]
+    return lat, lon
+
+def _textos(gdf: pd.DataFrame, col: str, padrao="N/A", fmt=str) -> list[str]:
+    """Coluna formatada como texto para o popup (valor padrão se a coluna não existir)."""
+    if col not in gdf.columns:
+        return [str(padrao)] * len(gdf)
+    return [fmt(v) for v in gdf[col].tolist()]
+
+def _cluster(color_hex, gdf, campos, icones, idx_icone=None, max_width=300):
+    """
+    Camada de pontos em lote: coordenadas, índice do ícone e textos do popup vão num único array
+    ([[lat, lon, i_icone, texto_1, ...], ...]) e um só callback JS cria marcador e popup no navegador
+    (FastMarkerCluster), com o círculo de cluster na cor da camada.
+      - campos: [(rótulo, textos por linha)] -> popup "<b>rótulo:</b> texto", um por linha;
+      - icones: opções de icone_mapa (ou None = marcador padrão); idx_icone: ícone de cada linha (padrão 0).
+    """
+    lat, lon = _latlon_array(gdf)
+    ok = ~(np.isnan(lat) | np.isnan(lon))
+    idx = np.zeros(len(gdf), dtype=int) if idx_icone is None else np.asarray(idx_icone, dtype=int)
+    colunas = [lat[ok].tolist(), lon[ok].tolist(), idx[ok].tolist()]
+    colunas += [[t for t, v in zip(textos, ok) if v] for _, textos in campos]
+    # FastMarkerCluster emite "var callback = <expressão>;": a função fica numa IIFE que fecha ícones e rótulos
+    callback = f"""(function () {{
+        var icones = {json.dumps(icones)}.map(function (o) {{
+            return o ? L.divIcon(o) : new L.Icon.Default();
+        }});
+        var rotulos = {json.dumps([r for r, _ in campos], ensure_ascii=False)};
+        return function (row) {{
+            var marker = L.marker(new L.LatLng(row[0], row[1]), {{icon: icones[row[2]]}});
+            var linhas = rotulos.map(function (r, j) {{ return "<b>" + r + ":</b> " + row[j + 3]; }});
+            if (linhas.length) {{ marker.bindPopup(linhas.join("<br>"), {{maxWidth: {int(max_width)}}}); }}
+            return marker;
+        }};
+    }})()"""
+    return FastMarkerCluster(
+        [list(r) for r in zip(*colunas)],
+        callback=callback,
         name="",
         icon_create_function=f"""
         function (cluster) {{
@@ -1203,201 +1949,991 @@ def _cluster(color_hex):
         """
     )
 
-with st.spinner("Atualizando mapa..."):
-    m = folium.Map(location=[-32.0540, -52.1150], zoom_start=13, tiles="CartoDB positron")
-
-    if mancha_selecionada_gdf is not None:
-        folium.GeoJson(
-            mancha_selecionada_gdf,
-            name=selecao_mancha_nome,
-            show=True,
-            tooltip=selecao_mancha_nome,
-            style_function=lambda x: {'color': 'blue', 'weight': 1.5, 'fillColor': '#3186cc', 'fillOpacity': 0.6}
-        ).add_to(m)
-
-    # Empresas
-    empresas_para_plotar = (
-        empresas_atingidas_gdf if mostrar_empresas_atingidas else empresas_filtradas
-    )
-    if mostrar_empresas and (empresas_para_plotar is not None) and (not empresas_para_plotar.empty):
-        fg_empresas = folium.FeatureGroup(name="Empresas", show=True)
-        mc_emp = _cluster("#1976d2").add_to(fg_empresas)
-        icon_emp = get_custom_icon("Empresas", size=(28,28))
-        for _, row in empresas_para_plotar.iterrows():
-            ll = _latlon_from_row(row)
-            if ll is None:
-                continue
-            massa_salarial_pop = formatar_br(row.get('Massa_Salarial', 0))
-            media_salarial_pop = formatar_br(row.get('MédiaSalarial', 0))
-            popup_html = (
-                f"<b>ID:</b> {row.get('id', 'N/A')}<br>"
-                f"<b>Empregados:</b> {row.get('Empregados', 'N/A')}<br>"
-                f"<b>Massa Salarial:</b> R$ {massa_salarial_pop}<br>"
-                f"<b>Média Salarial:</b> R$ {media_salarial_pop}"
-            )
-            folium.Marker(location=ll, popup=folium.Popup(popup_html, max_width=300), icon=icon_emp).add_to(mc_emp)
-        fg_empresas.add_to(m)
+# ---- Serialização das camadas vetoriais (GeoJSON enxuto / TopoJSON) ----
+GEOJSON_CASAS = 5          # 1e-5° ≈ 1 m em Rio Grande: abaixo do que se distingue no zoom da cidade
+MAPA_TOPOJSON = os.environ.get("MAPA_TOPOJSON", "").lower() in ("1", "true", "sim")
 
-    # Saúde
-    saude_para_plotar = (
-        saude_atingida_gdf if mostrar_saude_atingida else saude_filtrada
-    )
-    if mostrar_saude and (saude_para_plotar is not None) and (not saude_para_plotar.empty):
-        fg_saude = folium.FeatureGroup(name="Saúde", show=True)
-        mc_saude = _cluster("#2e7d32").add_to(fg_saude)
-        icon_sau = get_custom_icon("Saude", size=(28,28))
-        for _, row in saude_para_plotar.iterrows():
-            ll = _latlon_from_row(row)
-            if ll is None:
-                try:
-                    geom = row.geometry
-                    ll = (float(geom.y), float(geom.x))
-                except Exception:
-                    continue
-            nome  = row.get('NO_FANTASIA', 'Sem Nome')
-            bairro = row.get('NO_BAIRRO', '—')
-            lograd = row.get('NO_LOGRADOURO', '—')
-            numero = row.get('NU_ENDERECO', '—')
-            popup_html = (f"<b>Nome:</b> {nome}<br><b>Bairro:</b> {bairro}<br><b>Logradouro:</b> {lograd}<br><b>Número:</b> {numero}")
-            folium.Marker(location=ll, popup=folium.Popup(popup_html, max_width=320), icon=icon_sau).add_to(mc_saude)
-        fg_saude.add_to(m)
-
-    # Educação (FIX: sem fallback quando "Atingidos" estiver marcado)
-    educacao_para_plotar = (
-        educacao_atingida_gdf if mostrar_educacao_atingida else educacao_filtrada
-    )
+def _geojson_enxuto(gdf: gpd.GeoDataFrame, campos: list[str], casas: int = GEOJSON_CASAS) -> gpd.GeoDataFrame:
+    """Só as colunas do tooltip + geometria em EPSG:4326 com coordenadas arredondadas (sem index_right etc.)."""
+    g = gdf.to_crs("EPSG:4326") if gdf.crs is not None and gdf.crs.to_epsg() != 4326 else gdf
+    geom = shapely.transform(g.geometry.values, lambda c: np.round(c, casas))
+    return gpd.GeoDataFrame(g[[c for c in campos if c in g.columns]].reset_index(drop=True),
+                            geometry=np.asarray(geom), crs="EPSG:4326")
 
-    if mostrar_educacao and (educacao_para_plotar is not None) and (not educacao_para_plotar.empty):
-        fg_edu = folium.FeatureGroup(name="Educação", show=True)
-        mc_edu = _cluster("#0d9488").add_to(fg_edu)  # teal
-        icon_edu = get_custom_icon("Escola", size=(28,28))
+def _topologia(gdf: gpd.GeoDataFrame, casas: int = GEOJSON_CASAS) -> dict:
+    """
+    Topologia quantizada (grade de 10^-casas graus, EPSG:4326): os anéis/linhas são cortados nas junções
+    (vértices cujos vizinhos diferem entre feições), e cada trecho comum a dois terrenos/quadras vira um
+    único arco, referenciado por ambos (~i quando percorrido ao contrário).
+      - 'arcos': coordenadas inteiras absolutas de cada arco;
+      - 'refs': feição -> {"aneis": {parte: [[arcos do anel], ...]}, "linhas": [[arcos], ...]}.
+    """
+    g = gdf.to_crs("EPSG:4326") if gdf.crs is not None and gdf.crs.to_epsg() != 4326 else gdf
+    k = 10.0 ** -casas
+    x0, y0 = np.floor(g.total_bounds[:2] / k) * k   # origem na grade: mesmas coordenadas do GeoJSON arredondado
+    q = shapely.transform(g.geometry.values, lambda c: np.rint((c - [x0, y0]) / k))
+
+    # linhas de cada feição: [(feição, parte, é anel, coords int64)]
+    linhas = []
+    for i, geom in enumerate(q):
+        for j, p in enumerate(shapely.get_parts(geom)):
+            if p.geom_type == "Polygon":
+                for r in [p.exterior, *p.interiors]:
+                    xy = np.asarray(r.coords, dtype=np.int64)
+                    xy = xy[np.r_[True, np.any(np.diff(xy, axis=0) != 0, axis=1)]]
+                    if len(xy) >= 4:
+                        linhas.append((i, j, True, xy))
+            elif p.geom_type == "LineString":
+                xy = np.asarray(p.coords, dtype=np.int64)
+                xy = xy[np.r_[True, np.any(np.diff(xy, axis=0) != 0, axis=1)]]
+                if len(xy) >= 2:
+                    linhas.append((i, j, False, xy))
+
+    # junções: vértice visto com pares de vizinhos diferentes, ou extremidade de linha
+    chave = lambda xy: xy[:, 0] * (1 << 32) + xy[:, 1]
+    pts, viz, pontas = [], [], []
+    for _, _, anel, xy in linhas:
+        c = chave(xy[:-1] if anel else xy)
+        if anel:
+            ant, prox = np.roll(c, 1), np.roll(c, -1)
+        else:
+            ant, prox = np.r_[c[:1], c[:-1]], np.r_[c[1:], c[-1:]]
+            pontas += [c[0], c[-1]]
+        pts.append(c)
+        viz.append(np.column_stack([np.minimum(ant, prox), np.maximum(ant, prox)]))
+    juncoes = set(pontas)
+    if pts:
+        trios = np.unique(np.column_stack([np.concatenate(pts), np.concatenate(viz)]), axis=0)
+        u, n = np.unique(trios[:, 0], return_counts=True)
+        juncoes |= set(u[n > 1].tolist())
+
+    arcos, indice = [], {}
+    def _arco(xy: np.ndarray) -> int:
+        ida, volta = xy.tobytes(), xy[::-1].tobytes()
+        if ida in indice:
+            return indice[ida]
+        if volta in indice:
+            return ~indice[volta]
+        indice[ida] = len(arcos)
+        arcos.append(xy)
+        return indice[ida]
+
+    refs: dict[int, dict] = {}
+    for i, j, anel, xy in linhas:
+        c = chave(xy[:-1] if anel else xy)
+        corte = np.flatnonzero(np.isin(c, list(juncoes)))
+        if anel:
+            if len(corte) == 0:
+                # anel sem junções: começa no menor vértice para que anéis iguais virem o mesmo arco
+                m = int(np.lexsort((xy[:-1, 1], xy[:-1, 0]))[0])
+                partes = [np.vstack([xy[m:-1], xy[:m + 1]])]
+            else:
+                base = np.vstack([xy[corte[0]:-1], xy[:corte[0] + 1]])
+                cortes = np.r_[corte - corte[0], len(base) - 1]
+                partes = [base[a:b + 1] for a, b in zip(cortes[:-1], cortes[1:])]
+        else:
+            cortes = np.unique(np.r_[0, corte, len(xy) - 1])
+            partes = [xy[a:b + 1] for a, b in zip(cortes[:-1], cortes[1:])]
+        r = refs.setdefault(i, {"aneis": {}, "linhas": []})
+        if anel:
+            r["aneis"].setdefault(j, []).append([_arco(p) for p in partes])
+        else:
+            r["linhas"].append([_arco(p) for p in partes])
+    return {"k": k, "x0": float(x0), "y0": float(y0), "n": len(q), "arcos": arcos, "refs": refs}
+
+def _simplificar_arcos(arcos: list[np.ndarray], tolerancia: float) -> list[np.ndarray]:
+    """Douglas-Peucker em cada arco (extremidades fixas): trechos compartilhados simplificam igual dos dois lados."""
+    if tolerancia <= 0 or not arcos:
+        return arcos
+    simples = shapely.simplify(np.array([shapely.LineString(a) for a in arcos], dtype=object), tolerancia,
+                               preserve_topology=False)
+    return [np.rint(shapely.get_coordinates(s)).astype(np.int64) for s in simples]
+
+def _montar_geometrias(topo: dict, arcos: list[np.ndarray]) -> np.ndarray:
+    """Geometrias (EPSG:4326) a partir das referências da topologia; anel que colapsa volta aos arcos originais."""
+    k, x0, y0 = topo["k"], topo["x0"], topo["y0"]
+    def _linha(ids, fonte):
+        pts = [fonte[a] if a >= 0 else fonte[~a][::-1] for a in ids]
+        return np.vstack([pts[0]] + [p[1:] for p in pts[1:]]) * k + [x0, y0]
+    def _anel(ids):
+        xy = _linha(ids, arcos)
+        if len(xy) >= 4 and shapely.area(shapely.Polygon(xy)) > 0:
+            return xy
+        return _linha(ids, topo["arcos"])
+    geoms = np.full(topo["n"], None, dtype=object)
+    for i, r in topo["refs"].items():
+        if r["aneis"]:
+            pols = [shapely.Polygon(_anel(aneis[0]), [_anel(a) for a in aneis[1:]]) for aneis in r["aneis"].values()]
+            geoms[i] = pols[0] if len(pols) == 1 else shapely.MultiPolygon(pols)
+        elif r["linhas"]:
+            lins = [shapely.LineString(_linha(ids, arcos)) for ids in r["linhas"]]
+            geoms[i] = lins[0] if len(lins) == 1 else shapely.MultiLineString(lins)
+    return geoms
+
+def _topojson(gdf: gpd.GeoDataFrame, campos: list[str], objeto: str, casas: int = GEOJSON_CASAS) -> dict:
+    """TopoJSON quantizado e com arcos compartilhados (ver _topologia), arcos em delta como no topojson-client."""
+    g = gdf.to_crs("EPSG:4326") if gdf.crs is not None and gdf.crs.to_epsg() != 4326 else gdf
+    topo = _topologia(g, casas)
+    valores = {c: g[c].tolist() for c in campos if c in g.columns}
+    geometrias = []
+    for i, r in sorted(topo["refs"].items()):
+        poligonos, segmentos = list(r["aneis"].values()), r["linhas"]
+        if poligonos:
+            item = ({"type": "Polygon", "arcs": poligonos[0]} if len(poligonos) == 1
+                    else {"type": "MultiPolygon", "arcs": poligonos})
+        elif segmentos:
+            item = ({"type": "LineString", "arcs": segmentos[0]} if len(segmentos) == 1
+                    else {"type": "MultiLineString", "arcs": segmentos})
+        item["properties"] = {c: (None if pd.isna(v[i]) else v[i]) for c, v in valores.items()}
+        geometrias.append(item)
+    return {
+        "type": "Topology",
+        "transform": {"scale": [topo["k"], topo["k"]], "translate": [topo["x0"], topo["y0"]]},
+        "objects": {objeto: {"type": "GeometryCollection", "geometries": geometrias}},
+        "arcs": [np.vstack([a[:1], np.diff(a, axis=0)]).tolist() for a in topo["arcos"]],
+    }
+
+# ---- Nível de detalhe (LOD) pelo zoom do mapa: só o desenho usa as cópias simplificadas ----
+NIVEIS_LOD = ((12, 20.0), (13, 8.0), (14, 4.0), (15, 1.5))   # (zoom até, tolerância em metros); acima: resolução cheia
+
+def tolerancia_lod(zoom) -> float:
+    for ate, tol in NIVEIS_LOD:
+        if zoom is not None and zoom <= ate:
+            return tol
+    return 0.0
+
+@st.cache_resource(show_spinner=False, max_entries=64)
+def geometrias_lod(nome: str, chave_cenario, assinatura, tolerancia: float, _gdf: gpd.GeoDataFrame) -> gpd.GeoDataFrame:
+    """
+    Cópia simplificada de _gdf para desenho (por camada, cenário/assinatura e tolerância). A simplificação é feita nos
+    arcos da topologia, então vizinhos continuam encaixados (sem frestas/sobreposições entre terrenos/quadras).
+    As análises continuam na geometria completa.
+    """
+    g = _gdf.to_crs("EPSG:4326") if _gdf.crs is not None and _gdf.crs.to_epsg() != 4326 else _gdf
+    if tolerancia <= 0 or len(g) == 0:
+        return g
+    topo = _topologia(g)
+    # metros -> unidades da grade (10^-casas graus; 1° de latitude ≈ 111,32 km)
+    arcos = _simplificar_arcos(topo["arcos"], tolerancia / (111_320 * topo["k"]))
+    geoms = _montar_geometrias(topo, arcos)
+    vazio = pd.isna(geoms)
+    geoms[vazio] = g.geometry.values[vazio]
+    return gpd.GeoDataFrame(g.drop(columns=g.geometry.name), geometry=list(geoms), crs="EPSG:4326")
+
+def camada_vetorial(gdf: gpd.GeoDataFrame, nome: str, campos: list[str], aliases: list[str], estilo: dict,
+                    topologia: bool = False):
+    """GeoJson enxuto (ou TopoJson, com topologia=True e MAPA_TOPOJSON) com tooltip dos campos existentes."""
+    campos_ok = [c for c in campos if c in gdf.columns]
+    aliases_ok = [a for c, a in zip(campos, aliases) if c in gdf.columns]
+    # sem feições (ex.: nada na vista) o GeoJsonTooltip não tem de onde validar os campos
+    tooltip = folium.features.GeoJsonTooltip(fields=campos_ok, aliases=aliases_ok) if campos_ok and len(gdf) else None
+    if topologia and MAPA_TOPOJSON:
+        objeto = "".join(ch for ch in nome if ch.isalnum()) or "camada"
+        return folium.TopoJson(_topojson(gdf, campos_ok, objeto), f"objects.{objeto}", name=nome, show=True,
+                               tooltip=tooltip, style_function=lambda x: estilo)
+    return folium.GeoJson(_geojson_enxuto(gdf, campos_ok), name=nome, show=True,
+                          tooltip=tooltip, style_function=lambda x: estilo)
+
+# ---- Recorte pela vista do mapa e clusters de pontos no servidor ----
+MARGEM_VISTA = 0.5      # margem em torno da vista, em frações da largura/altura visíveis
+ZOOM_AGREGAR = 14       # até este zoom, camadas densas de pontos viram clusters calculados no servidor
+ZOOM_MIN_AGREGAR = 8    # nível mais afastado do índice de clusters (abaixo dele, usa-se este)
+LIMITE_PONTOS = 500     # ... quando houver mais pontos que isso na vista
+CELULA_PX = 64          # lado da célula de cluster, em pixels de tela
+
+def _caixa_vista(vista: dict, zoom: int) -> tuple | None:
+    """
+    (oeste, sul, leste, norte) da vista devolvida pelo st_folium, com margem e encaixada numa grade de
+    múltiplos do tamanho de tile no zoom: pequenos arrastos dentro da margem geram a mesma caixa (o mapa
+    sai idêntico e o componente não é remontado). None antes do primeiro retorno do mapa.
+    """
+    b = vista.get("bounds") or {}
+    sw, ne = b.get("_southWest") or {}, b.get("_northEast") or {}
+    try:
+        w, s, e, n = float(sw["lng"]), float(sw["lat"]), float(ne["lng"]), float(ne["lat"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    tile = 360.0 / 2 ** zoom
+    dx = max(np.ceil((e - w) / tile), 1) * tile
+    dy = max(np.ceil((n - s) / tile), 1) * tile
+    return (np.floor(w / dx - MARGEM_VISTA) * dx, np.floor(s / dy - MARGEM_VISTA) * dy,
+            np.ceil(e / dx + MARGEM_VISTA) * dx, np.ceil(n / dy + MARGEM_VISTA) * dy)
+
+def _na_vista(nome_camada: str, gdf: gpd.GeoDataFrame, caixa: tuple | None) -> gpd.GeoDataFrame:
+    """Só as feições de gdf (subconjunto da camada base) cujo envelope toca a caixa, pelo STRtree da camada."""
+    if caixa is None or gdf is None or gdf.empty or nome_camada not in CAMADAS_BASE:
+        return gdf
+    base_gdf, pontos = CAMADAS_BASE[nome_camada]
+    base4326, arvore = _indice_espacial(nome_camada, _assinatura_camada(nome_camada, base_gdf), base_gdf, pontos)
+    if not base4326.index.is_unique:
+        return gdf
+    dentro = np.zeros(len(base4326) + 1, dtype=bool)
+    dentro[arvore.query(shapely.box(*caixa))] = True
+    dentro[-1] = True   # linhas sem correspondência na camada base (get_indexer = -1) ficam
+    return gdf[dentro[base4326.index.get_indexer(gdf.index)]]
+
+def _mercator(lat: np.ndarray, lon: np.ndarray, zoom: int) -> tuple[np.ndarray, np.ndarray]:
+    """Coordenadas em pixels de tela (Web Mercator) no zoom dado."""
+    escala = 256 * 2 ** zoom
+    x = (lon + 180.0) / 360.0 * escala
+    s = np.sin(np.radians(np.clip(lat, -85.0511, 85.0511)))
+    y = (0.5 - np.log((1 + s) / (1 - s)) / (4 * np.pi)) * escala
+    return x, y
+
+def _na_caixa(lat: np.ndarray, lon: np.ndarray, caixa: tuple | None) -> np.ndarray:
+    if caixa is None:
+        return np.ones(len(lat), dtype=bool)
+    w, s, e, n = caixa
+    return (lon >= w) & (lon <= e) & (lat >= s) & (lat <= n)
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def indice_clusters(nome_camada: str, chave, assinatura, _gdf: gpd.GeoDataFrame) -> dict:
+    """
+    Índice hierárquico de clusters da camada (por cenário/filtros em 'chave'), no estilo do supercluster: cada nível,
+    de ZOOM_AGREGAR até ZOOM_MIN_AGREGAR, agrupa os clusters do nível de cima em células de CELULA_PX pixels, de modo
+    que todo cluster é a união exata de clusters do zoom seguinte.
+      - 'lat'/'lon': pontos válidos da camada;
+      - 'niveis': zoom -> array [[lat, lon, n, zoom de expansão], ...], com o centroide ponderado; a expansão é o
+        primeiro zoom em que o cluster se divide (ZOOM_AGREGAR + 1 = só nos marcadores individuais).
+    """
+    lat, lon = _latlon_array(_gdf)
+    ok = ~(np.isnan(lat) | np.isnan(lon))
+    lat, lon = lat[ok], lon[ok]
+    c_lat, c_lon, n = lat, lon, np.ones(len(lat))
+    expansao = np.full(len(lat), ZOOM_AGREGAR + 1)
+    niveis = {}
+    for z in range(ZOOM_AGREGAR, ZOOM_MIN_AGREGAR - 1, -1):
+        x, y = _mercator(c_lat, c_lon, z)
+        cel = (np.floor(x / CELULA_PX).astype(np.int64) << 32) + np.floor(y / CELULA_PX).astype(np.int64)
+        _, pai = np.unique(cel, return_inverse=True)
+        filhos = np.bincount(pai)
+        unico = np.empty(len(filhos), dtype=np.int64)
+        unico[pai] = np.arange(len(pai))   # para clusters de um só filho: esse filho
+        soma = np.bincount(pai, n)
+        c_lat, c_lon = np.bincount(pai, n * c_lat) / soma, np.bincount(pai, n * c_lon) / soma
+        expansao = np.where(filhos > 1, z + 1, expansao[unico])
+        n = soma
+        niveis[z] = np.column_stack([c_lat, c_lon, n, expansao])
+    return {"lat": lat, "lon": lon, "niveis": niveis}
+
+class _PontosAgregados(folium.map.Layer):
+    """Clusters [[lat, lon, n, zoom de expansão], ...] como círculos com a contagem, na cor da camada; o clique
+    aproxima o mapa até o zoom em que o cluster se divide."""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = (function () {
+                var grupo = L.featureGroup();
+                {{ this.dados|tojson }}.forEach(function (d) {
+                    var n = d[2], lado = n < 100 ? 34 : (n < 1000 ? 40 : 48);
+                    var rotulo = n < 1000 ? String(n) : (n / 1000).toFixed(1).replace(".", ",") + " K";
+                    L.marker([d[0], d[1]], {icon: L.divIcon({
+                        html: '<div style="background:{{ this.cor }}; color:#fff; width:' + lado + 'px; height:' + lado + 'px; border-radius:50%; display:flex; align-items:center; justify-content:center; font-weight:700;">' + rotulo + '</div>',
+                        className: 'custom-cluster',
+                        iconSize: new L.Point(lado, lado)
+                    })}).on("click", function () {
+                        {{ this.mapa.get_name() }}.setView([d[0], d[1]], d[3]);
+                    }).addTo(grupo);
+                });
+                return grupo;
+            })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, mapa: folium.Map, cor: str, dados: list, name=None, **kwargs):
+        super().__init__(name=name, **kwargs)
+        self._name = "PontosAgregados"
+        self.mapa = mapa
+        self.cor = cor
+        self.dados = dados
+
+def _agregados(m: folium.Map, cor: str, nome_camada: str, chave, gdf: gpd.GeoDataFrame, caixa: tuple | None, zoom: int):
+    """
+    Clusters do índice no zoom atual (só os da vista) quando o mapa está afastado e há mais de LIMITE_PONTOS
+    pontos na vista; None = desenhar o _cluster com os marcadores.
+    """
+    if zoom > ZOOM_AGREGAR or gdf is None or len(gdf) <= LIMITE_PONTOS:
+        return None
+    indice = indice_clusters(nome_camada, chave, _assinatura(gdf), gdf)
+    if np.count_nonzero(_na_caixa(indice["lat"], indice["lon"], caixa)) <= LIMITE_PONTOS:
+        return None
+    nivel = indice["niveis"][max(int(zoom), ZOOM_MIN_AGREGAR)]
+    nivel = nivel[_na_caixa(nivel[:, 0], nivel[:, 1], caixa)]
+    dados = [[la, lo, int(n), int(z)] for la, lo, n, z in np.round(nivel, 6).tolist()]
+    return _PontosAgregados(m, cor, dados, control=False)
+
+def _chave_pontos(nome_camada: str, atingidos: bool) -> tuple:
+    """Chave do índice de clusters: cenário (só quando a camada mostra os atingidos) + filtros ativos da camada."""
+    return (cenario_chave if atingidos else None, _chave_filtros(filtros_ativos.get(nome_camada)))
+
+# ---- Modo densidade (Empresas e Imóveis): grade quadrada em EPSG:31982 ----
+PESOS_DENSIDADE = {   # rótulo -> (coluna somada em cada célula, None = contagem; formato do valor)
+    "Contagem":       (None, compacto_br),
+    "Empregados":     ("Empregados", compacto_br),
+    "Massa Salarial": ("Massa_Salarial", lambda v: f"R$ {compacto_br(v)}"),
+}
+LADOS_DENSIDADE = ((12, 500), (14, 250))   # (zoom até, lado da célula em metros); acima: 100 m
+CORES_DENSIDADE = ("#fff5eb", "#fdd0a2", "#fdae6b", "#fd8d3c", "#e6550d", "#a63603")   # classes por quantil
+
+def lado_densidade(zoom) -> int:
+    for ate, lado in LADOS_DENSIDADE:
+        if zoom is not None and zoom <= ate:
+            return lado
+    return 100
+
+@st.cache_resource(show_spinner=False, max_entries=32)
+def grade_densidade(nome_camada: str, chave, assinatura, coluna_peso: str | None, lado: int, _gdf: gpd.GeoDataFrame,
+                    _mascara: np.ndarray | None, _membros) -> gpd.GeoDataFrame:
+    """
+    Células de 'lado' metros (EPSG:31982) com a soma de coluna_peso (ou a contagem) das feições sob os filtros
+    ('total') e das atingidas no cenário ('atingidos'), num único np.bincount cada; só células com feições,
+    devolvidas em EPSG:4326. 'chave' = cenário + filtros (define quando a grade é recalculada).
+    """
+    base4326, _ = _indice_espacial(nome_camada, assinatura, _gdf, True)
+    lat, lon = _latlon_array(base4326)
+    ok = ~(np.isnan(lat) | np.isnan(lon))
+    if _mascara is not None:
+        ok &= _mascara
+    atingido = np.zeros(len(base4326), dtype=bool)
+    if _membros is not None:
+        atingido[np.asarray(_membros, dtype=np.int64)] = True
+    if coluna_peso in base4326.columns:
+        peso = pd.to_numeric(base4326[coluna_peso], errors="coerce").fillna(0).to_numpy(dtype=float)
+    else:
+        peso = np.ones(len(base4326))
+    xy = gpd.GeoSeries(gpd.points_from_xy(lon[ok], lat[ok]), crs="EPSG:4326").to_crs(CRS_METRICO)
+    ix = np.floor(xy.x.to_numpy() / lado).astype(np.int64)
+    iy = np.floor(xy.y.to_numpy() / lado).astype(np.int64)
+    cel, inv = np.unique((ix << 32) + iy, return_inverse=True)
+    ix, iy = cel >> 32, cel & 0xFFFFFFFF
+    return gpd.GeoDataFrame(
+        {"total": np.bincount(inv, peso[ok], minlength=len(cel)),
+         "atingidos": np.bincount(inv, (peso * atingido)[ok], minlength=len(cel))},
+        geometry=shapely.box(ix * lado, iy * lado, (ix + 1) * lado, (iy + 1) * lado), crs=CRS_METRICO,
+    ).to_crs("EPSG:4326")
+
+def camada_densidade(grade: gpd.GeoDataFrame, nome: str, peso: str, atingidos: bool, caixa: tuple | None):
+    """
+    Coropleto leve da grade: cor pela classe (quantis de toda a grade, estáveis ao arrastar) dos atingidos ou do
+    total; só as células da vista. Tooltip com total, atingidos e % (com cenário). None se não houver células.
+    """
+    coluna = "atingidos" if atingidos else "total"
+    g = grade[grade[coluna] > 0]
+    if g.empty:
+        return None
+    limites = np.quantile(g[coluna], np.linspace(0, 1, len(CORES_DENSIDADE) + 1)[1:-1])
+    centro = shapely.centroid(g.geometry.values)
+    g = g[_na_caixa(shapely.get_y(centro), shapely.get_x(centro), caixa)]
+    fmt = PESOS_DENSIDADE[peso][1]
+    g = g.assign(cor=np.asarray(CORES_DENSIDADE)[np.searchsorted(limites, g[coluna], side="right")],
+                 Total=[fmt(v) for v in g["total"]], Atingidos=[fmt(v) for v in g["atingidos"]],
+                 pct=[f"{_pt_number(100 * a / t, 1)}%" if t else "—" for a, t in zip(g["atingidos"], g["total"])])
+    if atingidos:
+        campos, aliases = ["Total", "Atingidos", "pct"], [f"{peso} (total):", f"{peso} (atingidos):", "% atingido:"]
+    else:
+        campos, aliases = ["Total"], [f"{peso}:"]
+    tooltip = folium.features.GeoJsonTooltip(fields=campos, aliases=aliases) if len(g) else None
+    return folium.GeoJson(_geojson_enxuto(g, ["cor", *campos]), name=nome, show=True, tooltip=tooltip,
+                          style_function=lambda f: {"color": f["properties"]["cor"], "weight": 0.5,
+                                                    "fillColor": f["properties"]["cor"], "fillOpacity": 0.6})
+
+# ========= Tiles vetoriais locais (Ruas, Terrenos, Quadras) =========
+# Opcional: com TILES_PORTA definido, as camadas de linhas/polígonos saem do HTML do mapa e passam a ser
+# servidas como MVT por um pequeno servidor HTTP local, lendo MBTiles gerados em Dados/.cache_tiles.
+# O navegador só busca os tiles da vista/zoom atuais; o destaque do cenário é feito no estilo (cliente).
+PASTA_CACHE_TILES = os.path.join(pasta_dados, ".cache_tiles")
+TILES_PORTA = int(os.environ.get("TILES_PORTA", "0") or 0)
+TILES_URL = os.environ.get("TILES_URL", f"http://localhost:{TILES_PORTA}").rstrip("/")
+TILES_ZOOM = (11, 16)      # níveis pré-cortados; acima do máximo o Leaflet amplia os tiles do nível 16
+TILES_EXTENT = 4096        # resolução interna do tile (spec MVT)
+TILES_BUFFER = 64          # margem de recorte, em unidades do tile
+
+CAMADAS_TILES = {   # camada base -> (camada no MVT, campos do tooltip [(coluna, rótulo)])
+    "Ruas":     ("ruas",     [("tipo", "Tipo:"), ("nome", "Nome:")]),
+    "Terrenos": ("terrenos", [("area_lote", "Área do Lote (m²):")]),
+    "Quadras":  ("quadras",  [("id", "ID:"), ("area", "Área:"), ("area_m2", "Área (m²):")]),
+}
 
-        for _, row in educacao_para_plotar.iterrows():
-            ll = _latlon_from_row(row)
-            if ll is None:
+def _pb_varint(v: int) -> bytes:
+    out = bytearray()
+    while True:
+        b = v & 0x7F
+        v >>= 7
+        if v:
+            out.append(b | 0x80)
+        else:
+            out.append(b)
+            return bytes(out)
+
+def _pb_bytes(campo: int, dados: bytes) -> bytes:
+    return _pb_varint((campo << 3) | 2) + _pb_varint(len(dados)) + dados
+
+def _pb_uint(campo: int, v: int) -> bytes:
+    return _pb_varint(campo << 3) + _pb_varint(v)
+
+def _pb_packed(campo: int, valores) -> bytes:
+    return _pb_bytes(campo, b"".join(_pb_varint(int(v)) for v in valores))
+
+def _pb_valor(v) -> bytes:
+    """Value do MVT: string (1), double (3) ou sint64 (6)."""
+    if isinstance(v, (bool, np.bool_)):
+        return _pb_uint(7, int(v))
+    if isinstance(v, (int, np.integer)):
+        v = int(v)
+        return _pb_uint(6, (v << 1) ^ (v >> 63))
+    if isinstance(v, (float, np.floating)):
+        return _pb_varint((3 << 3) | 1) + struct.pack("<d", float(v))
+    return _pb_bytes(1, str(v).encode("utf-8"))
+
+def _zigzag(d: np.ndarray) -> np.ndarray:
+    return (d << 1) ^ (d >> 63)
+
+def _comandos_linha(xy: np.ndarray, cursor: list, anel: bool) -> list[int]:
+    """MoveTo + LineTo (+ ClosePath) relativos ao cursor; pontos repetidos após o arredondamento são removidos."""
+    xy = np.rint(xy).astype(np.int64)
+    if anel:
+        xy = xy[:-1]
+    if len(xy) > 1:
+        xy = xy[np.r_[True, np.any(np.diff(xy, axis=0) != 0, axis=1)]]
+    if len(xy) < (3 if anel else 2):
+        return []
+    d = np.diff(np.vstack([cursor, xy]), axis=0)
+    cursor[:] = xy[-1]
+    cmd = [9, *_zigzag(d[0]).tolist(), 2 | ((len(xy) - 1) << 3), *_zigzag(d[1:]).ravel().tolist()]
+    return cmd + [15] if anel else cmd
+
+def _geometria_mvt(geom, cursor: list) -> tuple[int, list[int]]:
+    """(tipo MVT, comandos) de uma geometria já em coordenadas do tile; tipo 0 = nada a desenhar."""
+    partes = shapely.get_parts(geom)
+    tipos = shapely.get_type_id(partes)
+    cmds: list[int] = []
+    if np.isin(tipos, (3, 6)).any():
+        for p in partes[np.isin(tipos, (3, 6))]:
+            aneis = [np.asarray(p.exterior.coords)] + [np.asarray(r.coords) for r in p.interiors]
+            for i, xy in enumerate(aneis):
+                # spec MVT: anel externo com área positiva (fórmula do agrimensor, y para baixo), furos negativa
+                area = np.sum(xy[:-1, 0] * xy[1:, 1] - xy[1:, 0] * xy[:-1, 1])
+                if area == 0:
+                    if i == 0:
+                        break
+                    continue
+                if (area > 0) != (i == 0):
+                    xy = xy[::-1]
+                c = _comandos_linha(xy, cursor, anel=True)
+                if not c and i == 0:
+                    break
+                cmds += c
+        return (3 if cmds else 0), cmds
+    for p in partes[np.isin(tipos, (1, 2, 5))]:
+        cmds += _comandos_linha(np.asarray(p.coords), cursor, anel=False)
+    return (2 if cmds else 0), cmds
+
+def _tile_mvt(camada: str, geoms, props: list[dict], fids: np.ndarray) -> bytes | None:
+    """Uma camada MVT (versão 2) com as feições já recortadas e em coordenadas do tile."""
+    chaves, valores, feicoes = {}, {}, []
+    for geom, prop, fid in zip(geoms, props, fids):
+        tipo, cmds = _geometria_mvt(geom, [0, 0])
+        if not tipo:
+            continue
+        tags = []
+        for k, v in prop.items():
+            if v is None or (isinstance(v, float) and np.isnan(v)):
                 continue
+            tags += [chaves.setdefault(k, len(chaves)), valores.setdefault((type(v).__name__, v), len(valores))]
+        feicoes.append(_pb_uint(1, int(fid)) + _pb_packed(2, tags) + _pb_uint(3, tipo) + _pb_packed(4, cmds))
+    if not feicoes:
+        return None
+    corpo = (_pb_uint(15, 2) + _pb_bytes(1, camada.encode("utf-8"))
+             + b"".join(_pb_bytes(2, f) for f in feicoes)
+             + b"".join(_pb_bytes(3, k.encode("utf-8")) for k in chaves)
+             + b"".join(_pb_bytes(4, _pb_valor(v)) for (_, v) in valores)
+             + _pb_uint(5, TILES_EXTENT))
+    return _pb_bytes(3, corpo)
+
+@st.cache_resource(show_spinner=False)
+def construir_mbtiles(nome_camada: str, assinatura, assinatura_cenarios: tuple, _gdf: gpd.GeoDataFrame,
+                      _bits: np.ndarray) -> str | None:
+    """
+    Corta a camada em tiles MVT (TILES_ZOOM) num MBTiles em Dados/.cache_tiles/<camada>.mbtiles.
+    Cada feição leva 'fid' (posição na camada base), 'cen' (bit k = atingida no k-ésimo cenário
+    pré-calculado) e os campos do tooltip. Reaproveita o arquivo enquanto as assinaturas não mudarem
+    ('assinatura' = _assinatura_camada, com os arquivos de origem: fid/cen seguem as linhas atuais).
+    """
+    camada, campos = CAMADAS_TILES[nome_camada]
+    arq = os.path.join(PASTA_CACHE_TILES, f"{camada}.mbtiles")
+    versao = repr((assinatura, assinatura_cenarios, TILES_ZOOM, TILES_EXTENT))
+    try:
+        with closing(sqlite3.connect(f"file:{arq}?mode=ro", uri=True)) as con:
+            if con.execute("SELECT value FROM metadata WHERE name='assinatura'").fetchone() == (versao,):
+                return arq
+    except Exception:
+        pass
+
+    base4326, _ = _indice_espacial(nome_camada, assinatura, _gdf, False)
+    geoms = base4326.to_crs("EPSG:3857").geometry.values
+    colunas = [(c, r) for c, r in campos if c in base4326.columns]
+    valores = {c: base4326[c].tolist() for c, _ in colunas}
+    props = [{"fid": i, "cen": int(_bits[i]), **{c: valores[c][i] for c, _ in colunas}} for i in range(len(geoms))]
+    x0b, y0b, x1b, y1b = shapely.bounds(geoms).T
+    meio = 20037508.342789244
+
+    os.makedirs(PASTA_CACHE_TILES, exist_ok=True)
+    tmp = arq + ".tmp"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    with closing(sqlite3.connect(tmp)) as con:
+        con.execute("CREATE TABLE metadata (name text, value text)")
+        con.execute("CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+        for z in range(TILES_ZOOM[0], TILES_ZOOM[1] + 1):
+            lado = 2 * meio / 2 ** z
+            margem = lado * TILES_BUFFER / TILES_EXTENT
+            # par (tile, feição) para cada tile que o bbox da feição toca (com a margem de recorte)
+            tx0 = np.floor((x0b - margem + meio) / lado).astype(np.int64)
+            tx1 = np.floor((x1b + margem + meio) / lado).astype(np.int64)
+            ty0 = np.floor((meio - y1b - margem) / lado).astype(np.int64)
+            ty1 = np.floor((meio - y0b + margem) / lado).astype(np.int64)
+            n = (tx1 - tx0 + 1) * (ty1 - ty0 + 1)
+            feat = np.repeat(np.arange(len(geoms)), n)
+            k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+            larg = np.repeat(tx1 - tx0 + 1, n)
+            tx, ty = np.repeat(tx0, n) + k % larg, np.repeat(ty0, n) + k // larg
+            ordem = np.lexsort((ty, tx))
+            tx, ty, feat = tx[ordem], ty[ordem], feat[ordem]
+            cortes = np.flatnonzero(np.r_[True, (np.diff(tx) != 0) | (np.diff(ty) != 0), True])
+            for a, b in zip(cortes[:-1], cortes[1:]):
+                x, y, idx = int(tx[a]), int(ty[a]), feat[a:b]
+                xmin, ymax = -meio + x * lado, meio - y * lado
+                rec = shapely.clip_by_rect(geoms[idx], xmin - margem, ymax - lado - margem, xmin + lado + margem, ymax + margem)
+                esc = TILES_EXTENT / lado
+                rec = shapely.transform(rec, lambda c: np.column_stack([(c[:, 0] - xmin) * esc, (ymax - c[:, 1]) * esc]))
+                vivo = ~shapely.is_empty(rec)
+                dados = _tile_mvt(camada, rec[vivo], [props[i] for i in idx[vivo]], idx[vivo])
+                if dados is not None:
+                    con.execute("INSERT INTO tiles VALUES (?, ?, ?, ?)", (z, x, 2 ** z - 1 - y, gzip.compress(dados)))
+        con.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+        w, s, e, n_ = base4326.total_bounds
+        campos_json = {"fid": "Number", "cen": "Number", **{c: "String" for c, _ in colunas}}
+        con.executemany("INSERT INTO metadata VALUES (?, ?)", [
+            ("name", camada), ("format", "pbf"), ("type", "overlay"),
+            ("minzoom", str(TILES_ZOOM[0])), ("maxzoom", str(TILES_ZOOM[1])),
+            ("bounds", f"{w},{s},{e},{n_}"), ("assinatura", versao),
+            ("json", json.dumps({"vector_layers": [{"id": camada, "fields": campos_json}]})),
+        ])
+        con.commit()
+    os.replace(tmp, arq)
+    return arq
+
+class _TilesHandler(BaseHTTPRequestHandler):
+    """GET /<camada>/<z>/<x>/<y>.pbf -> tile gzipado do MBTiles registrado em server.camadas (204 se vazio)."""
+    def do_GET(self):
+        partes = self.path.split("?")[0].strip("/").split("/")
+        arq = self.server.camadas.get(partes[0]) if len(partes) == 4 else None
+        try:
+            z, x, y = int(partes[1]), int(partes[2]), int(partes[3].split(".")[0])
+        except (ValueError, IndexError):
+            arq = None
+        if arq is None:
+            self.send_error(404)
+            return
+        with closing(sqlite3.connect(f"file:{arq}?mode=ro", uri=True)) as con:
+            linha = con.execute("SELECT tile_data FROM tiles WHERE zoom_level=? AND tile_column=? AND tile_row=?",
+                                (z, x, 2 ** z - 1 - y)).fetchone()
+        self.send_response(200 if linha else 204)
+        self.send_header("Access-Control-Allow-Origin", "*")
+        self.send_header("Cache-Control", "no-cache")
+        if linha:
+            self.send_header("Content-Type", "application/x-protobuf")
+            self.send_header("Content-Encoding", "gzip")
+            self.send_header("Content-Length", str(len(linha[0])))
+        self.end_headers()
+        if linha:
+            self.wfile.write(linha[0])
+
+    def log_message(self, *args):
+        pass
 
-        # ---------- Funcionários no POPUP (robusto ao 88888) ----------
-            staff_sum = 0
-            for c in STAFF_COLS:  # STAFF_COLS já definido na seção EDUCAÇÃO
-                v = pd.to_numeric(row.get(c, 0), errors="coerce")
-                if pd.isna(v) or v == 88888:
-                    v = 0
-                staff_sum += float(v)
-            func = int(staff_sum)
-
-        # ---------- Demais campos ----------
-            nome = row.get("NO_ENTIDADE", "Sem Nome")
-            dep  = row.get("DEP_LABEL", dep_label(row.get("TP_DEPENDENCIA", "")))
-
-            mb = pd.to_numeric(row.get("QT_MAT_BAS", 0), errors="coerce")
-            mp = pd.to_numeric(row.get("QT_MAT_PROF", 0), errors="coerce")
-            mat_total = int((0 if pd.isna(mb) else mb) + (0 if pd.isna(mp) else mp))
-
-        # ---------- Popup ----------
-            popup_html = (
-                f"<b>Escola:</b> {nome}<br>"
-                f"<b>Dependência:</b> {dep}<br>"
-                f"<b>Funcionários:</b> {func}<br>"
-                f"<b>Matrículas (Básica + Prof.):</b> {mat_total}"
+@st.cache_resource(show_spinner=False)
+def servidor_tiles(porta: int) -> ThreadingHTTPServer | None:
+    """Servidor de tiles (um por processo, compartilhado entre sessões), numa thread daemon em 127.0.0.1."""
+    try:
+        srv = ThreadingHTTPServer(("127.0.0.1", porta), _TilesHandler)
+    except OSError:
+        return None
+    srv.daemon_threads = True
+    srv.camadas = {}
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    return srv
+
+class _TooltipTiles(folium.MacroElement):
+    """Tooltip ao passar o mouse sobre uma feição da camada de tiles (campos [[coluna, rótulo]])."""
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            (function (mapa, camada, rotulos) {
+                var dica = L.tooltip({direction: "top"});
+                camada.on("mouseover", function (e) {
+                    var p = e.layer.properties || {};
+                    var linhas = rotulos.filter(function (c) { return p[c[0]] !== undefined; })
+                                        .map(function (c) { return "<b>" + c[1] + "</b> " + p[c[0]]; });
+                    if (linhas.length) { dica.setLatLng(e.latlng).setContent(linhas.join("<br>")).openOn(mapa); }
+                });
+                camada.on("mouseout", function () { mapa.closeTooltip(dica); });
+            })({{ this._parent._parent.get_name() }}, {{ this._parent.get_name() }}, {{ this.rotulos }});
+        {% endmacro %}
+    """)
+
+    def __init__(self, rotulos: str):
+        super().__init__()
+        self._name = "TooltipTiles"
+        self.rotulos = rotulos
+
+def camada_tiles(nome_camada: str, estilo: dict, nome_legenda: str):
+    """
+    VectorGridProtobuf da camada, mostrando só as feições atingidas no cenário atual: pelo bit do cenário
+    pré-calculado (atributo 'cen') ou, para área desenhada, pela lista de 'fid' atingidos.
+    None se os tiles estiverem desligados ou indisponíveis (o mapa volta ao GeoJSON).
+    """
+    base = CAMADAS_BASE.get(nome_camada, (None, False))[0]
+    srv = servidor_tiles(TILES_PORTA) if TILES_PORTA else None
+    if srv is None or base is None or membros_atuais is None or nome_camada not in membros_atuais:
+        return None
+    nomes_cen = sorted(n for n, c in cenarios_preparados.items() if c is not None)
+    bits = np.zeros(len(base), dtype=np.int64)
+    for k, nome_cen in enumerate(nomes_cen):
+        bits[cenarios_preparados[nome_cen]["membros"].get(nome_camada, [])] |= 1 << k
+    assinatura_cen = tuple((n, os.path.getmtime(cenarios_arquivo[n])) for n in nomes_cen)
+    try:
+        arq = construir_mbtiles(nome_camada, _assinatura_camada(nome_camada, base), assinatura_cen, base, bits)
+    except Exception:
+        return None
+    camada, campos = CAMADAS_TILES[nome_camada]
+    srv.camadas[camada] = arq
+
+    if cenario_pre is not None:
+        teste = f"Math.floor(p.cen / {2 ** nomes_cen.index(selecao_mancha_nome)}) % 2 === 1"
+    else:
+        teste = "atingidos.has(p.fid)"
+    rotulos = json.dumps([[c, r] for c, r in campos], ensure_ascii=False)
+    return VectorGridProtobuf(f"{TILES_URL}/{camada}/{{z}}/{{x}}/{{y}}.pbf", nome_legenda, f"""{{
+        "rendererFactory": L.canvas.tile,
+        "interactive": true,
+        "maxNativeZoom": {TILES_ZOOM[1]},
+        "getFeatureId": function (f) {{ return f.properties.fid; }},
+        "vectorTileLayerStyles": {{
+            "{camada}": (function () {{
+                var atingidos = new Set({json.dumps([] if cenario_pre is not None else np.asarray(membros_atuais[nome_camada]).tolist())});
+                var estilo = {json.dumps(estilo)};
+                return function (p) {{ return ({teste}) ? estilo : []; }};
+            }})()
+        }}
+    }}""").add_child(_TooltipTiles(rotulos))
+
+# ---- Cache de mapas renderizados (compartilhado entre sessões) ----
+# Reexecuções que não mudam o mapa (expanders do painel, cliques fora do mapa) e vistas padrão repetidas entre
+# usuários reaproveitam o script/cabeçalho já renderizados, sem montar nem renderizar o folium.Map de novo.
+MAPA_CACHE_MB = float(os.environ.get("MAPA_CACHE_MB", "64"))   # teto de memória do cache (texto renderizado)
+MAPA_CACHE_ITENS = 128
+
+@st.cache_resource(show_spinner=False)
+def cache_mapas() -> dict:
+    """Chave -> pedaços do mapa renderizado; OrderedDict em ordem de uso (LRU), com total de bytes e trava."""
+    return {"itens": OrderedDict(), "bytes": 0, "trava": threading.Lock()}
+
+def _mapa_do_cache(chave) -> dict | None:
+    cache = cache_mapas()
+    with cache["trava"]:
+        pedacos = cache["itens"].get(chave)
+        if pedacos is not None:
+            cache["itens"].move_to_end(chave)
+        return pedacos
+
+def _guardar_mapa(chave, pedacos: dict):
+    """Insere no cache e descarta os menos usados até caber em MAPA_CACHE_MB / MAPA_CACHE_ITENS."""
+    cache = cache_mapas()
+    with cache["trava"]:
+        if chave in cache["itens"] or pedacos["bytes"] > MAPA_CACHE_MB * 2**20:   # maior que o teto: não guarda
+            return
+        cache["itens"][chave] = pedacos
+        cache["bytes"] += pedacos["bytes"]
+        while cache["itens"] and (cache["bytes"] > MAPA_CACHE_MB * 2**20 or len(cache["itens"]) > MAPA_CACHE_ITENS):
+            _, antigo = cache["itens"].popitem(last=False)
+            cache["bytes"] -= antigo["bytes"]
+
+def _elementos(e):
+    yield e
+    for filho in getattr(e, "_children", {}).values():
+        yield from _elementos(filho)
+
+def _congelar_mapa(m: folium.Map) -> dict:
+    """
+    Renderiza o mapa uma vez, na mesma ordem do st_folium (figura, cabeçalho/HTML, script), e guarda só o que o
+    componente recebe: script, cabeçalho e HTML (sem os links, refeitos a partir de 'js'/'css'), opções e limites.
+    """
+    raiz = m.get_root()
+    raiz.render()
+    da_figura = set(folium.Figure().header._children)   # meta etc., recriados pela figura do _MapaCongelado
+    cabecalho = "\n".join(e.render() for nome, e in raiz.header._children.items()
+                          if nome not in da_figura and not isinstance(e, (folium.CssLink, folium.JavascriptLink)))
+    html = "\n".join(e.render() for e in raiz.html._children.values())
+    cabecalho, html = cabecalho.replace(m.get_name(), "map_div"), html.replace(m.get_name(), "map_div")
+    limites = m.get_bounds()
+    script = generate_leaflet_string(m)
+    elementos = list(_elementos(m))
+    return {
+        "script": script, "cabecalho": cabecalho, "html": html, "opcoes": dict(m.options), "limites": limites,
+        "js": list(dict.fromkeys(l for e in elementos for l in getattr(e, "default_js", []))),
+        "css": list(dict.fromkeys(l for e in elementos for l in getattr(e, "default_css", []))),
+        "bytes": sum(len(t.encode()) for t in (script, cabecalho, html)),   # UTF-8: acentos ocupam mais de um byte
+    }
+
+class _MapaCongelado(folium.Map):
+    """Mapa do cache: o st_folium recebe o script/cabeçalho/HTML já renderizados, sem filhos para percorrer."""
+    _template = Template("""
+        {% macro script(this, kwargs) %}{{ this.script }}{% endmacro %}
+    """)
+
+    def __init__(self, pedacos: dict):
+        super().__init__(tiles=None)
+        self.script = pedacos["script"]
+        self.options = pedacos["opcoes"]
+        self.default_js = pedacos["js"]
+        self.default_css = pedacos["css"]
+        self._limites = pedacos["limites"]
+        self.get_root().header.add_child(folium.Element(pedacos["cabecalho"]), name="mapa_congelado")
+        self.get_root().html.add_child(folium.Element(pedacos["html"]), name="mapa_congelado")
+
+    def get_bounds(self):
+        return self._limites
+
+@st.fragment
+def mapa_interativo():
+    # ---- Controle de Camadas (no fragmento do mapa: alternar não reexecuta o painel) ----
+    st.markdown("**Controle de Camadas**")
+    c3_sc, c4_sc, c5_sc, c6_sc, c7_sc = st.columns(5)
+    mostrar_empresas  = c3_sc.checkbox("Empresas", key="ck_empresas")
+    mostrar_saude     = c4_sc.checkbox("Saúde", key="ck_saude")
+    mostrar_educacao  = c5_sc.checkbox("Educação", key="ck_educacao")
+    mostrar_predios   = c6_sc.checkbox("Prédios Públicos", key="ck_predios")
+    mostrar_seguranca = c7_sc.checkbox("Segurança", key="ck_seguranca")
+    c_modo, c_peso = st.columns(2)
+    densidade = c_modo.radio("Empresas e Imóveis", ["Marcadores", "Densidade"], horizontal=True,
+                             key="modo_pontos") == "Densidade"
+    peso_densidade = c_peso.selectbox("Peso da densidade (Empresas)", list(PESOS_DENSIDADE), key="peso_densidade",
+                                      disabled=not densidade)
+
+    # Vista atual (zoom/centro/limites devolvidos pelo st_folium): escolhe o nível de detalhe e o recorte, e é
+    # restaurada quando o mapa é remontado
+    vista = st.session_state.get("mapa") or {}
+    zoom_mapa = vista.get("zoom") or 13
+    tol_lod = tolerancia_lod(zoom_mapa)
+    caixa_vista = _caixa_vista(vista, zoom_mapa)   # só o que está na vista (+ margem) é serializado
+
+    # Mapa renderizado em cache (entre sessões): cenário, camadas ligadas, filtros e vista definem o resultado
+    filtros_hash = hashlib.sha1(repr(sorted((nome, _chave_filtros(f)) for nome, f in filtros_ativos.items())).encode()).hexdigest()
+    chave_mapa = (cenario_chave, assinaturas_camadas, filtros_hash, zoom_mapa, caixa_vista,
+                  (mostrar_empresas, mostrar_saude, mostrar_educacao, mostrar_predios, mostrar_seguranca),
+                  (mostrar_empresas_atingidas, mostrar_saude_atingida, mostrar_educacao_atingida, mostrar_ruas_atingidas,
+                   mostrar_terrenos_atingidos, mostrar_quadras_atingidas, mostrar_imoveis_atingidos,
+                   mostrar_predios_atingidos, mostrar_seguranca_atingida),
+                  densidade and peso_densidade)
+    pedacos = _mapa_do_cache(chave_mapa)
+    if pedacos is None:
+        with st.spinner("Atualizando mapa..."):
+            m = folium.Map(location=[-32.0540, -52.1150], zoom_start=13, tiles="CartoDB positron")
+
+            if mancha_selecionada_gdf is not None:
+                mancha_desenho = geometrias_lod(f"mancha:{selecao_mancha_nome}", cenario_chave,
+                                                _assinatura(mancha_selecionada_gdf), tol_lod, mancha_selecionada_gdf)
+                folium.GeoJson(
+                    _geojson_enxuto(mancha_desenho, []),
+                    name=selecao_mancha_nome,
+                    show=True,
+                    tooltip=selecao_mancha_nome,
+                    style_function=lambda x: {'color': 'blue', 'weight': 1.5, 'fillColor': '#3186cc', 'fillOpacity': 0.6}
+                ).add_to(m)
+
+            # Empresas
+            empresas_para_plotar = (
+                empresas_atingidas_gdf if mostrar_empresas_atingidas else empresas_filtradas
+            )
+            if mostrar_empresas and densidade and (empresas_para_plotar is not None) and (not empresas_para_plotar.empty):
+                grade = grade_densidade("Empresas", (cenario_chave if modo_atingidos else None, _chave_filtros(filtros_ativos.get("Empresas"))),
+                                        _assinatura_camada("Empresas", empresas_gdf), PESOS_DENSIDADE[peso_densidade][0], lado_densidade(zoom_mapa),
+                                        empresas_gdf, mascaras_filtro.get("Empresas"), (membros_atuais or {}).get("Empresas"))
+                camada = camada_densidade(grade, "Empresas (densidade)", peso_densidade, mostrar_empresas_atingidas, caixa_vista)
+                if camada is not None:
+                    camada.add_to(m)
+            elif mostrar_empresas and (empresas_para_plotar is not None) and (not empresas_para_plotar.empty):
+                fg_empresas = folium.FeatureGroup(name="Empresas", show=True)
+                camada = _agregados(m, "#1976d2", "Empresas", _chave_pontos("Empresas", mostrar_empresas_atingidas), empresas_para_plotar, caixa_vista, zoom_mapa)
+                if camada is None:
+                    empresas_para_plotar = _na_vista("Empresas", empresas_para_plotar, caixa_vista)
+                    camada = _cluster("#1976d2", empresas_para_plotar, [
+                        ("ID",             _textos(empresas_para_plotar, "id")),
+                        ("Empregados",     _textos(empresas_para_plotar, "Empregados")),
+                        ("Massa Salarial", _textos(empresas_para_plotar, "Massa_Salarial", "R$ 0,00", lambda v: f"R$ {formatar_br(v)}")),
+                        ("Média Salarial", _textos(empresas_para_plotar, "MédiaSalarial", "R$ 0,00", lambda v: f"R$ {formatar_br(v)}")),
+                    ], [icone_mapa(m, "Empresas", size=(28,28))])
+                camada.add_to(fg_empresas)
+                fg_empresas.add_to(m)
+
+            # Saúde
+            saude_para_plotar = (
+                saude_atingida_gdf if mostrar_saude_atingida else saude_filtrada
+            )
+            if mostrar_saude and (saude_para_plotar is not None) and (not saude_para_plotar.empty):
+                fg_saude = folium.FeatureGroup(name="Saúde", show=True)
+                camada = _agregados(m, "#2e7d32", "Saúde", _chave_pontos("Saúde", mostrar_saude_atingida), saude_para_plotar, caixa_vista, zoom_mapa)
+                if camada is None:
+                    saude_para_plotar = _na_vista("Saúde", saude_para_plotar, caixa_vista)
+                    camada = _cluster("#2e7d32", saude_para_plotar, [
+                        ("Nome",       _textos(saude_para_plotar, "NO_FANTASIA", "Sem Nome")),
+                        ("Bairro",     _textos(saude_para_plotar, "NO_BAIRRO", "—")),
+                        ("Logradouro", _textos(saude_para_plotar, "NO_LOGRADOURO", "—")),
+                        ("Número",     _textos(saude_para_plotar, "NU_ENDERECO", "—")),
+                    ], [icone_mapa(m, "Saude", size=(28,28))], max_width=320)
+                camada.add_to(fg_saude)
+                fg_saude.add_to(m)
+
+            # Educação (FIX: sem fallback quando "Atingidos" estiver marcado)
+            educacao_para_plotar = (
+                educacao_atingida_gdf if mostrar_educacao_atingida else educacao_filtrada
             )
 
-            folium.Marker(
-                location=ll,
-                popup=folium.Popup(popup_html, max_width=360),
-                icon=icon_edu
-            ).add_to(mc_edu)
-
-        fg_edu.add_to(m)
-
-    # Ruas
-    if mostrar_ruas_atingidas and (logradouros_atingidos_gdf is not None) and (not logradouros_atingidos_gdf.empty):
-        folium.GeoJson(
-            logradouros_atingidos_gdf, name="Logradouros Atingidos", show=True,
-            tooltip=folium.features.GeoJsonTooltip(
-                fields=[f for f in ['tipo','nome'] if f in logradouros_atingidos_gdf.columns],
-                aliases=['Tipo:', 'Nome:']
-            ),
-            style_function=lambda x: {'color': 'red', 'weight': 4}
-        ).add_to(m)
-
-    # Terrenos
-    if mostrar_terrenos_atingidos and (terrenos_atingidos_gdf is not None) and (not terrenos_atingidos_gdf.empty):
-        folium.GeoJson(
-            terrenos_atingidos_gdf, name="Terrenos Atingidos", show=True,
-            tooltip=folium.features.GeoJsonTooltip(
-                fields=[f for f in ['area_lote'] if f in terrenos_atingidos_gdf.columns],
-                aliases=['Área do Lote (m²):']
-            ),
-            style_function=lambda x: {'color': '#b34700', 'weight': 1, 'fillColor': '#ff7f00', 'fillOpacity': 0.45}
-        ).add_to(m)
-
-    # Quadras
-    if mostrar_quadras_atingidas and (quadras_atingidas_gdf is not None) and (not quadras_atingidas_gdf.empty):
-        quad_fields = [c for c in ['id','area','area_m2'] if c in quadras_atingidas_gdf.columns]
-        aliases = ['ID:', 'Área:', 'Área (m²):'][:len(quad_fields)]
-        folium.GeoJson(
-            quadras_atingidas_gdf, name="Quadras Atingidas", show=True,
-            tooltip=folium.features.GeoJsonTooltip(fields=quad_fields, aliases=aliases) if quad_fields else None,
-            style_function=lambda x: {'color': '#6f42c1', 'weight': 1, 'fillColor': '#b197fc', 'fillOpacity': 0.35}
-        ).add_to(m)
-
-    # Imóveis (somente atingidos)
-    if mostrar_imoveis_atingidos and (imoveis_atingidos_gdf is not None) and (not imoveis_atingidos_gdf.empty):
-        fg_imoveis = folium.FeatureGroup(name="Imóveis Atingidos", show=True)
-        mc_imov = _cluster("#6f42c1").add_to(fg_imoveis)
-        icon_imv = get_custom_icon("PrediosPublicos", size=(24,24))
-        for _, row in imoveis_atingidos_gdf.iterrows():
-            geom = row.geometry
-            ll = (float(geom.y), float(geom.x))
-            linhas = []
-            if "Uso" in imoveis_atingidos_gdf.columns:    linhas.append(f"<b>Uso:</b> {row.get('Uso')}")
-            if "Patrim" in imoveis_atingidos_gdf.columns: linhas.append(f"<b>Patrim:</b> {row.get('Patrim')}")
-            if "Condom" in imoveis_atingidos_gdf.columns: linhas.append(f"<b>Condomínio:</b> {row.get('Condom')}")
-            pop = folium.Popup("<br>".join(linhas), max_width=260) if linhas else None
-            folium.Marker(location=ll, popup=pop, icon=icon_imv).add_to(mc_imov)
-        fg_imoveis.add_to(m)
-
-    # Prédios Públicos
-    predios_para_plotar = (
-        predios_atingidos_gdf if mostrar_predios_atingidos else predios_filtrados
-    )
-    if mostrar_predios and (predios_para_plotar is not None) and (len(predios_para_plotar) > 0):
-        fg_pp = folium.FeatureGroup(name="Prédios Públicos", show=True)
-        mc_pp = _cluster("#00695c").add_to(fg_pp)
-        for _, row in predios_para_plotar.iterrows():
-            ll = _latlon_from_row(row)
-            if ll is None: 
-                continue
-            nome  = row.get('Nome', 'Sem Nome')
-            ender = row.get('Endereço', '—') if 'Endereço' in predios_para_plotar.columns else row.get('Endereco', '—')
-            popup_html = (f"<b>Nome:</b> {nome}<br><b>Endereço:</b> {ender}")
-            tipo_val = str(row.get('Tipo', '')).lower()
-            use_escola = ("escola" in tipo_val) or ("educa" in tipo_val)
-            icon_pp = get_custom_icon("Escola", size=(28,28)) if use_escola else get_custom_icon("PrediosPublicos", size=(28,28))
-            folium.Marker(location=ll, popup=folium.Popup(popup_html, max_width=320), icon=icon_pp).add_to(mc_pp)
-        fg_pp.add_to(m)
-
-    # Segurança
-    seguranca_para_plotar = (
-        seguranca_atingida_gdf if mostrar_seguranca_atingida else seguranca_filtrada
-    )
-    if mostrar_seguranca and (seguranca_para_plotar is not None) and (len(seguranca_para_plotar) > 0):
-        fg_sg = folium.FeatureGroup(name="Segurança", show=True)
-        mc_sg = _cluster("#424242").add_to(fg_sg)
-        icon_seg = get_custom_icon("Seguranca", size=(28,28))
-        for _, row in seguranca_para_plotar.iterrows():
-            ll = _latlon_from_row(row)
-            if ll is None:
-                continue
-            nome  = row.get('Nome', 'Sem Nome')
-            ender = row.get('Endereço', '—') if 'Endereço' in seguranca_para_plotar.columns else row.get('Endereco', '—')
-            popup_html = (f"<b>Nome:</b> {nome}<br><b>Endereço:</b> {ender}")
-            folium.Marker(location=ll, popup=folium.Popup(popup_html, max_width=320), icon=icon_seg).add_to(mc_sg)
-        fg_sg.add_to(m)
-
-    folium.LayerControl(collapsed=True).add_to(m)
-    st_folium(m, width="100%", height=600, returned_objects=[])
+            if mostrar_educacao and (educacao_para_plotar is not None) and (not educacao_para_plotar.empty):
+                fg_edu = folium.FeatureGroup(name="Educação", show=True)
+                camada = _agregados(m, "#0d9488", "Educação", _chave_pontos("Educação", mostrar_educacao_atingida), educacao_para_plotar, caixa_vista, zoom_mapa)
+                if camada is None:
+                    educacao_para_plotar = _na_vista("Educação", educacao_para_plotar, caixa_vista)
+                    # Campos já materializados no carregamento (88888 tratado)
+                    camada = _cluster("#0d9488", educacao_para_plotar, [  # teal
+                        ("Escola",                     _textos(educacao_para_plotar, "NO_ENTIDADE", "Sem Nome")),
+                        ("Dependência",                _textos(educacao_para_plotar, "DEP_LABEL", "")),
+                        ("Funcionários",               _textos(educacao_para_plotar, "QT_FUNCIONARIOS", 0, lambda v: str(int(v)))),
+                        ("Matrículas (Básica + Prof.)", _textos(educacao_para_plotar, "MAT_BAS_PROF", 0, lambda v: str(int(v)))),
+                    ], [icone_mapa(m, "Escola", size=(28,28))], max_width=360)
+                camada.add_to(fg_edu)
+
+                fg_edu.add_to(m)
+
+            # Ruas
+            if mostrar_ruas_atingidas and (logradouros_atingidos_gdf is not None) and (not logradouros_atingidos_gdf.empty):
+                tiles = camada_tiles("Ruas", {"color": "red", "weight": 4}, "Logradouros Atingidos")
+                if tiles is not None:
+                    tiles.add_to(m)
+                else:
+                    camada_vetorial(_na_vista("Ruas", logradouros_atingidos_gdf, caixa_vista), "Logradouros Atingidos", ['tipo','nome'], ['Tipo:', 'Nome:'],
+                                    {'color': 'red', 'weight': 4}).add_to(m)
+
+            # Terrenos
+            if mostrar_terrenos_atingidos and (terrenos_atingidos_gdf is not None) and (not terrenos_atingidos_gdf.empty):
+                tiles = camada_tiles("Terrenos", {"color": "#b34700", "weight": 1, "fill": True, "fillColor": "#ff7f00", "fillOpacity": 0.45},
+                                     "Terrenos Atingidos")
+                if tiles is not None:
+                    tiles.add_to(m)
+                else:
+                    terrenos_desenho = geometrias_lod("Terrenos", cenario_chave, _assinatura(terrenos_atingidos_gdf),
+                                                      tol_lod, terrenos_atingidos_gdf)
+                    camada_vetorial(_na_vista("Terrenos", terrenos_desenho, caixa_vista), "Terrenos Atingidos", ['area_lote'], ['Área do Lote (m²):'],
+                                    {'color': '#b34700', 'weight': 1, 'fillColor': '#ff7f00', 'fillOpacity': 0.45},
+                                    topologia=True).add_to(m)
+
+            # Quadras
+            if mostrar_quadras_atingidas and (quadras_atingidas_gdf is not None) and (not quadras_atingidas_gdf.empty):
+                tiles = camada_tiles("Quadras", {"color": "#6f42c1", "weight": 1, "fill": True, "fillColor": "#b197fc", "fillOpacity": 0.35},
+                                     "Quadras Atingidas")
+                if tiles is not None:
+                    tiles.add_to(m)
+                else:
+                    quadras_desenho = geometrias_lod("Quadras", cenario_chave, _assinatura(quadras_atingidas_gdf),
+                                                     tol_lod, quadras_atingidas_gdf)
+                    camada_vetorial(_na_vista("Quadras", quadras_desenho, caixa_vista), "Quadras Atingidas", ['id','area','area_m2'], ['ID:', 'Área:', 'Área (m²):'],
+                                    {'color': '#6f42c1', 'weight': 1, 'fillColor': '#b197fc', 'fillOpacity': 0.35},
+                                    topologia=True).add_to(m)
+
+            # Imóveis (somente atingidos)
+            if mostrar_imoveis_atingidos and densidade and (imoveis_atingidos_gdf is not None) and (not imoveis_atingidos_gdf.empty):
+                grade = grade_densidade("Imóveis", (cenario_chave, ()), _assinatura_camada("Imóveis", imoveis_gdf), None, lado_densidade(zoom_mapa),
+                                        imoveis_gdf, None, (membros_atuais or {}).get("Imóveis"))
+                camada = camada_densidade(grade, "Imóveis (densidade)", "Contagem", True, caixa_vista)
+                if camada is not None:
+                    camada.add_to(m)
+            elif mostrar_imoveis_atingidos and (imoveis_atingidos_gdf is not None) and (not imoveis_atingidos_gdf.empty):
+                fg_imoveis = folium.FeatureGroup(name="Imóveis Atingidos", show=True)
+                camada = _agregados(m, "#6f42c1", "Imóveis", _chave_pontos("Imóveis", True), imoveis_atingidos_gdf, caixa_vista, zoom_mapa)
+                if camada is None:
+                    imoveis_para_plotar = _na_vista("Imóveis", imoveis_atingidos_gdf, caixa_vista)
+                    campos_imv = [(rot, _textos(imoveis_para_plotar, col))
+                                  for rot, col in (("Uso", "Uso"), ("Patrim", "Patrim"), ("Condomínio", "Condom"))
+                                  if col in imoveis_para_plotar.columns]
+                    camada = _cluster("#6f42c1", imoveis_para_plotar, campos_imv,
+                                      [icone_mapa(m, "PrediosPublicos", size=(24,24))], max_width=260)
+                camada.add_to(fg_imoveis)
+                fg_imoveis.add_to(m)
+
+            # Prédios Públicos
+            predios_para_plotar = (
+                predios_atingidos_gdf if mostrar_predios_atingidos else predios_filtrados
+            )
+            if mostrar_predios and (predios_para_plotar is not None) and (len(predios_para_plotar) > 0):
+                fg_pp = folium.FeatureGroup(name="Prédios Públicos", show=True)
+                camada = _agregados(m, "#00695c", "Prédios Públicos", _chave_pontos("Prédios Públicos", mostrar_predios_atingidos), predios_para_plotar, caixa_vista, zoom_mapa)
+                if camada is None:
+                    predios_para_plotar = _na_vista("Prédios Públicos", predios_para_plotar, caixa_vista)
+                    col_end = 'Endereço' if 'Endereço' in predios_para_plotar.columns else 'Endereco'
+                    tipo_pp = predios_para_plotar.get('Tipo', pd.Series("", index=predios_para_plotar.index)).astype(str).str.lower()
+                    use_escola = (tipo_pp.str.contains("escola", regex=False) | tipo_pp.str.contains("educa", regex=False)).to_numpy()
+                    camada = _cluster("#00695c", predios_para_plotar, [
+                        ("Nome",     _textos(predios_para_plotar, "Nome", "Sem Nome")),
+                        ("Endereço", _textos(predios_para_plotar, col_end, "—")),
+                    ], [icone_mapa(m, "PrediosPublicos", size=(28,28)), icone_mapa(m, "Escola", size=(28,28))],
+                        idx_icone=use_escola.astype(int), max_width=320)
+                camada.add_to(fg_pp)
+                fg_pp.add_to(m)
+
+            # Segurança
+            seguranca_para_plotar = (
+                seguranca_atingida_gdf if mostrar_seguranca_atingida else seguranca_filtrada
+            )
+            if mostrar_seguranca and (seguranca_para_plotar is not None) and (len(seguranca_para_plotar) > 0):
+                fg_sg = folium.FeatureGroup(name="Segurança", show=True)
+                camada = _agregados(m, "#424242", "Segurança", _chave_pontos("Segurança", mostrar_seguranca_atingida), seguranca_para_plotar, caixa_vista, zoom_mapa)
+                if camada is None:
+                    seguranca_para_plotar = _na_vista("Segurança", seguranca_para_plotar, caixa_vista)
+                    col_end = 'Endereço' if 'Endereço' in seguranca_para_plotar.columns else 'Endereco'
+                    camada = _cluster("#424242", seguranca_para_plotar, [
+                        ("Nome",     _textos(seguranca_para_plotar, "Nome", "Sem Nome")),
+                        ("Endereço", _textos(seguranca_para_plotar, col_end, "—")),
+                    ], [icone_mapa(m, "Seguranca", size=(28,28))], max_width=320)
+                camada.add_to(fg_sg)
+                fg_sg.add_to(m)
+
+            Draw(
+                export=False,
+                draw_options={"polyline": False, "circle": False, "marker": False, "circlemarker": False,
+                              "polygon": True, "rectangle": True},
+                edit_options={"edit": False, "remove": False},
+            ).add_to(m)
+
+            folium.LayerControl(collapsed=True).add_to(m)
+            pedacos = _congelar_mapa(m)
+        _guardar_mapa(chave_mapa, pedacos)
+
+    centro = vista.get("center")
+    retorno_mapa = st_folium(_MapaCongelado(pedacos), width="100%", height=600, key="mapa",
+                             returned_objects=["last_active_drawing", "zoom", "center", "bounds"],
+                             zoom=zoom_mapa, center=(centro["lat"], centro["lng"]) if centro else None)
+
+    # ---- Polígono desenhado vira o cenário temporário "Área Desenhada" ----
+    _desenho = (retorno_mapa or {}).get("last_active_drawing")
+    if (_desenho is not None
+            and (_desenho.get("geometry") or {}).get("type") in ("Polygon", "MultiPolygon")
+            and _desenho != st.session_state.get("desenho_consumido")):
+        # 'desenho_consumido' evita reprocessar o mesmo retorno do componente (inclusive após descartar a área)
+        st.session_state["desenho_consumido"] = _desenho
+        st.session_state["mancha_desenhada"] = _desenho
+        st.session_state["selecionar_desenho"] = True
+        st.rerun(scope="app")   # novo cenário: reexecuta o script inteiro
+
+mapa_interativo()
 
 # ---------- Rodapé ----------
 st.markdown("""
@@ -0,0 +1,60 @@
+"""Cubo de impacto: totais iguais ao tamanho da camada, mesmo com dimensões ausentes (NaN)."""
+import ast
+from pathlib import Path
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+
+DASHBOARD = Path(__file__).resolve().parents[1] / "Dashboard.py"
+
+
+def _carregar(*nomes: str) -> dict:
+    """Executa só as definições de topo pedidas do Dashboard.py (o script inteiro sobe o Streamlit)."""
+    arvore = ast.parse(DASHBOARD.read_text(encoding="utf-8"))
+    nos = [n for n in arvore.body
+           if (isinstance(n, ast.FunctionDef) and n.name in nomes)
+           or (isinstance(n, ast.Assign) and any(getattr(t, "id", None) in nomes for t in n.targets))]
+    ns = {"np": np, "pd": pd, "gpd": gpd}
+    exec(compile(ast.Module(body=nos, type_ignores=[]), str(DASHBOARD), "exec"), ns)
+    return ns
+
+
+ns = _carregar("NAO_INFORMADO", "_cubo_camada", "_total_atingido", "_por_categoria")
+
+
+def _camada(n: int, frac_nan: float, seed: int = 0) -> gpd.GeoDataFrame:
+    rng = np.random.default_rng(seed)
+    secao = rng.choice(["A", "B", "C"], n).astype(object)
+    secao[rng.random(n) < frac_nan] = np.nan
+    situacao = rng.choice(["Ativa", "Baixada"], n).astype(object)
+    situacao[rng.random(n) < frac_nan] = None
+    return gpd.GeoDataFrame({
+        "Seção": secao,
+        "situacao_cadastral_desc": situacao,
+        "Empregados": rng.integers(0, 50, n),
+    }, geometry=gpd.points_from_xy(rng.random(n), rng.random(n)), crs="EPSG:4326")
+
+
+def test_totais_do_cubo_batem_com_a_camada_e_os_atingidos():
+    gdf = _camada(2000, frac_nan=0.25)
+    pos = np.flatnonzero(np.random.default_rng(1).random(len(gdf)) < 0.3)
+    cubo = ns["_cubo_camada"](gdf, pos, ["Seção", "situacao_cadastral_desc"], ["Empregados"])
+
+    total, atingidos = ns["_total_atingido"](cubo)
+    assert total == len(gdf)
+    assert atingidos == len(pos)
+    total_emp, atingidos_emp = ns["_total_atingido"](cubo, "Empregados")
+    assert total_emp == gdf["Empregados"].sum()
+    assert atingidos_emp == gdf["Empregados"].iloc[pos].sum()
+
+
+def test_ausentes_viram_categoria_nao_informado():
+    gdf = _camada(4, frac_nan=0.0)
+    gdf.loc[3, "Seção"] = np.nan
+    cubo = ns["_cubo_camada"](gdf, None, ["Seção"], [])
+
+    por_secao = ns["_por_categoria"](cubo, "Seção").set_index("Seção")["Total"]
+    assert por_secao.sum() == 4
+    assert por_secao[ns["NAO_INFORMADO"]] == 1
+    assert "nan" not in por_secao.index